@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -21,6 +21,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third-party apps
     'rest_framework',
@@ -32,6 +33,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'products.metrics.RequestMetricsMiddleware',  # first, so it times the whole request
+    'products.routers.ReplicaPinningMiddleware',  # before the session middleware, which may write
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -71,9 +74,38 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default='postgres'),
         'HOST': config('DB_HOST', default='localhost'),
         'PORT': config('DB_PORT', default='5432'),
+        # Keep connections between requests instead of reconnecting each time
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Read replicas for search and catalog reads (products.routers): comma separated
+# host[:port][/name] of streaming replicas of the default database, e.g.
+# DB_REPLICAS=replica1:5432,replica2:5432. Name defaults to DB_NAME.
+DB_REPLICAS = config('DB_REPLICAS', default='', cast=Csv())
+for index, replica in enumerate(DB_REPLICAS, 1):
+    address, _, name = replica.partition('/')
+    host, _, port = address.partition(':')
+    DATABASES[f'replica_{index}'] = {
+        **DATABASES['default'],
+        'NAME': name or DATABASES['default']['NAME'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        # Fail fast on an unreachable replica; reads then go to another one or the primary
+        'OPTIONS': {'connect_timeout': config('DB_REPLICA_CONNECT_TIMEOUT', default=2, cast=int)},
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['products.routers.ReplicaRouter']
+# Replicas lagging more than this many seconds are skipped, and reads stay on
+# the primary for this long after a catalog write
+DB_REPLICA_MAX_LAG = config('DB_REPLICA_MAX_LAG', default=5.0, cast=float)
+# How often (seconds) each process checks the lag of every replica
+DB_REPLICA_CHECK_INTERVAL = config('DB_REPLICA_CHECK_INTERVAL', default=5.0, cast=float)
+# Reads of a client that wrote stay on the primary for this many seconds
+DB_PRIMARY_PIN_SECONDS = config('DB_PRIMARY_PIN_SECONDS', default=10, cast=int)
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -105,8 +137,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # REST Framework settings
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'products.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
+    'DEFAULT_RENDERER_CLASSES': [
+        'products.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.AnonRateThrottle',
@@ -128,3 +164,145 @@ CACHES = {
         'LOCATION': 'unique-snowflake',
     }
 }
+
+# Shared cache for multi-process deployments, e.g. REDIS_URL=redis://localhost:6379/1
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+
+# Search settings
+# Thresholds for the indexable pg_trgm operators used in fuzzy matching:
+# `%` (similarity) on brand names and `<%` (word similarity) on product names.
+SEARCH_TRIGRAM_SIMILARITY_THRESHOLD = config('SEARCH_TRIGRAM_SIMILARITY_THRESHOLD', default=0.3, cast=float)
+SEARCH_TRIGRAM_WORD_SIMILARITY_THRESHOLD = config('SEARCH_TRIGRAM_WORD_SIMILARITY_THRESHOLD', default=0.6, cast=float)
+
+# Two-phase search: each retrieval source returns at most this many candidate
+# ids, and only those candidates are scored with the relevance formula below.
+SEARCH_CANDIDATE_LIMIT = config('SEARCH_CANDIDATE_LIMIT', default=500, cast=int)
+SEARCH_RELEVANCE_WEIGHTS = {
+    'full_text': 2.0,  # Full-text gets higher weight
+    'name': 1.0,
+    'name_ar': 0.7,
+    'name_ar_arabic': 0.9,  # name_ar weight when the query contains Arabic
+    'brand': 0.8,
+}
+
+# Spell correction against the term dictionary (products.spelling): query words
+# of at least SEARCH_SPELL_MIN_LENGTH letters that no catalog word starts with
+# are replaced by the most similar dictionary term scoring at least
+# SEARCH_SPELL_MIN_SIMILARITY. When every word is known or corrected, the
+# trigram scans of product names are skipped.
+SEARCH_SPELL_CORRECTION = config('SEARCH_SPELL_CORRECTION', default=True, cast=bool)
+SEARCH_SPELL_MIN_LENGTH = config('SEARCH_SPELL_MIN_LENGTH', default=4, cast=int)
+SEARCH_SPELL_MIN_SIMILARITY = config('SEARCH_SPELL_MIN_SIMILARITY', default=0.4, cast=float)
+
+# Search result cache: ranked id lists per page, invalidated by a generation
+# counter that is bumped on every Product, Brand or Category write.
+SEARCH_CACHE_ALIAS = 'default'
+SEARCH_CACHE_TIMEOUT = config('SEARCH_CACHE_TIMEOUT', default=300, cast=int)
+SEARCH_CACHE_LOCK_TIMEOUT = config('SEARCH_CACHE_LOCK_TIMEOUT', default=5, cast=int)
+
+# HTTP caching of the catalog endpoints (products.conditional): responses carry
+# an ETag and Last-Modified of the catalog generation, and browsers, proxies and
+# CDNs may reuse them for CATALOG_CACHE_MAX_AGE seconds before revalidating.
+CATALOG_CACHE_MAX_AGE = config('CATALOG_CACHE_MAX_AGE', default=60, cast=int)
+# Category and brand responses are kept in the search cache until the next
+# catalog write, or at most this many seconds
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Search facets (?facets=brand,category,price): upper bounds of the price
+# buckets and the number of brand/category values returned per facet
+SEARCH_FACET_PRICE_BUCKETS = (2, 5, 10, 20, 50)
+SEARCH_FACET_LIMIT = config('SEARCH_FACET_LIMIT', default=20, cast=int)
+
+# Batch search (POST /api/products/search/batch/): searches per request and
+# results per search
+SEARCH_BATCH_MAX_QUERIES = config('SEARCH_BATCH_MAX_QUERIES', default=50, cast=int)
+SEARCH_BATCH_MAX_LIMIT = config('SEARCH_BATCH_MAX_LIMIT', default=100, cast=int)
+
+# Streaming export (/api/products/export/, export_products): rows fetched per
+# server-side cursor round trip and written per response chunk
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=2000, cast=int)
+
+# Admin changelists (products.pagination.EstimatedCountPaginator) show the
+# planner's row estimate instead of running COUNT(*), exact below this many rows
+ESTIMATED_COUNT_THRESHOLD = config('ESTIMATED_COUNT_THRESHOLD', default=10000, cast=int)
+
+# Change feed (/api/products/changes/): changes per page by default and at
+# most, and seconds a change is held back in case transactions started
+# around the same time are yet to commit (see products.changes)
+CHANGES_PAGE_SIZE = config('CHANGES_PAGE_SIZE', default=500, cast=int)
+CHANGES_MAX_PAGE_SIZE = config('CHANGES_MAX_PAGE_SIZE', default=5000, cast=int)
+CHANGES_SETTLE_SECONDS = config('CHANGES_SETTLE_SECONDS', default=1.0, cast=float)
+
+# Related products (/api/products/{id}/related/, compute_related_products):
+# neighbours stored per product, chosen among this many candidates with the
+# nearest names in the product's category
+RELATED_PRODUCTS_LIMIT = config('RELATED_PRODUCTS_LIMIT', default=10, cast=int)
+RELATED_PRODUCTS_CANDIDATES = config('RELATED_PRODUCTS_CANDIDATES', default=50, cast=int)
+
+# Search engine used by ProductSearchService: the ORM backend ranks in Postgres,
+# 'products.engine.InMemorySearchBackend' ranks from an in-process index.
+SEARCH_BACKEND = config('SEARCH_BACKEND', default='products.services.ORMSearchBackend')
+# Build the in-memory indexes (the SEARCH_BACKEND's, if it keeps one, and the
+# typeahead's) when a worker starts instead of on the first request needing them.
+# Boot then queries the whole catalog and fails while the database is down.
+SEARCH_WARM_UP = config('SEARCH_WARM_UP', default=False, cast=bool)
+# How often (seconds) the in-memory index checks for writes made by other processes
+SEARCH_ENGINE_SYNC_INTERVAL = config('SEARCH_ENGINE_SYNC_INTERVAL', default=5, cast=float)
+
+# Typeahead suggestions (/api/products/suggest/)
+SUGGEST_LIMIT = config('SUGGEST_LIMIT', default=10, cast=int)
+SUGGEST_MAX_LIMIT = config('SUGGEST_MAX_LIMIT', default=50, cast=int)
+# Top lists of prefixes matching at least this many index keys are memoized
+SUGGEST_MEMOIZE_MIN_KEYS = config('SUGGEST_MEMOIZE_MIN_KEYS', default=1000, cast=int)
+# How often (seconds) the suggestion index checks for writes made by other processes
+SUGGEST_SYNC_INTERVAL = config('SUGGEST_SYNC_INTERVAL', default=30, cast=float)
+
+# Async search and suggest views for ASGI deployments (products.async_views):
+# at most SEARCH_POOL_SIZE requests per process query the database at once,
+# each pool thread keeping one connection
+SEARCH_ASYNC_VIEWS = config('SEARCH_ASYNC_VIEWS', default=False, cast=bool)
+SEARCH_POOL_SIZE = config('SEARCH_POOL_SIZE', default=8, cast=int)
+# Seconds a request waits for a free pool thread before a 503
+SEARCH_POOL_TIMEOUT = config('SEARCH_POOL_TIMEOUT', default=2.0, cast=float)
+# statement_timeout of pool connections in milliseconds (0 = no limit); cancelled searches get a 504
+SEARCH_STATEMENT_TIMEOUT_MS = config('SEARCH_STATEMENT_TIMEOUT_MS', default=5000, cast=int)
+
+# Load-aware search degradation (products.degradation): searches run at the
+# `full`, `full_text` or `prefix` tier, each under its statement_timeout
+# deadline in milliseconds, falling to the next tier when it is missed.
+# Searches start below `full` when more than SEARCH_MAX_INFLIGHT run in the
+# process or their average latency exceeds SEARCH_LATENCY_SLO_MS.
+SEARCH_DEGRADATION = config('SEARCH_DEGRADATION', default=True, cast=bool)
+SEARCH_TIER_DEADLINES_MS = {
+    'full': config('SEARCH_DEADLINE_FULL_MS', default=800, cast=int),
+    'full_text': config('SEARCH_DEADLINE_FULL_TEXT_MS', default=400, cast=int),
+    'prefix': config('SEARCH_DEADLINE_PREFIX_MS', default=2000, cast=int),
+}
+SEARCH_MAX_INFLIGHT = config('SEARCH_MAX_INFLIGHT', default=16, cast=int)
+SEARCH_LATENCY_SLO_MS = config('SEARCH_LATENCY_SLO_MS', default=250, cast=float)
+# Seconds degraded result pages stay in the search cache
+SEARCH_DEGRADED_CACHE_TIMEOUT = config('SEARCH_DEGRADED_CACHE_TIMEOUT', default=10, cast=int)
+
+# Request instrumentation (products.metrics): Server-Timing headers,
+# latency histograms at /api/metrics/ and the slow search log
+SERVER_TIMING = config('SERVER_TIMING', default=True, cast=bool)
+METRICS_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SLOW_SEARCH_THRESHOLD_MS = config('SLOW_SEARCH_THRESHOLD_MS', default=500, cast=float)
+# Share of slow searches logged with an EXPLAIN (ANALYZE, BUFFERS) plan of the ranking query
+SLOW_SEARCH_EXPLAIN_SAMPLE_RATE = config('SLOW_SEARCH_EXPLAIN_SAMPLE_RATE', default=0.0, cast=float)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'products.slow_search': {'handlers': ['console'], 'level': 'WARNING', 'propagate': False},
+    },
+}
@@ -9,8 +9,17 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'product_search_api.settings')
 
 application = get_wsgi_application()
+
+# Load the in-memory indexes before serving traffic, see SEARCH_WARM_UP
+if settings.SEARCH_WARM_UP:
+    from products.services import ProductSearchService
+    from products.suggest import get_suggestion_index
+
+    ProductSearchService.warm_up()
+    get_suggestion_index()
@@ -1,5 +1,14 @@
+from django import forms
 from django.contrib import admin
-from .models import Category, Brand, NutritionFact, Product
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.db.models import Q
+
+from .arabic import normalize_arabic
+from .models import Category, Brand, NutritionFact, Product, SearchDocument
+from .pagination import EstimatedCountPaginator
+from .query import fuzzy_text, parse_search_query
+from .signals import bump_search_generation
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -15,12 +24,69 @@ class BrandAdmin(admin.ModelAdmin):
 class NutritionFactAdmin(admin.ModelAdmin):
     list_display = ('calories', 'protein', 'carbohydrates', 'fat', 'sugar', 'sodium')
 
+
+class AutocompleteFilter(admin.SimpleListFilter):
+    """
+    List filter choosing a related object with an autocomplete widget
+    (searching the related model's admin) instead of listing every object
+    """
+    template = 'admin/products/autocomplete_filter.html'
+    field_name = None
+
+    def lookups(self, request, model_admin):
+        self.field = model_admin.model._meta.get_field(self.field_name)
+        self.admin_site = model_admin.admin_site
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is None:
+            return queryset
+        if not value.isdigit():
+            raise IncorrectLookupParameters(f'Invalid {self.parameter_name}')
+        return queryset.filter(**{self.field.attname: value})
+
+    def choices(self, changelist):
+        widget = AutocompleteSelect(self.field, self.admin_site, attrs={
+            'class': 'autocomplete-filter',
+            'data-filter-parameter': self.parameter_name,
+        })
+        field = forms.ModelChoiceField(self.field.related_model.objects.all(), required=False, widget=widget)
+        yield {'widget': field.widget.render(self.parameter_name, self.value(), {'id': f'filter_{self.parameter_name}'})}
+
+
+class BrandFilter(AutocompleteFilter):
+    title = 'brand'
+    parameter_name = 'brand'
+    field_name = 'brand'
+
+
+class CategoryFilter(AutocompleteFilter):
+    title = 'category'
+    parameter_name = 'category'
+    field_name = 'category'
+
+
 # Remove the NutritionFactInline class and use a different approach
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'sku', 'price', 'brand', 'category', 'is_active')
-    list_filter = ('is_active', 'brand', 'category')
+    list_filter = ('is_active', BrandFilter, CategoryFilter)
+    list_select_related = ('brand', 'category')
+    # Newest first walks the primary key index; sorting every product by name does not
+    ordering = ('-id',)
     search_fields = ('name', 'name_ar', 'description', 'sku')
+    search_help_text = 'Exact SKU, or words of the name or description (fuzzy on names).'
+    # Counting millions of rows on every page view is what makes big changelists slow
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    autocomplete_fields = ('brand', 'category')
+    raw_id_fields = ('nutrition_facts',)
+    actions = ('activate', 'deactivate')
     readonly_fields = ('created_at', 'updated_at')
     fieldsets = (
         (None, {
@@ -36,3 +102,58 @@ class ProductAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at')
         }),
     )
+
+    @property
+    def media(self):
+        brand = self.model._meta.get_field('brand')
+        return (
+            super().media +
+            AutocompleteSelect(brand, self.admin_site).media +
+            forms.Media(js=['products/autocomplete_filter.js'])
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search through the search document indexes (search_vector GIN and
+        name trigram indexes) and the unique SKU index, instead of the
+        default icontains on every column, which scans the whole table.
+        Documents of inactive products are searched too.
+        """
+        search_term = normalize_arabic(search_term.strip())
+        if not search_term:
+            return queryset, False
+        # SearchDocument has no SKU index; resolve the SKU on products_product first
+        skus = Product.objects.using(queryset.db).filter(sku=search_term).values_list('id', flat=True)
+        condition = Q(id__in=list(skus))
+        search_query = parse_search_query(search_term)
+        if search_query is not None:
+            condition |= Q(search_vector=search_query)
+        fuzzy_string = fuzzy_text(search_term)
+        if fuzzy_string:
+            condition |= (
+                Q(name__trigram_word_similar=fuzzy_string) |
+                Q(name_ar_normalized__trigram_word_similar=fuzzy_string)
+            )
+        documents = SearchDocument.objects.using(queryset.db).filter(condition)
+        return queryset.filter(id__in=documents.values('id')), False
+
+    @admin.action(description='Activate selected products', permissions=['change'])
+    def activate(self, request, queryset):
+        self._set_active(request, queryset, True)
+
+    @admin.action(description='Deactivate selected products', permissions=['change'])
+    def deactivate(self, request, queryset):
+        self._set_active(request, queryset, False)
+
+    def _set_active(self, request, queryset, is_active):
+        """
+        One UPDATE for the whole selection; the triggers on products_product
+        update the search documents and updated_at in the same statement
+        (the spelling dictionary follows on its next refresh). Bulk updates
+        send no signals, so the search cache generation is bumped here.
+        """
+        updated = queryset.exclude(is_active=is_active).update(is_active=is_active)
+        if updated:
+            bump_search_generation(sender=Product)
+        state = 'activated' if is_active else 'deactivated'
+        self.message_user(request, f'{updated} product(s) {state}.')
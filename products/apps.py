@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        from .metrics import install_sql_counter
+        from .models import Brand, Category, NutritionFact, Product
+        from .signals import bump_search_generation, set_trigram_thresholds
+        connection_created.connect(set_trigram_thresholds, dispatch_uid='products_trigram_thresholds')
+        connection_created.connect(install_sql_counter, dispatch_uid='products_sql_counter')
+        # Nutrition facts are part of the product detail response (see products.conditional)
+        for model in (Product, Brand, Category, NutritionFact):
+            post_save.connect(bump_search_generation, sender=model,
+                              dispatch_uid=f'products_search_generation_save_{model.__name__}')
+            post_delete.connect(bump_search_generation, sender=model,
+                                dispatch_uid=f'products_search_generation_delete_{model.__name__}')
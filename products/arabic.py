@@ -0,0 +1,31 @@
+"""
+Normalization of Arabic spelling variants.
+
+The same word is written with or without hamza on its alef (أ إ آ ٱ / ا),
+with taa marbuta or haa (ة / ه), alef maqsura or yaa (ى / ي), a hamza
+seat or the bare letter (ؤ / و, ئ / ي), optional tashkeel and tatweel,
+and Arabic-Indic or Western digits. Catalog text is normalized at write
+time by the products_normalize_arabic() SQL function (migration 0012):
+inside search_vector and in the indexed SearchDocument.name_ar_normalized
+column, written by a trigger. normalize_arabic() applies the same mapping to queries, so both
+sides meet in the indexes. Text without Arabic characters is unchanged.
+"""
+# Letters and their normalized form; keep in sync with migration 0012
+VARIANTS = {
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+    'ؤ': 'و',
+    'ئ': 'ي',
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},  # Extended (Persian) digits
+}
+# Tatweel, tashkeel (fathatan to sukun and the rarer marks up to U+065F) and superscript alef
+REMOVED = 'ـ' + ''.join(chr(code) for code in range(0x064B, 0x0660)) + 'ٰ'
+
+_TABLE = str.maketrans({**VARIANTS, **dict.fromkeys(REMOVED)})
+
+
+def normalize_arabic(text):
+    """`text` with Arabic spelling variants folded, as products_normalize_arabic() does"""
+    return text.translate(_TABLE) if text else text
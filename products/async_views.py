@@ -0,0 +1,176 @@
+"""
+Async search and suggest endpoints for ASGI deployments (SEARCH_ASYNC_VIEWS).
+
+The ORM and psycopg2 are synchronous, so a query always needs a thread;
+Django's async ORM methods are thread wrappers too. Instead of a thread
+and a connection per in-flight request, these views keep waiting requests
+on the event loop and admit at most SEARCH_POOL_SIZE of them at a time
+into a dedicated thread pool. Pool threads keep their database connection
+between requests (CONN_MAX_AGE), so the pool is also a bounded connection
+pool. A request that finds no free slot within SEARCH_POOL_TIMEOUT seconds
+gets a 503, and statements on pool connections, to the primary or to a
+read replica, are cancelled after SEARCH_STATEMENT_TIMEOUT_MS (504). The
+pool threads run the regular ProductViewSet actions, so responses are the
+same as the sync views'.
+"""
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from .degradation import is_query_canceled
+from .metrics import timed
+from .views import ProductViewSet
+
+
+class PoolTimeout(Exception):
+    """No pool thread became free within SEARCH_POOL_TIMEOUT"""
+
+
+_thread = threading.local()
+
+
+def set_statement_timeout(sender, connection, **kwargs):
+    """
+    connection_created receiver: statement_timeout for every connection a
+    pool thread opens, to the primary or to a read replica
+    """
+    statement_timeout = getattr(_thread, 'statement_timeout', None)
+    if statement_timeout and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET statement_timeout = %s', [statement_timeout])
+
+
+class SearchPool:
+    """A bounded set of threads, each holding one database connection (per database)"""
+
+    def __init__(self, size, timeout, statement_timeout):
+        self.size = size
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix='search-pool', initializer=self._init_thread
+        )
+        connection_created.connect(set_statement_timeout, dispatch_uid='products_pool_statement_timeout')
+        # asyncio semaphores belong to one event loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _init_thread(self):
+        _thread.statement_timeout = self.statement_timeout
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.size)
+        return semaphore
+
+    async def run(self, func, *args):
+        """Run `func(*args)` on a pool thread once a slot is free, or raise PoolTimeout"""
+        semaphore = self._semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout
+        loop = asyncio.get_running_loop()
+
+        def release(future):
+            # A cancelled request's search keeps running; its slot is freed when the thread is
+            try:
+                loop.call_soon_threadsafe(semaphore.release)
+            except RuntimeError:  # the loop is already closed
+                pass
+
+        # The copied context carries the request's metrics into the thread
+        future = self.executor.submit(contextvars.copy_context().run, self._call, func, *args)
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def _call(self, func, *args):
+        # What request_started/request_finished do for the request thread
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    def close(self):
+        """Close the connection of every pool thread and stop the threads"""
+        barrier = threading.Barrier(self.size)
+
+        def close_connection():
+            # Waiting for each other puts one call on every thread
+            barrier.wait()
+            connections.close_all()
+
+        for future in [self.executor.submit(close_connection) for _ in range(self.size)]:
+            future.result()
+        self.executor.shutdown()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_search_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SearchPool(
+                    settings.SEARCH_POOL_SIZE,
+                    settings.SEARCH_POOL_TIMEOUT,
+                    settings.SEARCH_STATEMENT_TIMEOUT_MS,
+                )
+    return _pool
+
+
+def _render(view, request):
+    response = view(request)
+    # Render on the pool thread rather than on the event loop
+    with timed('render'):
+        response.render()
+    return response
+
+
+async def _respond(view, request):
+    try:
+        return await get_search_pool().run(_render, view, request)
+    except PoolTimeout:
+        response = JsonResponse({'detail': 'Search is busy, please retry.'}, status=503)
+        response['Retry-After'] = '1'
+        return response
+    except OperationalError as exc:
+        if is_query_canceled(exc):
+            return JsonResponse({'detail': 'Search timed out.'}, status=504)
+        raise
+
+
+_search_view = ProductViewSet.as_view({'get': 'search'})
+_suggest_view = ProductViewSet.as_view({'get': 'suggest'})
+_search_batch_view = ProductViewSet.as_view({'post': 'search_batch'})
+
+
+@csrf_exempt
+async def search(request):
+    """Async ProductViewSet.search"""
+    return await _respond(_search_view, request)
+
+
+@csrf_exempt
+async def suggest(request):
+    """Async ProductViewSet.suggest"""
+    return await _respond(_suggest_view, request)
+
+
+@csrf_exempt
+async def search_batch(request):
+    """Async ProductViewSet.search_batch"""
+    return await _respond(_search_batch_view, request)
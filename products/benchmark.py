@@ -0,0 +1,195 @@
+"""
+Synthetic catalogs and latency statistics for the search benchmark.
+
+`generate_products` yields rows in the format `import_products` reads, so
+`generate_catalog` can write any catalog size to a file and load it through
+the COPY path. The same seed and size always give the same catalog, which
+is what makes benchmark runs on different machines or commits comparable.
+"""
+import random
+
+# category -> (Arabic name, price range, nutrition ranges per 100g or None,
+#              items as (English, Arabic), flavors as (English, Arabic))
+CATEGORIES = {
+    'Dairy': ('ألبان', (1.5, 25), {
+        'calories': (40, 400), 'protein': (2, 25), 'carbohydrates': (0, 15),
+        'fat': (0, 35), 'sugar': (0, 15), 'sodium': (30, 900),
+    }, [
+        ('Milk', 'حليب'), ('Yogurt', 'زبادي'), ('Laban', 'لبن'), ('Cheese', 'جبنة'),
+        ('Labneh', 'لبنة'), ('Butter', 'زبدة'), ('Cream', 'قشطة'), ('Feta', 'جبنة فيتا'),
+    ], [
+        ('Plain', 'سادة'), ('Strawberry', 'فراولة'), ('Vanilla', 'فانيليا'), ('Mango', 'مانجو'),
+    ]),
+    'Beverages': ('مشروبات', (0.5, 15), {
+        'calories': (0, 60), 'protein': (0, 2), 'carbohydrates': (0, 15),
+        'fat': (0, 1), 'sugar': (0, 14), 'sodium': (0, 60),
+    }, [
+        ('Juice', 'عصير'), ('Water', 'مياه'), ('Cola', 'كولا'), ('Iced Tea', 'شاي مثلج'),
+        ('Nectar', 'رحيق'), ('Sparkling Water', 'مياه غازية'), ('Energy Drink', 'مشروب طاقة'),
+    ], [
+        ('Orange', 'برتقال'), ('Apple', 'تفاح'), ('Lemon', 'ليمون'), ('Guava', 'جوافة'),
+        ('Mango', 'مانجو'), ('Pomegranate', 'رمان'),
+    ]),
+    'Snacks': ('وجبات خفيفة', (0.5, 20), {
+        'calories': (350, 560), 'protein': (2, 12), 'carbohydrates': (40, 75),
+        'fat': (10, 35), 'sugar': (0, 45), 'sodium': (100, 1200),
+    }, [
+        ('Chips', 'شيبس'), ('Chocolate', 'شوكولاتة'), ('Biscuits', 'بسكويت'), ('Wafer', 'ويفر'),
+        ('Popcorn', 'فشار'), ('Crackers', 'مقرمشات'), ('Nuts', 'مكسرات'),
+    ], [
+        ('Salted', 'مملح'), ('Cheese', 'بالجبنة'), ('Hazelnut', 'بالبندق'), ('Chili', 'حار'),
+        ('Caramel', 'كراميل'),
+    ]),
+    'Bakery': ('مخبوزات', (0.5, 12), {
+        'calories': (230, 450), 'protein': (6, 12), 'carbohydrates': (40, 60),
+        'fat': (1, 20), 'sugar': (1, 25), 'sodium': (200, 600),
+    }, [
+        ('Bread', 'خبز'), ('Croissant', 'كرواسون'), ('Toast', 'توست'), ('Pita', 'خبز عربي'),
+        ('Cake', 'كعك'), ('Muffin', 'مافن'),
+    ], [
+        ('White', 'أبيض'), ('Brown', 'أسمر'), ('Whole Wheat', 'قمح كامل'), ('Date', 'بالتمر'),
+        ('Zaatar', 'بالزعتر'),
+    ]),
+    'Frozen Food': ('أغذية مجمدة', (2, 40), {
+        'calories': (60, 320), 'protein': (2, 20), 'carbohydrates': (3, 35),
+        'fat': (0, 20), 'sugar': (0, 10), 'sodium': (50, 900),
+    }, [
+        ('Vegetables', 'خضروات'), ('Chicken Nuggets', 'ناجتس دجاج'), ('Pizza', 'بيتزا'),
+        ('French Fries', 'بطاطس مقلية'), ('Samosa', 'سمبوسة'), ('Ice Cream', 'آيس كريم'),
+    ], [
+        ('Mixed', 'مشكلة'), ('Spicy', 'حارة'), ('Classic', 'كلاسيك'), ('Chocolate', 'شوكولاتة'),
+    ]),
+    'Pantry': ('مواد غذائية', (1, 60), {
+        'calories': (0, 900), 'protein': (0, 25), 'carbohydrates': (0, 80),
+        'fat': (0, 100), 'sugar': (0, 70), 'sodium': (0, 2000),
+    }, [
+        ('Rice', 'أرز'), ('Pasta', 'مكرونة'), ('Olive Oil', 'زيت زيتون'), ('Honey', 'عسل'),
+        ('Tahini', 'طحينة'), ('Lentils', 'عدس'), ('Dates', 'تمر'), ('Tomato Paste', 'معجون طماطم'),
+    ], [
+        ('Basmati', 'بسمتي'), ('Organic', 'عضوي'), ('Extra Virgin', 'بكر ممتاز'), ('Red', 'أحمر'),
+        ('Sukkari', 'سكري'),
+    ]),
+    'Household': ('منظفات', (2, 50), None, [
+        ('Detergent', 'منظف'), ('Dish Soap', 'سائل جلي'), ('Bleach', 'مبيض'),
+        ('Tissues', 'مناديل'), ('Trash Bags', 'أكياس قمامة'),
+    ], [
+        ('Lavender', 'لافندر'), ('Lemon', 'ليمون'), ('Unscented', 'بدون رائحة'), ('Ultra', 'ألترا'),
+    ]),
+    'Personal Care': ('عناية شخصية', (3, 80), None, [
+        ('Shampoo', 'شامبو'), ('Toothpaste', 'معجون أسنان'), ('Soap', 'صابون'),
+        ('Deodorant', 'مزيل عرق'), ('Body Lotion', 'لوشن للجسم'),
+    ], [
+        ('Herbal', 'بالأعشاب'), ('Mint', 'نعناع'), ('Aloe Vera', 'صبار'), ('Sensitive', 'للبشرة الحساسة'),
+    ]),
+}
+
+ADJECTIVES = [
+    ('Fresh', 'طازج'), ('Light', 'لايت'), ('Premium', 'فاخر'), ('Natural', 'طبيعي'),
+    ('Classic', 'كلاسيك'), ('Family Pack', 'عبوة عائلية'), ('Low Fat', 'قليل الدسم'), ('Original', 'أصلي'),
+]
+
+SIZES = [('200g', '٢٠٠ جم'), ('500g', '٥٠٠ جم'), ('1kg', '١ كجم'), ('250ml', '٢٥٠ مل'), ('1L', '١ لتر'), ('6 Pack', '٦ حبات')]
+
+# Well known names first, so small catalogs still contain them
+BRANDS = [
+    ('Almarai', 'المراعي'), ('Nadec', 'نادك'), ('Al Safi', 'الصافي'), ('Puck', 'بوك'),
+    ('Lurpak', 'لورباك'), ('Rani', 'راني'), ('Lays', 'ليز'), ('Galaxy', 'جالكسي'),
+    ('Americana', 'أمريكانا'), ('Sunbulah', 'السنبلة'), ('Tiffany', 'تيفاني'), ('Abu Kass', 'أبو كاس'),
+    ('Afia', 'عافية'), ('Persil', 'برسيل'), ('Fine', 'فاين'), ('Dettol', 'ديتول'),
+]
+# Further brands are made of two syllables, e.g. "Nova Gold" / "نوفا جولد"
+BRAND_SYLLABLES = [
+    ('Nova', 'نوفا'), ('Gold', 'جولد'), ('Sun', 'صن'), ('Oasis', 'واحة'), ('Royal', 'رويال'),
+    ('Desert', 'الصحراء'), ('Star', 'ستار'), ('Green', 'جرين'), ('Pearl', 'لؤلؤة'), ('Crown', 'كراون'),
+    ('Falcon', 'الصقر'), ('Palm', 'النخلة'), ('Blue', 'بلو'), ('Delta', 'دلتا'), ('Sky', 'سكاي'),
+    ('Noor', 'نور'), ('Baraka', 'بركة'), ('Zahra', 'زهرة'), ('Prime', 'برايم'), ('Wadi', 'وادي'),
+]
+
+INACTIVE_RATIO = 0.03
+NUTRITION_RATIO = 0.8
+
+
+def brand_count(products):
+    """Catalogs get one brand per 1000 products, at least the well known ones"""
+    return min(max(len(BRANDS), products // 1000), len(BRANDS) + len(BRAND_SYLLABLES) ** 2)
+
+
+def make_brands(count):
+    """Return `count` (English, Arabic) brand names, the same for every run"""
+    brands = list(BRANDS[:count])
+    for first in BRAND_SYLLABLES:
+        for second in BRAND_SYLLABLES:
+            if len(brands) >= count:
+                return brands
+            if first != second:
+                brands.append((f'{first[0]} {second[0]}', f'{first[1]} {second[1]}'))
+    return brands
+
+
+def generate_products(count, seed=42):
+    """Yield `count` product rows in the import_products JSONL format"""
+    rng = random.Random(seed)
+    brands = make_brands(brand_count(count))
+    categories = list(CATEGORIES.items())
+    # Every brand sells in two or three categories
+    brand_categories = [rng.sample(categories, rng.randint(2, 3)) for _ in brands]
+
+    for number in range(1, count + 1):
+        brand_index = min(int(rng.paretovariate(1.2)) - 1, len(brands) - 1) if rng.random() < 0.5 \
+            else rng.randrange(len(brands))
+        brand, brand_ar = brands[brand_index]
+        category, (category_ar, (low, high), nutrition, items, flavors) = rng.choice(brand_categories[brand_index])
+        item, item_ar = rng.choice(items)
+        flavor, flavor_ar = rng.choice(flavors)
+        adjective, adjective_ar = rng.choice(ADJECTIVES)
+        size, size_ar = rng.choice(SIZES)
+
+        row = {
+            'sku': f'BENCH-{seed}-{number:07d}',
+            'name': f'{brand} {adjective} {flavor} {item} {size}',
+            'name_ar': f'{item_ar} {flavor_ar} {adjective_ar} {brand_ar} {size_ar}',
+            'description': f'{adjective} {flavor.lower()} {item.lower()} from {brand}, '
+                           f'part of our {category.lower()} range.',
+            'description_ar': f'{item_ar} {flavor_ar} من {brand_ar} ضمن تشكيلة {category_ar}.',
+            'price': f'{rng.uniform(low, high):.2f}',
+            'brand': brand,
+            'category': category,
+            'is_active': rng.random() >= INACTIVE_RATIO,
+        }
+        if nutrition and rng.random() < NUTRITION_RATIO:
+            row['nutrition_facts'] = {
+                field: round(rng.uniform(*bounds), 1) for field, bounds in nutrition.items()
+            }
+        yield row
+
+
+def percentile(values, fraction):
+    """Percentile of sorted `values` with linear interpolation between ranks"""
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(samples, elapsed=None):
+    """
+    Latency statistics in milliseconds for a list of (seconds, queries, ok)
+    samples; throughput needs the wall clock time of the run.
+    """
+    latencies = sorted(seconds * 1000 for seconds, _, ok in samples if ok)
+    queries = [count for _, count, ok in samples if ok]
+    summary = {
+        'requests': len(samples),
+        'errors': len(samples) - len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1] if latencies else None,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+    }
+    if elapsed is not None:
+        summary['throughput_rps'] = len(samples) / elapsed if elapsed else None
+    return summary
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Max
+
+from .models import Product
+
+GENERATION_KEY = 'search:generation'
+HITS_KEY = 'search:stats:hits'
+MISSES_KEY = 'search:stats:misses'
+MODIFIED_KEY = 'catalog:modified'
+TERMS_KEY = 'search:terms'
+
+
+def get_search_cache():
+    return caches[settings.SEARCH_CACHE_ALIAS]
+
+
+def get_generation():
+    """Return the current catalog generation, creating it if the backend lost it"""
+    cache = get_search_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so an evicted counter never repeats an old generation
+        cache.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """Invalidate every cached search result by moving to a new generation"""
+    cache = get_search_cache()
+    try:
+        generation = cache.incr(GENERATION_KEY)
+    except ValueError:
+        get_generation()
+        generation = cache.incr(GENERATION_KEY)
+    cache.set(f'{MODIFIED_KEY}:{generation}', int(time.time()), timeout=settings.CATALOG_CACHE_TIMEOUT)
+    return generation
+
+
+def bump_terms_version():
+    """Record a spelling dictionary refresh; it also changes search results"""
+    generation = bump_generation()
+    get_search_cache().set(TERMS_KEY, generation, timeout=None)
+    return generation
+
+
+def get_terms_version():
+    """Generation of the last spelling dictionary refresh, None when unknown"""
+    return get_search_cache().get(TERMS_KEY)
+
+
+def get_last_modified(generation):
+    """
+    Unix time of the catalog write that started `generation`, or of the
+    newest Product.updated_at when the cache does not know it.
+    """
+    cache = get_search_cache()
+    key = f'{MODIFIED_KEY}:{generation}'
+    modified = cache.get(key)
+    if modified is None:
+        latest = Product.objects.aggregate(latest=Max('updated_at'))['latest']
+        modified = int(latest.timestamp()) if latest else 0
+        cache.add(key, modified, timeout=settings.CATALOG_CACHE_TIMEOUT)
+    return modified
+
+
+def get_write_age():
+    """Seconds since the last catalog write, None when the cache does not know"""
+    modified = get_search_cache().get(f'{MODIFIED_KEY}:{get_generation()}')
+    return None if modified is None else time.time() - modified
+
+
+def get_or_set_catalog(key, compute):
+    """Cache `compute()` in the search cache until the next catalog write"""
+    cache = get_search_cache()
+    key = f'catalog:response:{get_generation()}:{hashlib.sha1(key.encode()).hexdigest()}'
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout=settings.CATALOG_CACHE_TIMEOUT)
+    return value
+
+
+class SearchResultCache:
+    """
+    Cache of ranked product id lists, one entry per search page.
+
+    Keys include the catalog generation, so a write to Product, Brand or
+    Category (see signals.bump_search_generation) makes every older entry
+    unreachable without having to find and delete it. Only counters and
+    atomic add/incr are used, so this works on shared backends such as
+    Redis or Memcached as well as the local memory cache.
+    """
+
+    def __init__(self):
+        self.cache = get_search_cache()
+        self.timeout = settings.SEARCH_CACHE_TIMEOUT
+        self.lock_timeout = settings.SEARCH_CACHE_LOCK_TIMEOUT
+
+    @staticmethod
+    def normalize_query(query_string):
+        return ' '.join((query_string or '').lower().split())
+
+    def make_key(self, query_string, filters, page_params):
+        digest = self._digest(self._key_parts(query_string, filters, page_params))
+        return f'search:result:{get_generation()}:{digest}'
+
+    def make_batch_key(self, queries):
+        """Key of a whole batch search, `queries` being (query_string, filters, limit) tuples"""
+        digest = self._digest([
+            self._key_parts(query_string, filters, {'limit': limit}) for query_string, filters, limit in queries
+        ])
+        return f'search:batch:{get_generation()}:{digest}'
+
+    def _key_parts(self, query_string, filters, page_params):
+        return {
+            'q': self.normalize_query(query_string),
+            'filters': {name: str(value) for name, value in filters.items() if value not in (None, '')},
+            'page': {name: str(value) for name, value in page_params.items() if value not in (None, '')},
+        }
+
+    @staticmethod
+    def _digest(parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get_or_compute(self, key, compute, timeout=None):
+        """
+        Return `(value, hit)`. On a miss only one caller computes the value;
+        concurrent callers wait for it for up to SEARCH_CACHE_LOCK_TIMEOUT
+        seconds instead of all running the same search at once. `timeout`,
+        a function of the value returning seconds or None for the default,
+        can shorten how long it is kept.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            self._count(HITS_KEY)
+            return value, True
+
+        self._count(MISSES_KEY)
+        lock_key = f'{key}:lock'
+        if not self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self.cache.get(key)
+                if value is not None:
+                    return value, True
+            # The lock holder is too slow or died, compute it ourselves
+        try:
+            value = compute()
+            seconds = timeout(value) if timeout is not None else None
+            self.cache.set(key, value, timeout=self.timeout if seconds is None else min(self.timeout, seconds))
+        finally:
+            self.cache.delete(lock_key)
+        return value, False
+
+    def stats(self):
+        hits = self.cache.get(HITS_KEY, 0)
+        misses = self.cache.get(MISSES_KEY, 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / total, 4) if total else 0.0,
+        }
+
+    def _count(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            if not self.cache.add(key, 1, timeout=None):
+                self.cache.incr(key)
@@ -0,0 +1,137 @@
+"""
+Incremental change feed of the catalog (/api/products/changes/).
+
+Partner systems mirror the catalog by following the feed instead of
+re-reading every product. Created, updated and deactivated products are
+`upsert` changes with the product shaped like the export (see
+products.export); deleted products are `delete` changes from their
+tombstones (ProductTombstone). Changes are in (changed_at, id) order:
+products by (updated_at, id) through the product_updated_id index,
+tombstones by (deleted_at, id), merged. Each page returns an opaque cursor
+of its last change to resume from, so a sync only reads what changed since.
+
+updated_at and deleted_at are set by triggers at the time of the write
+(migration 0015), but a write only becomes visible when its transaction
+commits. A change is therefore only served once it is older than every
+transaction still writing on the primary (and CHANGES_SETTLE_SECONDS), so
+a later commit can never land behind a cursor a client already holds.
+The feed reads the primary: replicas do not see those transactions.
+
+Brand, category and nutrition fact edits are changes of every product
+embedding them: triggers on those tables touch the products' updated_at
+(migration 0016).
+"""
+import base64
+import heapq
+import json
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+
+from .export import ProductExporter
+from .models import Product, ProductTombstone
+
+# Changes before this time are committed, or will never be: the start of the
+# oldest transaction that is writing, at the latest now
+HORIZON_SQL = """
+SELECT least(
+    statement_timestamp(),
+    (SELECT min(xact_start) FROM pg_stat_activity
+     WHERE datname = current_database() AND backend_xid IS NOT NULL AND pid <> pg_backend_pid())
+) - make_interval(secs => %s)
+"""
+
+
+def horizon(using=DEFAULT_DB_ALIAS, settle_seconds=0):
+    """Time before which every change is committed, see HORIZON_SQL"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(HORIZON_SQL, [settle_seconds])
+        return cursor.fetchone()[0]
+
+
+def changed_product_ids(since, using=DEFAULT_DB_ALIAS):
+    """
+    Ids of the products updated or deleted at or after `since`. In-process
+    indexes catch up with other processes' writes from the horizon() read
+    before their previous catch-up.
+    """
+    updated = Product.objects.using(using).filter(updated_at__gte=since).values_list('id', flat=True)
+    deleted = ProductTombstone.objects.using(using).filter(deleted_at__gte=since).values_list('id', flat=True)
+    return {*updated, *deleted}
+
+
+def encode_cursor(changed_at, pk):
+    payload = json.dumps([changed_at.isoformat(), pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """(changed_at, id) of a cursor; ValueError when the token is not one"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        changed_at, pk = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        changed_at = datetime.fromisoformat(changed_at)
+        if changed_at.tzinfo is None or not isinstance(pk, int):
+            raise ValueError
+    except (TypeError, ValueError, UnicodeDecodeError) as exc:
+        raise ValueError('Invalid cursor') from exc
+    return changed_at, pk
+
+
+def _after(field, changed_at, pk):
+    """(field, id) > (changed_at, pk), with a bound on the leading column for the index scan"""
+    return Q(**{f'{field}__gte': changed_at}) & (
+        Q(**{f'{field}__gt': changed_at}) | Q(**{field: changed_at, 'id__gt': pk})
+    )
+
+
+class ChangeFeed:
+    """Reads pages of the change feed from the primary"""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.exporter = ProductExporter()
+
+    def horizon(self):
+        return horizon(self.using, settings.CHANGES_SETTLE_SECONDS)
+
+    def read(self, since=None, limit=None):
+        """
+        Up to `limit` changes after the `since` cursor, as (changes, cursor,
+        has_more). The cursor is that of the last change, or `since` when
+        there is none yet. Raises ValueError for an invalid cursor.
+        """
+        limit = limit or settings.CHANGES_PAGE_SIZE
+        position = decode_cursor(since) if since else None
+        horizon = self.horizon()
+        products = Product.objects.using(self.using).filter(updated_at__lt=horizon)
+        tombstones = ProductTombstone.objects.using(self.using).filter(deleted_at__lt=horizon)
+        if position is not None:
+            products = products.filter(_after('updated_at', *position))
+            tombstones = tombstones.filter(_after('deleted_at', *position))
+
+        # Each source reads at most one change more than the page, to tell whether there is more
+        updated = products.order_by('updated_at', 'id').values_list('updated_at', *self.exporter.columns)
+        deleted = tombstones.order_by('deleted_at', 'id').values_list('deleted_at', 'id', 'sku')
+        merged = heapq.merge(
+            ((row[0], row[1 + self.exporter.id_index], 'upsert', row[1:]) for row in updated[:limit + 1]),
+            ((deleted_at, pk, 'delete', sku) for deleted_at, pk, sku in deleted[:limit + 1]),
+            key=lambda change: change[:2],
+        )
+        page = list(islice(merged, limit + 1))
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        changes = []
+        for changed_at, pk, op, data in page:
+            change = {'op': op, 'id': pk, 'changed_at': changed_at}
+            if op == 'upsert':
+                change['product'] = self.exporter.to_dict(data)
+            else:
+                change['sku'] = data
+            changes.append(change)
+        cursor = encode_cursor(*page[-1][:2]) if page else since
+        return changes, cursor, has_more
@@ -0,0 +1,76 @@
+"""
+Conditional GET and HTTP caching headers for the catalog endpoints.
+
+Every catalog write moves the catalog to a new generation (see
+cache.bump_generation), so the generation identifies the state a response
+was built from. Responses carry it as their ETag, with the time of the
+write as Last-Modified. A request whose If-None-Match (or If-Modified-Since)
+still matches gets a 304 before any query or serialization runs; checking
+costs one or two cache reads. Cache-Control lets browsers, reverse proxies
+and CDNs reuse responses for CATALOG_CACHE_MAX_AGE seconds and then
+revalidate them with these validators.
+
+Degraded search results (X-Search-Tier other than full, see
+products.degradation) get no validators: the generation does not change
+when the load passes, so revalidating them would keep them until the next
+catalog write. They may be reused for SEARCH_DEGRADED_CACHE_TIMEOUT
+seconds at most, like the server-side cache entry. Views returning them
+only answer If-None-Match with a 304, since only full results carry an
+ETag; If-Modified-Since alone may come from a degraded copy.
+"""
+import functools
+import hashlib
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .cache import get_generation, get_last_modified
+from .degradation import TIER_FULL
+
+
+def catalog_etag(request, generation):
+    """ETag of a response for `generation`, per negotiated media type (JSON, browsable API)"""
+    media_type = getattr(request, 'accepted_media_type', '') or ''
+    digest = hashlib.sha1(media_type.encode()).hexdigest()[:8]
+    return quote_etag(f'{generation}-{digest}')
+
+
+def conditional(view_method=None, *, degradable=False):
+    """
+    Decorate a GET action of a viewset with catalog ETag/Last-Modified
+    validation and Cache-Control/Vary headers. With `degradable`, the
+    action may return degraded search results.
+    """
+    if view_method is None:
+        return functools.partial(conditional, degradable=degradable)
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        # Read before the view runs, so the response is at least as new as its ETag
+        generation = get_generation()
+        etag = catalog_etag(request, generation)
+        last_modified = get_last_modified(generation)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=None if degradable else last_modified,
+        )
+        if response is None:
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if response.get('X-Search-Tier', TIER_FULL) != TIER_FULL:
+                max_age = min(settings.CATALOG_CACHE_MAX_AGE, settings.SEARCH_DEGRADED_CACHE_TIMEOUT)
+                patch_cache_control(response, public=True, max_age=max_age)
+                patch_vary_headers(response, ['Accept'])
+                return response
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        elif response.status_code == 304:
+            response['ETag'] = etag
+        else:
+            return response
+        patch_cache_control(response, public=True, max_age=settings.CATALOG_CACHE_MAX_AGE)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    return wrapper
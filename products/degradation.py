@@ -0,0 +1,130 @@
+"""
+Load-aware degradation of search (ProductSearchService.search_tiered).
+
+A search runs at one of three tiers, from the most to the least expensive:
+
+- `full`: full-text plus the trigram sources and relevance formula;
+- `full_text`: only the full-text source, ranked by SearchRank alone;
+- `prefix`: full-text (prefix) matches ordered by name, without ranking.
+
+Each tier runs under a Postgres statement_timeout deadline
+(SEARCH_TIER_DEADLINES_MS). A search that misses its deadline is retried
+at the next tier. Searches also start below `full` when this process is
+overloaded: more than SEARCH_MAX_INFLIGHT searches running, or the moving
+average of search latency above SEARCH_LATENCY_SLO_MS; twice either limit
+starts them at `prefix`. Results of degraded searches are cached for
+SEARCH_DEGRADED_CACHE_TIMEOUT seconds only, so repeated queries are
+answered from the cache under load and at full quality soon after.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+
+TIER_FULL = 'full'
+TIER_FULL_TEXT = 'full_text'
+TIER_PREFIX = 'prefix'
+TIERS = (TIER_FULL, TIER_FULL_TEXT, TIER_PREFIX)
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+# Weight of the latest search in the latency moving average
+LATENCY_SMOOTHING = 0.2
+
+
+def is_query_canceled(exc):
+    return getattr(exc.__cause__, 'pgcode', None) == QUERY_CANCELED
+
+
+class LoadGovernor:
+    """In-flight searches and latency of this process, choosing the tier searches start at"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.latency_ms = 0.0
+        self.tiers = dict.fromkeys(TIERS, 0)
+        self.deadlines_missed = dict.fromkeys(TIERS, 0)
+
+    def start_tier(self):
+        """Index in TIERS of the first tier to try"""
+        with self.lock:
+            load = max(
+                self.inflight / settings.SEARCH_MAX_INFLIGHT,
+                self.latency_ms / settings.SEARCH_LATENCY_SLO_MS,
+            )
+        if load <= 1:
+            return 0
+        return 1 if load <= 2 else 2
+
+    @contextmanager
+    def track(self):
+        """Count a search as in flight and add its duration to the moving average"""
+        with self.lock:
+            self.inflight += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.inflight -= 1
+                self.latency_ms += LATENCY_SMOOTHING * (elapsed - self.latency_ms)
+
+    def record(self, tier, deadline_missed=False):
+        with self.lock:
+            if deadline_missed:
+                self.deadlines_missed[tier] += 1
+            else:
+                self.tiers[tier] += 1
+
+    def snapshot(self):
+        """Load and tier counters, for /api/metrics/"""
+        with self.lock:
+            return {
+                'inflight': self.inflight,
+                'latency_ms': round(self.latency_ms, 3),
+                'tiers': dict(self.tiers),
+                'deadlines_missed': dict(self.deadlines_missed),
+            }
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_load_governor():
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = LoadGovernor()
+    return _governor
+
+
+@contextmanager
+def deadline(milliseconds, using):
+    """
+    Cancel the block's statements on `using` after `milliseconds` (0: no
+    deadline). SET LOCAL in a transaction of its own (a savepoint inside an
+    atomic block), so a cancelled statement does not break the caller's
+    transaction and the connection's own statement_timeout comes back after.
+    """
+    connection = connections[using]
+    if not milliseconds or connection.vendor != 'postgresql':
+        yield
+        return
+    nested = connection.in_atomic_block
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            if nested:
+                # SET LOCAL outlives a released savepoint, restore it after the block
+                cursor.execute('SHOW statement_timeout')
+                previous = cursor.fetchone()[0]
+            cursor.execute('SET LOCAL statement_timeout = %s', [int(milliseconds)])
+        yield
+        if nested:
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [previous])
@@ -0,0 +1,886 @@
+"""
+In-process search engine for catalogs that fit in RAM.
+
+The engine keeps the active catalog as column arrays and answers the same
+retrieval and ranking logic as `ORMSearchBackend` without touching the
+products table:
+
+- full-text postings (lexeme -> product ordinals + packed tsvector positions)
+  built from the stored `search_vector`, so lexemes, positions and weights are
+  exactly the ones Postgres produced
+- trigram postings for `name` and `name_ar`, and pg_trgm's `similarity` /
+  `word_similarity` ported to Python for the fuzzy sources and relevance
+- the spelling dictionary (SearchTerm) with trigram postings, so queries
+  are corrected like products.spelling does without a lookup query
+
+Postings are `array` objects, not containers of Python objects. Queries
+are parsed with `products.query.tokenize` and match the documents the
+SearchQuery of `products.query` matches: words are stemmed by Postgres once
+each and cached (the dictionary's words when it is loaded), so a search
+usually runs no query at all until its page is hydrated. Full-text matches
+are scored with the plain `text_score` instead of ts_rank, so products
+close in relevance may be ordered differently than by the SQL backend;
+every source and the final ranking break ties by product id.
+
+The engine follows writes of this process through model signals and those
+of other processes through `sync()`, which re-reads changed and deleted
+(ProductTombstone) products in a background thread. `build()` loads a
+fresh snapshot and swaps it in, so searches keep using the current state
+until it is ready.
+"""
+import bisect
+import re
+import sys
+import threading
+import time
+from array import array
+from decimal import Decimal
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+
+from .arabic import normalize_arabic
+from .cache import get_generation, get_terms_version
+from .changes import changed_product_ids, horizon
+from .degradation import TIER_FULL
+from .models import Brand, Category, Product, SearchTerm
+from .query import PREFIX_WEIGHTS, fuzzy_text, token_config, tokenize
+from .services import ORMSearchBackend, SearchBackend, SearchResult
+
+# ts_rank default weights indexed by the 2-bit tsvector weight: D, C, B, A
+RANK_WEIGHTS = (0.1, 0.2, 0.4, 1.0)
+WEIGHT_CODES = {'A': 3, 'B': 2, 'C': 1, 'D': 0}
+PREFIX_CODES = {WEIGHT_CODES[weight] for weight in PREFIX_WEIGHTS}
+POSITION_MASK = 0x3FFF
+# ts_rank of a single occurrence in the name (1 / 1.645), so that text_score
+# weighs against trigram similarity about like SearchRank does in SQL
+TEXT_SCORE_SCALE = 0.6
+# Stemmed query words kept per process, (config, word) -> lexemes
+MAX_CACHED_WORDS = 500000
+
+TSVECTOR_LEXEME = re.compile(r"'((?:[^']|'')*)'(?::([0-9A-D,]+))?")
+# pg_trgm word characters: alphanumerics of the database's LC_CTYPE. Under
+# the C locale only ASCII counts, see configure_trigrams().
+UNICODE_TRIGRAM_WORD = re.compile(r'[^\W_]+')
+ASCII_TRIGRAM_WORD = re.compile(r'[A-Za-z0-9]+')
+TRIGRAM_WORD = UNICODE_TRIGRAM_WORD
+
+
+def _float4(value):
+    """Round to single precision like pg_trgm does"""
+    return array('f', [value])[0]
+
+
+def trigrams(text):
+    """Ordered trigrams of `text` as pg_trgm generates them, duplicates included"""
+    result = []
+    for word in TRIGRAM_WORD.findall(text.lower()):
+        padded = f'  {word} '
+        result.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def configure_trigrams():
+    """Match the word characters pg_trgm uses in the connected database"""
+    global TRIGRAM_WORD
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT cardinality(show_trgm('\u0628'))")
+        unicode_words = cursor.fetchone()[0] > 0
+    TRIGRAM_WORD = UNICODE_TRIGRAM_WORD if unicode_words else ASCII_TRIGRAM_WORD
+
+
+def similarity(query, text):
+    """pg_trgm similarity()"""
+    if not query or not text:
+        return 0.0
+    first, second = set(trigrams(query)), set(trigrams(text))
+    if not first or not second:
+        return 0.0
+    common = len(first & second)
+    return _float4(common / (len(first) + len(second) - common))
+
+
+def word_similarity(query, text):
+    """
+    pg_trgm word_similarity(): best similarity between the trigrams of
+    `query` and any continuous extent of the ordered trigrams of `text`.
+    Port of iterate_word_similarity() in contrib/pg_trgm/trgm_op.c.
+    """
+    if not query or not text:
+        return 0.0
+    index = {}
+    for trigram in set(trigrams(query)):
+        index[trigram] = len(index)
+    ulen1 = found_count = len(index)
+    positions = [index.setdefault(trigram, len(index)) for trigram in trigrams(text)]
+    if not ulen1 or not positions:
+        return 0.0
+
+    lastpos = [-1] * len(index)
+    ulen2 = count = 0
+    lower = -1
+    best = 0.0
+    for i, trgindex in enumerate(positions):
+        found = trgindex < found_count
+        if lower >= 0 or found:
+            if lastpos[trgindex] < 0:
+                ulen2 += 1
+                if found:
+                    count += 1
+            lastpos[trgindex] = i
+        if not found:
+            continue
+
+        upper = i
+        if lower == -1:
+            lower = i
+            ulen2 = 1
+        current = count / (ulen1 + ulen2 - count)
+        # Also try to move the lower bound for a greater similarity
+        tmp_count, tmp_ulen2, prev_lower = count, ulen2, lower
+        for tmp_lower in range(lower, upper + 1):
+            candidate = tmp_count / (ulen1 + tmp_ulen2 - tmp_count)
+            if candidate > current:
+                current, ulen2, lower, count = candidate, tmp_ulen2, tmp_lower, tmp_count
+            tmp_index = positions[tmp_lower]
+            if lastpos[tmp_index] == tmp_lower:
+                tmp_ulen2 -= 1
+                if tmp_index < found_count:
+                    tmp_count -= 1
+        best = max(best, current)
+        for tmp_lower in range(prev_lower, lower):
+            tmp_index = positions[tmp_lower]
+            if lastpos[tmp_index] == tmp_lower:
+                lastpos[tmp_index] = -1
+    return _float4(best)
+
+
+def parse_tsvector(text):
+    """Yield (lexeme, packed positions) pairs of a tsvector's text form"""
+    for match in TSVECTOR_LEXEME.finditer(text or ''):
+        lexeme, raw_positions = match.group(1).replace("''", "'"), match.group(2)
+        packed = []
+        for raw in (raw_positions or '0').split(','):
+            weight = WEIGHT_CODES.get(raw[-1], 0)
+            position = int(raw.rstrip('ABCD'))
+            packed.append((weight << 14) | (position & POSITION_MASK))
+        yield lexeme, packed
+
+
+# (config, lowercased word) -> its lexemes as (offset, lexeme) pairs, () for a stop word
+_word_lexemes = {}
+
+WORD_LEXEMES_SQL = 'SELECT w.word, to_tsvector(%s::regconfig, w.word)::text FROM unnest(%s::text[]) AS w(word)'
+
+
+def stem_words(config, words):
+    """
+    {word: lexemes} of the lowercased `words`, stemmed by Postgres in one
+    query for those not cached yet
+    """
+    words = {word.lower() for word in words}
+    stems = {word: _word_lexemes[(config, word)] for word in words if (config, word) in _word_lexemes}
+    missing = sorted(words - stems.keys())
+    if not missing:
+        return stems
+    with connection.cursor() as cursor:
+        cursor.execute(WORD_LEXEMES_SQL, [config, missing])
+        rows = cursor.fetchall()
+    for word, vector in rows:
+        stems[word] = tuple(sorted(
+            ((packed & POSITION_MASK) - 1, lexeme)
+            for lexeme, positions in parse_tsvector(vector) for packed in positions
+        ))
+        if len(_word_lexemes) < MAX_CACHED_WORDS:
+            _word_lexemes[(config, word)] = stems[word]
+    return stems
+
+
+def _term(words, prefix, stems):
+    """
+    products.query.term_query(words, prefix) as a ((offset, lexeme), ...)
+    phrase and `prefix`. Stop words are dropped but keep their offset, like
+    phrase distances in Postgres; no lexemes when every word is one.
+    """
+    lexemes, offset = [], 0
+    for word in words:
+        word_lexemes = stems[word.lower()]
+        lexemes.extend((offset + position, lexeme) for position, lexeme in word_lexemes)
+        offset += word_lexemes[-1][0] + 1 if word_lexemes else 1
+    return tuple(lexemes), prefix
+
+
+@lru_cache(maxsize=4096)
+def parse_query(query_string):
+    """
+    products.query.parse_search_query(query_string) as a tuple of
+    alternatives, each a (terms, excluded terms) pair of _term() phrases.
+    Empty when the query has no words but stop words, like the SQL query.
+    """
+    groups = tokenize(query_string)
+    by_config = {}
+    for group in groups:
+        for words, _, _ in group:
+            by_config.setdefault(token_config(' '.join(words)), set()).update(words)
+    stems = {config: stem_words(config, words) for config, words in by_config.items()}
+    alternatives = []
+    for group in groups:
+        terms, excluded = [], []
+        for words, prefix, negated in group:
+            term = _term(words, prefix, stems[token_config(' '.join(words))])
+            if term[0]:
+                (excluded if negated else terms).append(term)
+        if terms or excluded:
+            alternatives.append((tuple(terms), tuple(excluded)))
+    return tuple(alternatives)
+
+
+def exclusion_terms(query):
+    """The terms of products.query.exclusion_query(): every excluded term of a parsed query"""
+    return [term for _, excluded in query for term in excluded]
+
+
+def _occurrences(lexeme, prefix, entries):
+    """
+    Packed positions of `lexeme` in a document's (lexeme, positions) entries,
+    with `prefix` also those of the lexemes it starts in PREFIX_WEIGHTS fields
+    """
+    for entry, positions in entries:
+        if entry == lexeme:
+            yield from positions
+        elif prefix and entry.startswith(lexeme):
+            yield from (packed for packed in positions if packed >> 14 in PREFIX_CODES)
+
+
+def term_matches(term, entries):
+    """Whether a document contains the term's lexemes at consecutive offsets"""
+    lexemes, prefix = term
+    starts = None
+    for offset, lexeme in lexemes:
+        found = {(packed & POSITION_MASK) - offset for packed in _occurrences(lexeme, prefix, entries)}
+        starts = found if starts is None else starts & found
+        if not starts:
+            return False
+    return True
+
+
+def query_matches(query, entries):
+    """`search_vector @@ query` for one document's entries"""
+    return any(
+        all(term_matches(term, entries) for term in terms) and
+        not any(term_matches(term, entries) for term in excluded)
+        for terms, excluded in query
+    )
+
+
+def rank_operands(query):
+    """The distinct (lexeme, prefix) pairs a query is ranked by"""
+    return sorted({(lexeme, prefix) for terms, _ in query for lexemes, prefix in terms for _, lexeme in lexemes})
+
+
+def text_score(operands, entries):
+    """
+    Full-text score of a document: the mean over the query's operands of
+    the best weight they occur with (RANK_WEIGHTS, 0 when absent), times
+    TEXT_SCORE_SCALE. Unlike ts_rank it ignores repetitions and proximity.
+    """
+    if not operands:
+        return 0.0
+    total = 0.0
+    for lexeme, prefix in operands:
+        total += max((RANK_WEIGHTS[packed >> 14] for packed in _occurrences(lexeme, prefix, entries)), default=0.0)
+    return total / len(operands) * TEXT_SCORE_SCALE
+
+
+def _price_cents(price):
+    return int((Decimal(str(price)) * 100).to_integral_value())
+
+
+def _array_bytes(values):
+    return values.buffer_info()[1] * values.itemsize
+
+
+class _Postings:
+    """Sorted product ordinals with their packed tsvector positions"""
+    __slots__ = ('ordinals', 'offsets', 'positions')
+
+    def __init__(self):
+        self.ordinals = array('I')
+        self.offsets = array('I', [0])
+        self.positions = array('H')
+
+    def add(self, ordinal, packed):
+        i = bisect.bisect_left(self.ordinals, ordinal)
+        if i == len(self.ordinals):
+            self.ordinals.append(ordinal)
+            self.positions.extend(packed)
+            self.offsets.append(len(self.positions))
+            return
+        start = self.offsets[i]
+        self.ordinals.insert(i, ordinal)
+        self.positions[start:start] = array('H', packed)
+        self.offsets[i + 1:] = array('I', (offset + len(packed) for offset in self.offsets[i:]))
+
+    def remove(self, ordinal):
+        i = bisect.bisect_left(self.ordinals, ordinal)
+        if i == len(self.ordinals) or self.ordinals[i] != ordinal:
+            return
+        start, end = self.offsets[i], self.offsets[i + 1]
+        del self.positions[start:end]
+        del self.ordinals[i]
+        del self.offsets[i + 1]
+        self.offsets[i + 1:] = array('I', (offset - (end - start) for offset in self.offsets[i + 1:]))
+
+    def get(self, ordinal):
+        i = bisect.bisect_left(self.ordinals, ordinal)
+        if i == len(self.ordinals) or self.ordinals[i] != ordinal:
+            return None
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def nbytes(self):
+        return _array_bytes(self.ordinals) + _array_bytes(self.offsets) + _array_bytes(self.positions)
+
+
+def _insort(values, ordinal):
+    i = bisect.bisect_left(values, ordinal)
+    if i == len(values) or values[i] != ordinal:
+        values.insert(i, ordinal)
+
+
+def _discard(values, ordinal):
+    i = bisect.bisect_left(values, ordinal)
+    if i < len(values) and values[i] == ordinal:
+        del values[i]
+
+
+class SearchEngine:
+    """Array-backed inverted and trigram indexes over the active catalog"""
+
+    # Kept when a rebuilt snapshot is swapped in
+    KEPT = ('_lock', '_syncing', 'checked_at')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._syncing = False
+        self._reset()
+
+    def _reset(self):
+        # Column store, one slot per product ordinal. Slots of removed
+        # products are kept (active=0) until the next rebuild.
+        self.ordinal_of = {}
+        self.product_ids = array('q')
+        self.brand_ids = array('q')
+        self.category_ids = array('q')
+        self.prices = array('q')  # in cents
+        self.active = array('b')
+        self.names = []
+        self.names_ar = []
+        # Per ordinal slice of `doc_terms` listing its lexeme ids
+        self.doc_term_start = array('Q')
+        self.doc_term_count = array('H')
+        self.doc_terms = array('I')
+        # Full-text lexicon (lexeme -> term id), postings and lexemes by term
+        # id; `lexemes` is kept sorted for prefix lookups
+        self.lexicon = {}
+        self.postings = []
+        self.terms = []
+        self.lexemes = []
+        # Trigram postings (trigram -> sorted ordinals)
+        self.name_trigrams = {}
+        self.name_ar_trigrams = {}
+        self.brand_products = {}
+        self.brand_names = {}
+        self.category_names = {}
+        # Spelling dictionary sorted for prefix lookups, the frequency of each
+        # term and trigram postings (trigram -> sorted term indexes)
+        self.spelling_terms = []
+        self.spelling_frequencies = array('q')
+        self.spelling_trigrams = {}
+        self.terms_version = None
+        self.active_count = 0
+        self.generation = None
+        self.synced_at = None
+        self.checked_at = 0.0
+
+    # Building and incremental updates
+
+    def build(self):
+        """Load a full snapshot of the active catalog and swap it in"""
+        fresh = SearchEngine()
+        fresh._load()
+        with self._lock:
+            self.__dict__.update({name: value for name, value in vars(fresh).items() if name not in self.KEPT})
+            self.checked_at = time.monotonic()
+
+    def _load(self):
+        configure_trigrams()
+        self.generation = get_generation()
+        self.synced_at = horizon()
+        self.brand_names = dict(Brand.objects.values_list('id', 'name'))
+        self.category_names = dict(Category.objects.values_list('id', 'name'))
+        self.lexemes = None  # sorted once after loading
+        for row in self._rows(Product.objects.filter(is_active=True).order_by('id')):
+            self._index(*row)
+        self.lexemes = sorted(self.lexicon)
+        self._load_terms()
+
+    def _load_terms(self):
+        """
+        Load the spelling dictionary, which only changes when it is
+        refreshed, and stem its words for query parsing
+        """
+        version = get_terms_version()
+        rows = sorted(SearchTerm.objects.values_list('term', 'frequency').iterator(chunk_size=5000))
+        terms = [term for term, _ in rows]
+        term_trigrams = {}
+        for index, term in enumerate(terms):
+            for trigram in set(trigrams(term)):
+                term_trigrams.setdefault(trigram, array('I')).append(index)
+        by_config = {}
+        for term in terms:
+            by_config.setdefault(token_config(term), []).append(term)
+        for config, config_terms in by_config.items():
+            stem_words(config, config_terms)
+        with self._lock:
+            self.spelling_terms = terms
+            self.spelling_frequencies = array('q', (frequency for _, frequency in rows))
+            self.spelling_trigrams = term_trigrams
+            self.terms_version = version
+
+    def refresh_products(self, product_ids):
+        """Re-read the given products and update (or drop) their entries"""
+        product_ids = set(product_ids)
+        # Read before taking the lock, so searches do not wait for the database
+        rows = list(self._rows(Product.objects.filter(id__in=product_ids, is_active=True)))
+        with self._lock:
+            for row in rows:
+                self._unindex(row[0])
+                self._index(*row)
+                product_ids.discard(row[0])
+            for product_id in product_ids:
+                self._unindex(product_id)
+
+    def refresh_brand(self, brand_id):
+        brand_names = dict(Brand.objects.values_list('id', 'name'))
+        with self._lock:
+            self.brand_names = brand_names
+        self.refresh_products(Product.objects.filter(brand_id=brand_id).values_list('id', flat=True))
+
+    def refresh_category(self, category_id):
+        category_names = dict(Category.objects.values_list('id', 'name'))
+        with self._lock:
+            self.category_names = category_names
+        self.refresh_products(Product.objects.filter(category_id=category_id).values_list('id', flat=True))
+
+    def sync(self):
+        """
+        Catch up with writes made by other processes, at most every
+        SEARCH_ENGINE_SYNC_INTERVAL seconds and once the shared catalog
+        generation moved. The catch-up runs in a background thread;
+        searches keep using the current state meanwhile.
+        """
+        if time.monotonic() - self.checked_at < settings.SEARCH_ENGINE_SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._syncing or time.monotonic() - self.checked_at < settings.SEARCH_ENGINE_SYNC_INTERVAL:
+                return
+            self.checked_at = time.monotonic()
+            generation = get_generation()
+            if generation == self.generation:
+                return
+            self._syncing = True
+        threading.Thread(
+            target=self._sync_in_background, args=(generation,), name='search-engine-sync', daemon=True
+        ).start()
+
+    def _sync_in_background(self, generation):
+        try:
+            self.catch_up(generation)
+        finally:
+            self._syncing = False
+            # The thread's own database connection
+            connection.close()
+
+    def catch_up(self, generation):
+        """
+        Re-read the products updated or deleted (ProductTombstone) since the
+        last sync. Brand, category and nutrition fact edits touch their
+        products (migrations 0015 and 0016), so they are re-read too.
+        """
+        since = horizon()
+        brand_names = dict(Brand.objects.values_list('id', 'name'))
+        category_names = dict(Category.objects.values_list('id', 'name'))
+        with self._lock:
+            self.brand_names = brand_names
+            self.category_names = category_names
+        self.refresh_products(changed_product_ids(self.synced_at))
+        if get_terms_version() != self.terms_version:
+            self._load_terms()
+        with self._lock:
+            self.generation = generation
+            self.synced_at = since
+
+    @staticmethod
+    def _rows(queryset):
+        return queryset.values_list(
+            'id', 'name', 'name_ar', 'brand_id', 'category_id', 'price', 'search_vector'
+        ).iterator(chunk_size=5000)
+
+    def _index(self, product_id, name, name_ar, brand_id, category_id, price, search_vector):
+        # Trigrams of name_ar are matched like SearchDocument.name_ar_normalized
+        name_ar = normalize_arabic(name_ar)
+        ordinal = self.ordinal_of.get(product_id)
+        if ordinal is None:
+            ordinal = len(self.product_ids)
+            self.ordinal_of[product_id] = ordinal
+            self.product_ids.append(product_id)
+            self.brand_ids.append(brand_id)
+            self.category_ids.append(category_id)
+            self.prices.append(_price_cents(price))
+            self.active.append(1)
+            self.names.append(name)
+            self.names_ar.append(name_ar)
+            self.doc_term_start.append(0)
+            self.doc_term_count.append(0)
+        else:
+            self.brand_ids[ordinal] = brand_id
+            self.category_ids[ordinal] = category_id
+            self.prices[ordinal] = _price_cents(price)
+            self.active[ordinal] = 1
+            self.names[ordinal] = name
+            self.names_ar[ordinal] = name_ar
+        self.active_count += 1
+
+        term_ids = []
+        for lexeme, packed in parse_tsvector(search_vector):
+            term_id = self.lexicon.get(lexeme)
+            if term_id is None:
+                term_id = self.lexicon[lexeme] = len(self.postings)
+                self.postings.append(_Postings())
+                self.terms.append(lexeme)
+                if self.lexemes is not None:
+                    bisect.insort(self.lexemes, lexeme)
+            self.postings[term_id].add(ordinal, packed)
+            term_ids.append(term_id)
+        self.doc_term_start[ordinal] = len(self.doc_terms)
+        self.doc_term_count[ordinal] = len(term_ids)
+        self.doc_terms.extend(term_ids)
+
+        for field_trigrams, text in ((self.name_trigrams, name), (self.name_ar_trigrams, name_ar)):
+            for trigram in set(trigrams(text or '')):
+                _insort(field_trigrams.setdefault(trigram, array('I')), ordinal)
+        _insort(self.brand_products.setdefault(brand_id, array('I')), ordinal)
+
+    def _unindex(self, product_id):
+        ordinal = self.ordinal_of.get(product_id)
+        if ordinal is None or not self.active[ordinal]:
+            return
+        start = self.doc_term_start[ordinal]
+        for term_id in self.doc_terms[start:start + self.doc_term_count[ordinal]]:
+            self.postings[term_id].remove(ordinal)
+        self.doc_term_count[ordinal] = 0
+        for field_trigrams, text in ((self.name_trigrams, self.names[ordinal]),
+                                     (self.name_ar_trigrams, self.names_ar[ordinal])):
+            for trigram in set(trigrams(text or '')):
+                _discard(field_trigrams[trigram], ordinal)
+        _discard(self.brand_products[self.brand_ids[ordinal]], ordinal)
+        self.active[ordinal] = 0
+        self.active_count -= 1
+
+    # Searching
+
+    def lookup_terms(self, words):
+        """
+        Port of products.spelling.CORRECT_SQL: {word: (known, exact, fix)}
+        from the in-memory dictionary
+        """
+        with self._lock:
+            terms = self.spelling_terms
+            # `term % word` and the correction's own minimum
+            threshold = max(settings.SEARCH_TRIGRAM_SIMILARITY_THRESHOLD, settings.SEARCH_SPELL_MIN_SIMILARITY)
+            results = {}
+            for word in words:
+                i = bisect.bisect_left(terms, word)
+                known = i < len(terms) and terms[i].startswith(word)
+                # NULL in SQL when no term starts with the word
+                exact = terms[i] == word if known else None
+                fix = None
+                word_trigrams = set(trigrams(word))
+                if not known and word_trigrams:
+                    # similarity <= shared trigrams / query trigrams, so this prunes safely
+                    needed = threshold * len(word_trigrams)
+                    counts = {}
+                    for trigram in word_trigrams:
+                        for index in self.spelling_trigrams.get(trigram, ()):
+                            counts[index] = counts.get(index, 0) + 1
+                    best = None
+                    for index, count in counts.items():
+                        if count < needed:
+                            continue
+                        score = similarity(terms[index], word)
+                        if score >= threshold:
+                            key = (-score, -self.spelling_frequencies[index], terms[index])
+                            best = key if best is None or key < best else best
+                    fix = best[2] if best else None
+                results[word] = (known, exact, fix)
+            return results
+
+    def search(self, query_string, has_arabic, sources=None, **filters):
+        """
+        Return `(ranked product ids, truncated)` using the same sources,
+        thresholds, candidate limit and relevance formula as ORMSearchBackend,
+        with text_score in place of SearchRank, ordered by relevance and id.
+        `sources` restricts retrieval like ORMSearchBackend._source_names.
+        """
+        with self._lock:
+            query = parse_query(query_string)
+            allowed = self._filter(exclusion_terms(query), **filters)
+            limit = settings.SEARCH_CANDIDATE_LIMIT
+            operands = rank_operands(query)
+            # Trigram matching sees the plain words, as in ORMSearchBackend
+            fuzzy_string = fuzzy_text(query_string)
+
+            names = sources or ('full_text', 'name', 'name_ar', 'brand')
+            sources = [
+                self._full_text_source(query, operands, allowed, limit),
+                self._trigram_source(self.name_trigrams, self.names, fuzzy_string, allowed, limit)
+                if 'name' in names else [],
+                self._trigram_source(self.name_ar_trigrams, self.names_ar, fuzzy_string, allowed, limit)
+                if 'name_ar' in names else [],
+                self._brand_source(fuzzy_string, allowed, limit),
+            ]
+            truncated = any(len(source) >= limit for source in sources)
+            candidates = set().union(*sources)
+
+            weights = settings.SEARCH_RELEVANCE_WEIGHTS
+            name_ar_weight = weights['name_ar_arabic'] if has_arabic else weights['name_ar']
+            ranked = []
+            for ordinal in candidates:
+                scores = [
+                    text_score(operands, self._doc_entries(ordinal)) * weights['full_text'],
+                    similarity(fuzzy_string, self.names[ordinal]) * weights['name'],
+                    similarity(fuzzy_string, self.brand_names.get(self.brand_ids[ordinal])) * weights['brand'],
+                    0.0,
+                ]
+                # GREATEST() ignores NULLs, so a missing Arabic name does not score
+                if self.names_ar[ordinal] is not None:
+                    scores.append(similarity(fuzzy_string, self.names_ar[ordinal]) * name_ar_weight)
+                ranked.append((-max(scores), self.product_ids[ordinal]))
+            ranked.sort()
+            return [product_id for _, product_id in ranked], truncated
+
+    def _filter(self, excluded, category=None, brand=None, min_price=None, max_price=None):
+        category = int(category) if category else None
+        brand = int(brand) if brand else None
+        min_cents = _price_cents(min_price) if min_price is not None else None
+        max_cents = _price_cents(max_price) if max_price is not None else None
+
+        def allowed(ordinal):
+            return (
+                self.active[ordinal] and
+                (category is None or self.category_ids[ordinal] == category) and
+                (brand is None or self.brand_ids[ordinal] == brand) and
+                (min_cents is None or self.prices[ordinal] >= min_cents) and
+                (max_cents is None or self.prices[ordinal] <= max_cents) and
+                not any(term_matches(term, self._doc_entries(ordinal)) for term in excluded)
+            )
+        return allowed
+
+    def _doc_entries(self, ordinal):
+        """(lexeme, packed positions) pairs of a product's search_vector, in tsvector order"""
+        start = self.doc_term_start[ordinal]
+        return [
+            (self.terms[term_id], self.postings[term_id].get(ordinal))
+            for term_id in self.doc_terms[start:start + self.doc_term_count[ordinal]]
+        ]
+
+    def _term_ids(self, lexeme, prefix):
+        if not prefix:
+            term_id = self.lexicon.get(lexeme)
+            return [] if term_id is None else [term_id]
+        term_ids = []
+        for i in range(bisect.bisect_left(self.lexemes, lexeme), len(self.lexemes)):
+            if not self.lexemes[i].startswith(lexeme):
+                break
+            term_ids.append(self.lexicon[self.lexemes[i]])
+        return term_ids
+
+    def _candidates(self, query):
+        """
+        Superset of the ordinals matching `query` from the postings: those
+        with every lexeme of an alternative's terms. None means all, for an
+        alternative with excluded terms only.
+        """
+        candidates = set()
+        for terms, _ in query:
+            if not terms:
+                return None
+            alternative = None
+            for lexemes, prefix in terms:
+                for _, lexeme in lexemes:
+                    ordinals = {
+                        ordinal for term_id in self._term_ids(lexeme, prefix)
+                        for ordinal in self.postings[term_id].ordinals
+                    }
+                    alternative = ordinals if alternative is None else alternative & ordinals
+            candidates |= alternative
+        return candidates
+
+    def _full_text_source(self, query, operands, allowed, limit):
+        candidates = self._candidates(query)
+        if candidates is None:
+            candidates = range(len(self.product_ids))
+        scored = []
+        for ordinal in candidates:
+            if not allowed(ordinal):
+                continue
+            # Weights and phrase offsets are only checked on the document itself
+            entries = self._doc_entries(ordinal)
+            if query_matches(query, entries):
+                scored.append((-text_score(operands, entries), self.product_ids[ordinal], ordinal))
+        scored.sort()
+        return [ordinal for _, _, ordinal in scored[:limit]]
+
+    def _trigram_source(self, index, texts, query_string, allowed, limit):
+        query_trigrams = set(trigrams(query_string))
+        if not query_trigrams:
+            return []
+        threshold = settings.SEARCH_TRIGRAM_WORD_SIMILARITY_THRESHOLD
+        # word_similarity <= shared trigrams / query trigrams, so this prunes safely
+        needed = threshold * len(query_trigrams)
+        counts = {}
+        for trigram in query_trigrams:
+            for ordinal in index.get(trigram, ()):
+                counts[ordinal] = counts.get(ordinal, 0) + 1
+        scored = []
+        for ordinal, count in counts.items():
+            if count >= needed and allowed(ordinal):
+                score = word_similarity(query_string, texts[ordinal])
+                if score >= threshold:
+                    scored.append((-score, self.product_ids[ordinal], ordinal))
+        scored.sort()
+        return [ordinal for _, _, ordinal in scored[:limit]]
+
+    def _brand_source(self, query_string, allowed, limit):
+        threshold = settings.SEARCH_TRIGRAM_SIMILARITY_THRESHOLD
+        matches = []
+        for brand_id, name in self.brand_names.items():
+            if similarity(query_string, name) >= threshold:
+                matches.extend(ordinal for ordinal in self.brand_products.get(brand_id, ()) if allowed(ordinal))
+                if len(matches) >= limit:
+                    break
+        return matches[:limit]
+
+    # Reporting
+
+    def memory_report(self):
+        """Approximate memory used by the engine's structures, in bytes"""
+        with self._lock:
+            columns = sum(_array_bytes(values) for values in (
+                self.product_ids, self.brand_ids, self.category_ids, self.prices, self.active,
+                self.doc_term_start, self.doc_term_count, self.doc_terms,
+            ))
+            strings = (
+                sys.getsizeof(self.names) + sys.getsizeof(self.names_ar) +
+                sum(sys.getsizeof(text) for text in self.names) +
+                sum(sys.getsizeof(text) for text in self.names_ar if text is not None)
+            )
+            full_text = sum(postings.nbytes() for postings in self.postings)
+            trigram = sum(
+                _array_bytes(ordinals)
+                for index in (self.name_trigrams, self.name_ar_trigrams, self.brand_products)
+                for ordinals in index.values()
+            )
+            dictionaries = sum(sys.getsizeof(mapping) + sum(sys.getsizeof(key) for key in mapping) for mapping in (
+                self.ordinal_of, self.lexicon, self.name_trigrams, self.name_ar_trigrams, self.brand_products,
+            )) + sys.getsizeof(self.postings) + sys.getsizeof(self.terms) + sys.getsizeof(self.lexemes)
+            spelling = (
+                sys.getsizeof(self.spelling_terms) + sum(sys.getsizeof(term) for term in self.spelling_terms) +
+                _array_bytes(self.spelling_frequencies) + sys.getsizeof(self.spelling_trigrams) +
+                sum(sys.getsizeof(key) + _array_bytes(indexes) for key, indexes in self.spelling_trigrams.items())
+            )
+            report = {
+                'products': self.active_count,
+                'slots': len(self.product_ids),
+                'lexemes': len(self.lexicon),
+                'trigrams': len(self.name_trigrams) + len(self.name_ar_trigrams),
+                'spelling_terms': len(self.spelling_terms),
+                'column_bytes': columns,
+                'string_bytes': strings,
+                'full_text_posting_bytes': full_text,
+                'trigram_posting_bytes': trigram,
+                'dictionary_bytes': dictionaries,
+                'spelling_bytes': spelling,
+            }
+            report['total_bytes'] = columns + strings + full_text + trigram + dictionaries + spelling
+            return report
+
+    # Signal receivers
+
+    def connect_signals(self):
+        # Bound methods are weakly referenced, so a discarded engine disconnects itself
+        post_save.connect(self._product_changed, sender=Product)
+        post_delete.connect(self._product_changed, sender=Product)
+        post_save.connect(self._brand_changed, sender=Brand)
+        post_delete.connect(self._brand_changed, sender=Brand)
+        post_save.connect(self._category_changed, sender=Category)
+        post_delete.connect(self._category_changed, sender=Category)
+
+    # Primary keys are read now: Django clears them on deleted instances
+
+    def _product_changed(self, sender, instance, **kwargs):
+        # The trigger-maintained search_vector is only final once the transaction commits
+        product_id = instance.pk
+        transaction.on_commit(lambda: self.refresh_products([product_id]))
+
+    def _brand_changed(self, sender, instance, **kwargs):
+        brand_id = instance.pk
+        transaction.on_commit(lambda: self.refresh_brand(brand_id))
+
+    def _category_changed(self, sender, instance, **kwargs):
+        category_id = instance.pk
+        transaction.on_commit(lambda: self.refresh_category(category_id))
+
+
+class InMemorySearchBackend(SearchBackend):
+    """
+    SEARCH_BACKEND that ranks with a process-local SearchEngine and leaves
+    only hydration of the returned page to the database.
+    """
+
+    def __init__(self):
+        self.engine = SearchEngine()
+        self.fallback = ORMSearchBackend()
+        self._built = False
+        self._build_lock = threading.Lock()
+        self.engine.connect_signals()
+
+    def warm_up(self):
+        if self._built:
+            return
+        with self._build_lock:
+            if not self._built:
+                self.engine.build()
+                self._built = True
+
+    def search(self, query_string, tier=TIER_FULL, **filters):
+        # Filter-only listings are already served by indexes in the database.
+        # Ranking in memory puts no load on the database, so every tier ranks fully
+        if not query_string or not query_string.strip():
+            return self.fallback.search(query_string, tier=tier, **filters)
+
+        self.warm_up()
+        self.engine.sync()
+        correction = ORMSearchBackend._correct([query_string], self.engine.lookup_terms)[0]
+        query_string = correction.query_string
+        has_arabic = any('\u0600' <= c <= '\u06FF' for c in query_string)
+        ranked_ids, truncated = self.engine.search(
+            query_string, has_arabic, ORMSearchBackend._source_names(TIER_FULL, correction), **filters
+        )
+        return SearchResult(truncated=truncated, ranked_ids=ranked_ids, did_you_mean=correction.did_you_mean)
+
+    def facets(self, query_string, facets, tier=TIER_FULL, **filters):
+        # One aggregate query in the database; its retrieval matches the engine's sources
+        return self.fallback.facets(query_string, facets, tier=tier, **filters)
@@ -0,0 +1,139 @@
+"""
+Streaming export of products as NDJSON or CSV (/api/products/export/ and
+the export_products command).
+
+Rows are shaped like the product detail endpoint (ProductDetailSerializer)
+without the search vector: brand, category and nutrition facts are nested
+objects in NDJSON and `brand.name`-style columns in CSV. They are read as
+value tuples of one joined query, so there are no per-row queries.
+
+Without a search query the products are read through a server-side cursor
+(`iterator(chunk_size=EXPORT_CHUNK_SIZE)`) in the requested ordering, so
+memory stays constant whatever the size of the catalog. With a query, the
+search ranks at most SEARCH_CANDIDATE_LIMIT candidates per source; their
+ids are kept in rank order and the products are read chunk by chunk.
+"""
+import csv
+import json
+
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.utils import encoders
+
+from .facets import filter_conditions
+from .models import Product
+from .serializers import ProductDetailSerializer
+from .services import ProductSearchService
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+# Orderings of the export without a search query, as for ProductViewSet.list
+EXPORT_ORDERINGS = ('name', 'price', 'created_at')
+EXCLUDED_FIELDS = ('search_vector',)
+
+
+class ProductExporter:
+    """Reads the export rows and writes them in either format"""
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+        # (path, column, to_representation) per exported value, nested serializers flattened
+        self.fields = []
+        # Nullable nested objects: path -> index of the column telling whether it exists
+        self.nullable = {}
+        for name, field in ProductDetailSerializer().fields.items():
+            if name in EXCLUDED_FIELDS:
+                continue
+            if isinstance(field, serializers.Serializer):
+                if Product._meta.get_field(field.source).null:
+                    # Without the related row all of its columns are NULL, its id included
+                    self.nullable[name] = len(self.fields) + list(field.fields).index('id')
+                for child_name, child in field.fields.items():
+                    self.fields.append(
+                        ((name, child_name), f'{field.source}__{child.source}', child.to_representation)
+                    )
+            else:
+                self.fields.append(((name,), field.source, field.to_representation))
+        self.columns = [column for _, column, _ in self.fields]
+        self.id_index = self.columns.index('id')
+
+    def rows(self, query='', ordering=None, using=None, **filters):
+        """
+        Iterator of the value tuples of the exported products, in search rank
+        or `ordering` order, read from the `using` database. A search runs
+        right away; products are read while the iterator is consumed.
+        """
+        products = Product.objects.all() if using is None else Product.objects.using(using)
+        if query and query.strip():
+            result = ProductSearchService.search(query, **filters)
+            if result.ranked_ids is not None:
+                ids = list(result.ranked_ids)
+            else:
+                ids = list(result.queryset.values_list('id', flat=True))
+            return self._rows_by_id(products, ids)
+        ordering = ordering if (ordering or '').lstrip('-') in EXPORT_ORDERINGS else 'name'
+        queryset = products.filter(is_active=True).filter(filter_conditions(**filters)).order_by(ordering, 'id')
+        return queryset.values_list(*self.columns).iterator(chunk_size=self.chunk_size)
+
+    def _rows_by_id(self, products, ids):
+        for start in range(0, len(ids), self.chunk_size):
+            chunk = ids[start:start + self.chunk_size]
+            rows = {row[self.id_index]: row for row in products.filter(id__in=chunk).values_list(*self.columns)}
+            yield from (rows[pk] for pk in chunk if pk in rows)
+
+    def to_dict(self, row):
+        """Nested representation of a row, as the detail endpoint returns it"""
+        data = {}
+        for ((name, *child), _, represent), value in zip(self.fields, row):
+            value = None if value is None else represent(value)
+            if not child:
+                data[name] = value
+            elif name in self.nullable and row[self.nullable[name]] is None:
+                data[name] = None
+            else:
+                data.setdefault(name, {})[child[0]] = value
+        return data
+
+    def ndjson(self, rows):
+        """NDJSON text, in pieces of up to chunk_size lines"""
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(
+                self.to_dict(row), cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':')
+            ) + '\n')
+            if len(lines) >= self.chunk_size:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    def csv(self, rows):
+        """CSV text with a header row, in pieces of up to chunk_size lines"""
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+        writer.writerow(['.'.join(path) for path, _, _ in self.fields])
+        for row in rows:
+            writer.writerow([
+                '' if value is None else represent(value)
+                for value, (_, _, represent) in zip(row, self.fields)
+            ])
+            if len(buffer.lines) >= self.chunk_size:
+                yield buffer.take()
+        yield buffer.take()
+
+    def write(self, export_format, rows):
+        return self.ndjson(rows) if export_format == 'ndjson' else self.csv(rows)
+
+
+class _LineBuffer:
+    """File-like target of csv.writer collecting the lines it writes"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def take(self):
+        text, self.lines = ''.join(self.lines), []
+        return text
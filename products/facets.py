@@ -0,0 +1,115 @@
+"""
+Facet counts for search results (`facets=brand,category,price`).
+
+All requested facets are counted in one query, a UNION ALL of one
+aggregate per facet. Each facet respects the active filters except its
+own: its candidates are retrieved with the other filters applied inside
+every retrieval source, before the SEARCH_CANDIDATE_LIMIT cut, so the
+counts are those of the results the search would return without that
+facet's filter.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+FACETS = ('brand', 'category', 'price')
+# Search filters each facet relaxes when it is counted
+FACET_FILTERS = {
+    'brand': ('brand',),
+    'category': ('category',),
+    'price': ('min_price', 'max_price'),
+}
+# Grouping columns of each facet, the first one identifies its rows
+FACET_COLUMNS = {
+    'brand': ('brand_id', 'brand_name'),
+    'category': ('category_id', 'category_name'),
+    'price': ('price_bucket',),
+}
+
+
+def parse_facets(value):
+    """Known facet names of a comma separated `facets` parameter, in FACETS order"""
+    names = {name.strip().lower() for name in (value or '').split(',')}
+    return [facet for facet in FACETS if facet in names]
+
+
+def filter_conditions(**filters):
+    """Q for the search filters that are set, as ORMSearchBackend applies them"""
+    conditions = Q()
+    if filters.get('category'):
+        conditions &= Q(category_id=filters['category'])
+    if filters.get('brand'):
+        conditions &= Q(brand_id=filters['brand'])
+    if filters.get('min_price') is not None:
+        conditions &= Q(price__gte=filters['min_price'])
+    if filters.get('max_price') is not None:
+        conditions &= Q(price__lte=filters['max_price'])
+    return conditions
+
+
+def price_buckets():
+    """(min, max) of every price bucket; min is inclusive, None means unbounded"""
+    bounds = sorted(settings.SEARCH_FACET_PRICE_BUCKETS)
+    return list(zip([None, *bounds], [*bounds, None]))
+
+
+def relaxed_filters(facet, filters):
+    """The search filters `facet` is counted with: all of them except its own"""
+    return {name: value for name, value in filters.items() if name not in FACET_FILTERS[facet]}
+
+
+def facet_counts(candidates, facets):
+    """
+    Count per value of each facet in `facets` the SearchDocument queryset
+    `candidates[facet]`, the search's candidates retrieved with the facet's
+    relaxed_filters().
+    """
+    if not facets:
+        return {}
+    buckets = price_buckets()
+    parts, params = [], []
+    # Run on the database the candidates are read from, e.g. a replica (see products.routers)
+    connection = connections[candidates[facets[0]].db]
+    quote = connection.ops.quote_name
+    width = max(len(columns) for columns in FACET_COLUMNS.values())
+    for index, facet in enumerate(facets):
+        queryset = candidates[facet].order_by().annotate(
+            price_bucket=Case(
+                *[When(price__lt=high, then=Value(i)) for i, (_, high) in enumerate(buckets[:-1])],
+                default=Value(len(buckets) - 1),
+                output_field=IntegerField(),
+            ),
+        ).values(*FACET_COLUMNS[facet])
+        facet_sql, facet_params = queryset.query.get_compiler(connection=connection).as_sql()
+        columns = [quote(column) for column in FACET_COLUMNS[facet]]
+        # Every part has the same columns: facet index, the facet's columns padded with NULLs, count
+        selected = [str(index), *columns, *['NULL'] * (width - len(columns)), 'COUNT(*)']
+        parts.append(
+            f"SELECT {', '.join(selected)} FROM ({facet_sql}) AS candidates_{index} "
+            f"GROUP BY {', '.join(columns)}"
+        )
+        params.extend(facet_params)
+    with connection.cursor() as cursor:
+        cursor.execute(' UNION ALL '.join(parts), params)
+        rows = cursor.fetchall()
+
+    counts = {facet: {} for facet in facets}
+    for index, *values, count in rows:
+        facet = facets[index]
+        counts[facet][tuple(values[:len(FACET_COLUMNS[facet])])] = count
+
+    result = {}
+    limit = settings.SEARCH_FACET_LIMIT
+    for facet in facets:
+        if facet == 'price':
+            # Every bucket, in price order, so the UI can render a stable range list
+            result[facet] = [
+                {'min': low, 'max': high, 'count': counts[facet].get((index,), 0)}
+                for index, (low, high) in enumerate(buckets)
+            ]
+        else:
+            values = sorted(counts[facet].items(), key=lambda item: (-item[1], item[0][1] or '', item[0][0]))
+            result[facet] = [
+                {'id': pk, 'name': name, 'count': count} for (pk, name), count in values[:limit]
+            ]
+    return result
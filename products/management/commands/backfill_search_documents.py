@@ -0,0 +1,62 @@
+import importlib
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+search_document_triggers = importlib.import_module('products.migrations.0010_search_document_triggers')
+
+# One keyset batch: documents of the products without one, and the normalized
+# Arabic name of documents written before it was maintained (migration 0012).
+# FOR SHARE waits for concurrent writes to those products and reads their
+# committed values, and holds later ones until the batch commits, when their
+# triggers see the document.
+BACKFILL_SQL = f"""
+WITH batch AS (
+    SELECT * FROM products_product WHERE id > %s ORDER BY id LIMIT %s FOR SHARE
+), written AS (
+    {search_document_triggers.upsert_documents(
+        'batch p', 'WHERE NOT EXISTS (SELECT 1 FROM products_searchdocument d WHERE d.id = p.id)'
+    )}
+    RETURNING 1
+), normalized AS (
+    UPDATE products_searchdocument d SET name_ar_normalized = products_normalize_arabic(d.name_ar)
+    FROM batch p
+    WHERE d.id = p.id AND d.name_ar_normalized IS DISTINCT FROM products_normalize_arabic(d.name_ar)
+    RETURNING 1
+)
+SELECT max(id), (SELECT count(*) FROM written), (SELECT count(*) FROM normalized) FROM batch
+"""
+
+
+class Command(BaseCommand):
+    help = ('Create missing search documents and fill their normalized Arabic names '
+            'in short, id-ordered batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of products read by one batch (default: 5000)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+        started = time.monotonic()
+        last_id, written, normalized, batches = 0, 0, 0, 0
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(BACKFILL_SQL, [last_id, batch_size])
+                last_id, batch_written, batch_normalized = cursor.fetchone()
+            if last_id is None:
+                break
+            written += batch_written
+            normalized += batch_normalized
+            batches += 1
+            if options['verbosity'] >= 2:
+                self.stdout.write(
+                    f'  batch {batches}: up to id {last_id}, {batch_written} documents, {batch_normalized} names'
+                )
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {written} search documents and normalized {normalized} Arabic names '
+            f'in {batches} batches ({time.monotonic() - started:.1f}s).'
+        ))
@@ -0,0 +1,303 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from products.benchmark import summarize
+from products.models import Brand, Category, Product
+from products.services import ProductSearchService
+from products.views import ProductViewSet
+
+DEFAULT_MIX = os.path.join(settings.BASE_DIR, 'benchmarks', 'query_mix.json')
+TARGETS = ('service', 'endpoint')
+# Compared between runs; a higher value is worse for all of them
+COMPARED_STATS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+# Alias of a cache that stores nothing, used while the result cache is bypassed
+BYPASS_CACHE_ALIAS = 'benchmark-bypass'
+
+
+class QueryCounter:
+    """connection.execute_wrapper counting the SQL statements of a request"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = ('Replay a query mix against ProductSearchService and the search endpoint and report '
+            'latency percentiles, throughput and queries per request')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help='Query mix JSON file (default: benchmarks/query_mix.json)')
+        parser.add_argument('--target', choices=TARGETS + ('both',), default='both',
+                            help='Measure the service, the endpoint or both (default: both)')
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Times the weighted mix is replayed and measured (default: 5)')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Unmeasured rounds run first to warm caches and connections (default: 1)')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Threads sending requests, each with its own connection (default: 1)')
+        parser.add_argument('--seed', type=int, default=42,
+                            help='Seed of the request order (default: 42)')
+        parser.add_argument('--use-cache', action='store_true',
+                            help='Keep the search result cache on; by default every request is a miss')
+        parser.add_argument('--save', help='Write the results as a JSON baseline to this file')
+        parser.add_argument('--compare', help='Baseline JSON file to compare the results with')
+        parser.add_argument('--max-regression', type=float,
+                            help='With --compare, fail when p95 latency grew by more than this percentage')
+
+    def handle(self, *args, **options):
+        if options['rounds'] < 1 or options['concurrency'] < 1 or options['warmup'] < 0:
+            raise CommandError('--rounds and --concurrency must be positive, --warmup not negative')
+        baseline = self._load_json(options['compare']) if options['compare'] else None
+        mix = self._load_mix(options['mix'])
+        if not Product.objects.filter(is_active=True).exists():
+            raise CommandError('No active products; create a catalog with generate_catalog --load first')
+
+        requests = [entry for entry in mix for _ in range(entry['weight'])]
+        targets = TARGETS if options['target'] == 'both' else (options['target'],)
+        overrides = {
+            # Host of the requests sent by the test client
+            'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'],
+        }
+        if not options['use_cache']:
+            overrides['CACHES'] = {
+                **settings.CACHES,
+                BYPASS_CACHE_ALIAS: {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+            }
+            overrides['SEARCH_CACHE_ALIAS'] = BYPASS_CACHE_ALIAS
+
+        # The rate limit would reject the benchmark's own traffic
+        throttle_classes = ProductViewSet.throttle_classes
+        ProductViewSet.throttle_classes = []
+        try:
+            with override_settings(**overrides):
+                results = {
+                    target: self._run(target, requests, options) for target in targets
+                }
+        finally:
+            ProductViewSet.throttle_classes = throttle_classes
+
+        report = {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'environment': self._environment(options),
+            'results': results,
+        }
+        for target, result in results.items():
+            self._print_result(target, result)
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2, ensure_ascii=False)
+                output.write('\n')
+            self.stdout.write(f"Baseline saved to {options['save']}")
+        if baseline is not None:
+            regressions = self._compare(baseline, report, options['max_regression'])
+            if regressions:
+                raise CommandError('p95 regressions over {}%: {}'.format(
+                    options['max_regression'], ', '.join(regressions)
+                ))
+
+    # Input
+
+    @staticmethod
+    def _load_json(path):
+        try:
+            with open(path, encoding='utf-8') as handle:
+                return json.load(handle)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Cannot read {path}: {exc}')
+
+    def _load_mix(self, path):
+        """Queries of the mix with brand and category names replaced by ids"""
+        brand_ids, category_ids = {}, {}
+        for model, ids in ((Brand, brand_ids), (Category, category_ids)):
+            # Names are not unique; use the oldest row with that name like import_products
+            for name, pk in model.objects.order_by('-id').values_list('name', 'id'):
+                ids[name] = pk
+
+        mix = []
+        for entry in self._load_json(path).get('queries', []):
+            filters = dict(entry.get('filters', {}))
+            missing = [
+                f'{name} {filters[name]!r}'
+                for name, ids in (('brand', brand_ids), ('category', category_ids))
+                if name in filters and filters[name] not in ids
+            ]
+            if missing:
+                self.stderr.write(f"Skipping {entry.get('q')!r}: no {', '.join(missing)}")
+                continue
+            if 'brand' in filters:
+                filters['brand'] = brand_ids[filters['brand']]
+            if 'category' in filters:
+                filters['category'] = category_ids[filters['category']]
+            mix.append({
+                'kind': entry.get('kind', 'other'),
+                'q': entry.get('q', ''),
+                'filters': filters,
+                'weight': int(entry.get('weight', 1)),
+            })
+        if not mix:
+            raise CommandError(f'No usable queries in {path}')
+        return mix
+
+    # Running
+
+    def _run(self, target, requests, options):
+        """Replay the mix `rounds` times and summarize the samples per query kind"""
+        rng = random.Random(options['seed'])
+        send = self._send_service if target == 'service' else self._send_endpoint
+        for _ in range(options['warmup']):
+            self._replay(send, requests, options['concurrency'])
+
+        rounds = []
+        for _ in range(options['rounds']):
+            round_requests = list(requests)
+            rng.shuffle(round_requests)
+            rounds.extend(round_requests)
+        started = time.perf_counter()
+        samples = self._replay(send, rounds, options['concurrency'])
+        elapsed = time.perf_counter() - started
+
+        by_kind = defaultdict(list)
+        for entry, sample in zip(rounds, samples):
+            by_kind[entry['kind']].append(sample)
+        return {
+            'overall': summarize(samples, elapsed),
+            'kinds': {kind: summarize(kind_samples) for kind, kind_samples in sorted(by_kind.items())},
+        }
+
+    def _replay(self, send, requests, concurrency):
+        """Send the requests, split over `concurrency` threads, and return their samples in order"""
+        if concurrency == 1:
+            return [self._measure(send, entry) for entry in requests]
+
+        def worker(chunk):
+            try:
+                return [self._measure(send, entry) for entry in chunk]
+            finally:
+                connection.close()
+
+        chunks = [requests[offset::concurrency] for offset in range(concurrency)]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(worker, chunks))
+        samples = [None] * len(requests)
+        for offset, chunk_samples in enumerate(results):
+            samples[offset::concurrency] = chunk_samples
+        return samples
+
+    def _measure(self, send, entry):
+        """Return (seconds, SQL statements, succeeded) for one request"""
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            try:
+                ok = send(entry)
+            except Exception as exc:
+                self.stderr.write(f"{entry['q']!r} failed: {exc!r}")
+                ok = False
+            elapsed = time.perf_counter() - started
+        return elapsed, counter.count, ok
+
+    @staticmethod
+    def _send_service(entry):
+        """Search and load the first page the way the search endpoint does"""
+        result = ProductSearchService.search(entry['q'], **entry['filters'])
+        page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+        if result.ranked_ids is not None:
+            ids = result.ranked_ids[:page_size]
+        else:
+            ids = list(result.queryset.values_list('id', flat=True)[:page_size])
+        ProductViewSet._hydrate(ids)
+        return True
+
+    @staticmethod
+    def _send_endpoint(entry):
+        client = Client()
+        response = client.get(reverse('product-search'), {'q': entry['q'], **entry['filters']})
+        return response.status_code == 200
+
+    # Reporting
+
+    @staticmethod
+    def _environment(options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            commit = None
+        return {
+            'commit': commit,
+            'search_backend': settings.SEARCH_BACKEND,
+            'active_products': Product.objects.filter(is_active=True).count(),
+            'postgres': connection.pg_version,
+            'python': platform.python_version(),
+            'mix': os.path.basename(options['mix']),
+            'rounds': options['rounds'],
+            'concurrency': options['concurrency'],
+            'use_cache': options['use_cache'],
+        }
+
+    def _print_result(self, target, result):
+        overall = result['overall']
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{target}: {overall['requests']} requests, {overall['errors']} errors, "
+            f"{overall['throughput_rps']:.1f} req/s"
+        ))
+        self.stdout.write(f"  {'kind':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+        for kind, stats in [*result['kinds'].items(), ('all', overall)]:
+            self.stdout.write(
+                f"  {kind:<12}{stats['requests']:>6}"
+                + ''.join(self._format(stats[name], 10, 2) for name in ('p50_ms', 'p95_ms', 'p99_ms'))
+                + self._format(stats['queries_per_request'], 9, 1)
+            )
+
+    @staticmethod
+    def _format(value, width, digits):
+        return f'{value:>{width}.{digits}f}' if value is not None else f"{'-':>{width}}"
+
+    def _compare(self, baseline, report, max_regression):
+        """Print the change of every compared statistic and return the p95 regressions"""
+        environment = baseline.get('environment', {})
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"Compared with {baseline.get('created_at')} (commit {environment.get('commit')}, "
+            f"{environment.get('active_products')} active products)"
+        ))
+        regressions = []
+        for target, result in report['results'].items():
+            old_result = baseline.get('results', {}).get(target)
+            if old_result is None:
+                continue
+            groups = [('all', result['overall'], old_result['overall'])] + [
+                (kind, stats, old_result['kinds'][kind])
+                for kind, stats in result['kinds'].items() if kind in old_result.get('kinds', {})
+            ]
+            for kind, stats, old_stats in groups:
+                changes = []
+                for name in COMPARED_STATS:
+                    old, new = old_stats.get(name), stats.get(name)
+                    if not old or new is None:
+                        continue
+                    change = (new - old) / old * 100
+                    changes.append(f'{name} {old:.2f} -> {new:.2f} ({change:+.0f}%)')
+                    if name == 'p95_ms' and max_regression is not None and change > max_regression:
+                        regressions.append(f'{target}/{kind} {change:+.0f}%')
+                self.stdout.write(f"  {target}/{kind}: {'; '.join(changes)}")
+        return regressions
@@ -0,0 +1,72 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from products.models import Product
+from products.renderers import FastJSONRenderer
+from products.serializers import EncodedRows, ProductListSerializer, product_list_encoder
+
+
+class Command(BaseCommand):
+    help = ('Compare ProductListSerializer + JSONRenderer with the value tuple path (RowEncoder + '
+            'FastJSONRenderer) for product pages, checking that both produce the same bytes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', type=int, nargs='+', default=[20, 100, 1000],
+                            help='Page sizes to measure (default: 20 100 1000)')
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='Measured renders per page size and path (default: 50)')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be positive')
+        queryset = Product.objects.filter(is_active=True).order_by('name', 'id')
+        self.stdout.write(f"{'page':>6}  {'path':<10}{'fetch ms':>10}{'render ms':>11}{'total ms':>10}{'speedup':>9}")
+        for page_size in options['page_sizes']:
+            ids = list(queryset.values_list('id', flat=True)[:page_size])
+            if len(ids) < page_size:
+                self.stderr.write(f'Only {len(ids)} active products for page size {page_size}')
+            paths = {
+                'serializer': self._serializer_path,
+                'tuples': self._tuple_path,
+            }
+            outputs, timings = {}, {}
+            for name, render_page in paths.items():
+                outputs[name] = render_page(queryset, page_size)[2]
+                samples = [render_page(queryset, page_size) for _ in range(options['iterations'])]
+                timings[name] = (
+                    statistics.median(fetch for fetch, _, _ in samples) * 1000,
+                    statistics.median(render for _, render, _ in samples) * 1000,
+                )
+            if outputs['serializer'] != outputs['tuples']:
+                raise CommandError(f'Output differs at page size {page_size}')
+
+            baseline = sum(timings['serializer'])
+            for name, (fetch, render) in timings.items():
+                self.stdout.write(
+                    f'{page_size:>6}  {name:<10}{fetch:>10.2f}{render:>11.2f}{fetch + render:>10.2f}'
+                    f'{baseline / (fetch + render):>8.1f}x'
+                )
+        self.stdout.write(self.style.SUCCESS('Both paths produced identical bytes.'))
+
+    @staticmethod
+    def _page(data):
+        return {'count': 0, 'next': None, 'previous': None, 'results': data}
+
+    def _serializer_path(self, queryset, page_size):
+        """Model instances with select_related, ProductListSerializer and JSONRenderer"""
+        started = time.perf_counter()
+        products = list(queryset.select_related('brand', 'category')[:page_size])
+        fetched = time.perf_counter()
+        content = JSONRenderer().render(self._page(ProductListSerializer(products, many=True).data))
+        return fetched - started, time.perf_counter() - fetched, content
+
+    def _tuple_path(self, queryset, page_size):
+        """Value tuples of the encoder's columns, EncodedRows and FastJSONRenderer"""
+        started = time.perf_counter()
+        rows = list(queryset.values_list(*product_list_encoder.columns)[:page_size])
+        fetched = time.perf_counter()
+        content = FastJSONRenderer().render(self._page(EncodedRows(product_list_encoder, rows)))
+        return fetched - started, time.perf_counter() - fetched, content
@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+
+from products.cache import bump_generation
+from products.models import Product
+from products.related import refresh_related, stale_product_ids
+
+
+class Command(BaseCommand):
+    help = 'Fill the related products table in parallel, id-range batches (see products.related)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of ids covered by one batch (default: 1000)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of parallel database connections (default: 4)')
+        parser.add_argument('--full', action='store_true',
+                            help='Recompute every product, not only those changed since their last refresh')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        workers = options['workers']
+        if batch_size < 1 or workers < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+
+        bounds = Product.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No products.')
+            return
+
+        ranges = [
+            (start, start + batch_size)
+            for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size)
+        ]
+        self._full = options['full']
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = len(ranges)
+        started = time.monotonic()
+
+        if workers == 1:
+            refreshed, written = self._refresh_ranges(ranges)
+        else:
+            # The scoring runs in Postgres, so each worker only needs its own connection
+            slices = [ranges[i::workers] for i in range(workers)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                counts = list(executor.map(self._refresh_in_thread, slices))
+            refreshed, written = sum(count[0] for count in counts), sum(count[1] for count in counts)
+
+        if refreshed:
+            # Cached related responses and their ETags are of the previous lists
+            bump_generation()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed {refreshed} products ({written} related products) in {self._total} batches ({elapsed:.1f}s).'
+        ))
+
+    def _refresh_in_thread(self, ranges):
+        try:
+            return self._refresh_ranges(ranges)
+        finally:
+            connection.close()
+
+    def _refresh_ranges(self, ranges):
+        """Refresh one range per transaction, so readers see each product's old or new list, never none."""
+        refreshed = written = 0
+        for start, end in ranges:
+            if self._full:
+                ids = list(Product.objects.filter(id__gte=start, id__lt=end).values_list('id', flat=True))
+            else:
+                ids = stale_product_ids(start, end)
+            written += refresh_related(ids)
+            refreshed += len(ids)
+            with self._lock:
+                self._done += 1
+                if self.verbosity >= 2:
+                    self.stdout.write(f'  batch {self._done}/{self._total}: ids [{start}, {end}), {len(ids)} refreshed')
+        return refreshed, written
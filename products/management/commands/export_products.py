@@ -0,0 +1,83 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.export import EXPORT_FORMATS, EXPORT_ORDERINGS, ProductExporter
+
+
+class Command(BaseCommand):
+    help = ('Export products as NDJSON or CSV with brand, category and nutrition facts inline, '
+            'streamed through a server-side cursor')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o',
+                            help='File to write, gzipped when it ends in .gz (default: standard output)')
+        parser.add_argument('--format', choices=EXPORT_FORMATS,
+                            help='Output format (default: from the file extension, else ndjson)')
+        parser.add_argument('--query', '-q', default='',
+                            help='Export the results of this search, in rank order')
+        parser.add_argument('--category', type=int, help='Category id filter')
+        parser.add_argument('--brand', type=int, help='Brand id filter')
+        parser.add_argument('--min-price', help='Minimum price filter')
+        parser.add_argument('--max-price', help='Maximum price filter')
+        parser.add_argument('--ordering', default='name',
+                            choices=[prefix + field for field in EXPORT_ORDERINGS for prefix in ('', '-')],
+                            help='Order of an export without --query (default: name)')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Rows per cursor fetch and write (default: EXPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        path = options['output']
+        export_format = options['format'] or self._format_of(path)
+        exporter = ProductExporter(options['chunk_size'])
+        rows = exporter.rows(
+            options['query'],
+            ordering=options['ordering'],
+            category=options['category'],
+            brand=options['brand'],
+            min_price=options['min_price'],
+            max_price=options['max_price'],
+        )
+        counted = _Counter(rows)
+
+        started = time.monotonic()
+        if path:
+            try:
+                output = gzip.open(path, 'wt', encoding='utf-8', newline='') if path.endswith('.gz') \
+                    else open(path, 'w', encoding='utf-8', newline='')
+            except OSError as exc:
+                raise CommandError(f'Cannot write {path}: {exc}')
+            with output:
+                for piece in exporter.write(export_format, counted):
+                    output.write(piece)
+        else:
+            for piece in exporter.write(export_format, counted):
+                self.stdout.write(piece, ending='')
+        elapsed = time.monotonic() - started
+        # Progress goes to stderr, stdout may be the export itself
+        self.stderr.write(
+            f'Exported {counted.count} products as {export_format} in {elapsed:.1f}s'
+            f'{f" to {path}" if path else ""}.'
+        )
+
+    @staticmethod
+    def _format_of(path):
+        name = (path or '').removesuffix('.gz')
+        return 'csv' if name.endswith('.csv') else 'ndjson'
+
+
+class _Counter:
+    """Iterator passing rows through while counting them"""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows)
+        self.count += 1
+        return row
@@ -0,0 +1,58 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from products.benchmark import generate_products
+
+
+class Command(BaseCommand):
+    help = 'Write a deterministic synthetic catalog for benchmarks, optionally loading it with import_products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000,
+                            help='Number of products, e.g. 10000 to 5000000 (default: 10000)')
+        parser.add_argument('--seed', type=int, default=42,
+                            help='Random seed; the same seed and size give the same catalog (default: 42)')
+        parser.add_argument('--output',
+                            help='JSONL file to write, gzipped when it ends in .gz '
+                                 '(default with --load: a temporary file)')
+        parser.add_argument('--load', action='store_true',
+                            help='Import the catalog with import_products --defer-search-vector')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Passed to import_products, for large initial loads')
+
+    def handle(self, *args, **options):
+        count = options['products']
+        if count < 1:
+            raise CommandError('--products must be positive')
+        path = options['output']
+        if not path and not options['load']:
+            raise CommandError('Pass --output, --load or both')
+        temporary = not path
+        if temporary:
+            handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+            os.close(handle)
+
+        try:
+            started = time.monotonic()
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'wt', encoding='utf-8') as output:
+                for row in generate_products(count, seed=options['seed']):
+                    output.write(json.dumps(row, ensure_ascii=False))
+                    output.write('\n')
+            self.stdout.write(f'Generated {count} products in {time.monotonic() - started:.1f}s')
+            if not temporary:
+                self.stdout.write(f'Written to {path}')
+
+            if options['load']:
+                call_command('import_products', path, defer_search_vector=True,
+                             defer_indexes=options['defer_indexes'],
+                             verbosity=options['verbosity'], stdout=self.stdout)
+        finally:
+            if temporary:
+                os.remove(path)
@@ -0,0 +1,364 @@
+import csv
+import gzip
+import io
+import json
+import os
+import time
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from products.cache import bump_generation
+from products.models import Brand, Category, Product, SearchDocument
+from products.spelling import add_terms
+
+NUTRITION_FIELDS = ('calories', 'protein', 'carbohydrates', 'fat', 'sugar', 'sodium')
+STAGING_COLUMNS = (
+    'sku', 'name', 'name_ar', 'description', 'description_ar', 'price',
+    'brand_id', 'category_id', 'is_active',
+) + NUTRITION_FIELDS
+# Columns compared to tell an updated product from an unchanged one
+COMPARED_COLUMNS = (
+    'name', 'name_ar', 'description', 'description_ar', 'price', 'brand_id', 'category_id', 'is_active',
+)
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'f', 'no', 'n'}
+MAX_PRICE = Decimal('1e8')  # price is numeric(10, 2)
+
+# Rows of the current batch, private to this connection
+CREATE_STAGING_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS products_import_staging (
+    sku varchar(100) PRIMARY KEY,
+    name varchar(255) NOT NULL,
+    name_ar varchar(255),
+    description text,
+    description_ar text,
+    price numeric(10, 2) NOT NULL,
+    brand_id bigint NOT NULL,
+    category_id bigint NOT NULL,
+    is_active boolean NOT NULL,
+    calories double precision,
+    protein double precision,
+    carbohydrates double precision,
+    fat double precision,
+    sugar double precision,
+    sodium double precision,
+    nutrition_id bigint
+)
+"""
+
+COPY_SQL = f"COPY products_import_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN"
+
+HAS_NUTRITION = f"num_nonnulls({', '.join(f's.{field}' for field in NUTRITION_FIELDS)}) > 0"
+
+# Products that already have nutrition facts get them updated in place
+UPDATE_NUTRITION_SQL = f"""
+UPDATE products_nutritionfact n
+SET {', '.join(f'{field} = s.{field}' for field in NUTRITION_FIELDS)}
+FROM products_import_staging s
+JOIN products_product p ON p.sku = s.sku
+WHERE n.id = p.nutrition_facts_id
+  AND {HAS_NUTRITION}
+  AND ({', '.join(f'n.{field}' for field in NUTRITION_FIELDS)})
+      IS DISTINCT FROM ({', '.join(f's.{field}' for field in NUTRITION_FIELDS)})
+"""
+
+# New nutrition facts get their ids up front so products can reference them
+RESERVE_NUTRITION_IDS_SQL = f"""
+UPDATE products_import_staging s
+SET nutrition_id = nextval(pg_get_serial_sequence('products_nutritionfact', 'id'))
+WHERE {HAS_NUTRITION}
+  AND NOT EXISTS (
+      SELECT 1 FROM products_product p
+      WHERE p.sku = s.sku AND p.nutrition_facts_id IS NOT NULL
+  )
+"""
+
+INSERT_NUTRITION_SQL = f"""
+INSERT INTO products_nutritionfact (id, {', '.join(NUTRITION_FIELDS)})
+SELECT nutrition_id, {', '.join(NUTRITION_FIELDS)}
+FROM products_import_staging
+WHERE nutrition_id IS NOT NULL
+"""
+
+# Unchanged rows are skipped so they keep their updated_at and search_vector
+UPSERT_SQL = f"""
+INSERT INTO products_product AS p (
+    {', '.join(COMPARED_COLUMNS)}, sku, nutrition_facts_id, created_at, updated_at
+)
+SELECT {', '.join(COMPARED_COLUMNS)}, sku, nutrition_id, now(), now()
+FROM products_import_staging
+ON CONFLICT (sku) DO UPDATE SET
+    {', '.join(f'{column} = EXCLUDED.{column}' for column in COMPARED_COLUMNS)},
+    nutrition_facts_id = COALESCE(EXCLUDED.nutrition_facts_id, p.nutrition_facts_id),
+    updated_at = EXCLUDED.updated_at
+WHERE ({', '.join(f'p.{column}' for column in COMPARED_COLUMNS)})
+      IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in COMPARED_COLUMNS)})
+   OR EXCLUDED.nutrition_facts_id IS NOT NULL
+RETURNING xmax = 0
+"""
+
+
+def _copy_value(value):
+    """Encode one value for COPY's text format"""
+    if value is None:
+        return '\\N'
+    return (
+        str(value).replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r')
+    )
+
+
+class Command(BaseCommand):
+    help = 'Import products from a CSV or JSONL file through COPY and an upsert on sku'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file, optionally gzipped (.gz)')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Input format (default: from the file extension)')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Rows loaded and committed per batch (default: 10000)')
+        parser.add_argument('--rejects',
+                            help='Write rejected rows to this JSONL file with line number and reason')
+        parser.add_argument('--defer-search-vector', action='store_true',
+                            help='Skip the search_vector trigger while loading and index all '
+                                 'changed products at the end')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drop the secondary product and search document indexes while loading '
+                                 'and rebuild them at the end (for initial loads; search is slow meanwhile)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Parallel connections for the deferred search_vector backfill (default: 4)')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+        file_format = options['format'] or self._detect_format(path)
+
+        self.name_max_lengths = {
+            Brand: Brand._meta.get_field('name').max_length,
+            Category: Category._meta.get_field('name').max_length,
+        }
+        self.related_ids = {Brand: {}, Category: {}}
+        self.counts = {'read': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0}
+        self.rejects = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        self.started = time.monotonic()
+
+        deferred_indexes = [
+            (model, index) for model in (Product, SearchDocument) for index in model._meta.indexes
+        ] if options['defer_indexes'] else []
+        with connection.cursor() as cursor:
+            # Products written from here on are stamped later (updated_at, clock_timestamp())
+            cursor.execute('SELECT clock_timestamp()')
+            since, = cursor.fetchone()
+            cursor.execute(CREATE_STAGING_SQL)
+            if options['defer_search_vector']:
+                cursor.execute("SET products.defer_search_vector = 'on'")
+        try:
+            if deferred_indexes:
+                with connection.schema_editor() as editor:
+                    for model, index in deferred_indexes:
+                        editor.remove_index(model, index)
+                self.stdout.write(f'Dropped {len(deferred_indexes)} indexes until the import finishes.')
+            self._import(self._read(path, file_format), batch_size)
+        finally:
+            if self.rejects:
+                self.rejects.close()
+            if options['defer_search_vector']:
+                with connection.cursor() as cursor:
+                    cursor.execute('RESET products.defer_search_vector')
+                # Changed rows were stored with a NULL search_vector
+                call_command('reindex_search', only_missing=True, workers=options['workers'],
+                             verbosity=self.verbosity, stdout=self.stdout)
+            if deferred_indexes:
+                self.stdout.write(f'Rebuilding {len(deferred_indexes)} indexes...')
+                with connection.schema_editor() as editor:
+                    for model, index in deferred_indexes:
+                        editor.add_index(model, index)
+            # New words only; the refresh_search_terms schedule recounts the rest
+            added = add_terms(since)
+            if added:
+                self.stdout.write(f'Added {added} new words to the spelling dictionary.')
+            # Bulk SQL bypasses model signals, so invalidate cached searches here
+            bump_generation()
+
+        elapsed = time.monotonic() - self.started
+        counts = self.counts
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['read']} rows in {elapsed:.1f}s "
+            f"({counts['read'] / elapsed if elapsed else 0:.0f} rows/s): "
+            f"{counts['inserted']} inserted, {counts['updated']} updated, "
+            f"{counts['unchanged']} unchanged, {counts['rejected']} rejected."
+        ))
+        if counts['rejected'] and options['rejects']:
+            self.stdout.write(f"Rejected rows written to {options['rejects']}")
+
+    # Reading
+
+    @staticmethod
+    def _detect_format(path):
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith('.csv'):
+            return 'csv'
+        if name.endswith(('.jsonl', '.ndjson')):
+            return 'jsonl'
+        raise CommandError('Cannot tell the format from the file name, pass --format')
+
+    def _read(self, path, file_format):
+        """Yield (line number, raw row, error) without loading the whole file"""
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8', newline='') as handle:
+            if file_format == 'csv':
+                reader = csv.DictReader(handle)
+                for row in reader:
+                    yield reader.line_num, row, None
+            else:
+                for line_number, line in enumerate(handle, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                    except ValueError as exc:
+                        yield line_number, line.rstrip('\n'), f'invalid JSON: {exc}'
+                        continue
+                    if not isinstance(row, dict):
+                        yield line_number, row, 'expected a JSON object'
+                        continue
+                    yield line_number, row, None
+
+    # Loading
+
+    def _import(self, rows, batch_size):
+        batch = {}
+        for line_number, raw, error in rows:
+            self.counts['read'] += 1
+            try:
+                if error:
+                    raise ValueError(error)
+                row = self._clean(raw)
+            except ValueError as exc:
+                self._reject(line_number, raw, str(exc))
+                continue
+            # A sku repeated within a batch can only be upserted once; the last row wins
+            batch.pop(row['sku'], None)
+            batch[row['sku']] = row
+            if len(batch) >= batch_size:
+                self._load_batch(list(batch.values()))
+                batch.clear()
+        if batch:
+            self._load_batch(list(batch.values()))
+
+    def _clean(self, raw):
+        """Validate one input row, raising ValueError with the reason for rejecting it"""
+        if isinstance(raw.get('nutrition_facts'), dict):
+            # JSONL rows may nest nutrition facts, CSV rows have flat columns
+            raw = {**raw, **raw['nutrition_facts']}
+        row = {}
+        for name in ('sku', 'name', 'name_ar', 'description', 'description_ar'):
+            value = raw.get(name)
+            value = str(value).strip() if value is not None else ''
+            if '\x00' in value:
+                raise ValueError(f'{name} contains a NUL character')
+            max_length = Product._meta.get_field(name).max_length
+            if max_length and len(value) > max_length:
+                raise ValueError(f'{name} is longer than {max_length} characters')
+            row[name] = value or None
+        for name in ('sku', 'name'):
+            if row[name] is None:
+                raise ValueError(f'{name} is required')
+
+        try:
+            price = Decimal(str(raw.get('price', '')).strip()).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        except InvalidOperation:
+            raise ValueError('price is not a number')
+        if not price.is_finite() or price < 0 or price >= MAX_PRICE:
+            raise ValueError('price is out of range')
+        row['price'] = price
+
+        for model, name in ((Brand, 'brand'), (Category, 'category')):
+            value = str(raw.get(name) or '').strip()
+            if not value:
+                raise ValueError(f'{name} is required')
+            if len(value) > self.name_max_lengths[model]:
+                raise ValueError(f'{name} is longer than {self.name_max_lengths[model]} characters')
+            row[name] = value
+
+        is_active = str(raw.get('is_active', '')).strip().lower()
+        if is_active in ('', 'none'):
+            row['is_active'] = True
+        elif is_active in TRUE_VALUES or is_active in FALSE_VALUES:
+            row['is_active'] = is_active in TRUE_VALUES
+        else:
+            raise ValueError('is_active is not a boolean')
+
+        for name in NUTRITION_FIELDS:
+            value = raw.get(name)
+            if value is None or str(value).strip() == '':
+                row[name] = None
+                continue
+            try:
+                row[name] = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{name} is not a number')
+        return row
+
+    def _resolve(self, model, names):
+        """Map names to ids, creating the missing rows in one INSERT"""
+        ids = self.related_ids[model]
+        missing = set(names) - ids.keys()
+        if missing:
+            # Names are not unique; reuse the oldest row with that name
+            for name, pk in model.objects.filter(name__in=missing).order_by('-id').values_list('name', 'id'):
+                ids[name] = pk
+            created = model.objects.bulk_create([model(name=name) for name in sorted(missing - ids.keys())])
+            for instance in created:
+                ids[instance.name] = instance.pk
+        return ids
+
+    def _load_batch(self, rows):
+        with transaction.atomic():
+            brand_ids = self._resolve(Brand, {row['brand'] for row in rows})
+            category_ids = self._resolve(Category, {row['category'] for row in rows})
+            buffer = io.StringIO()
+            for row in rows:
+                row['brand_id'] = brand_ids[row['brand']]
+                row['category_id'] = category_ids[row['category']]
+                buffer.write('\t'.join(_copy_value(row[column]) for column in STAGING_COLUMNS))
+                buffer.write('\n')
+            buffer.seek(0)
+
+            with connection.cursor() as cursor:
+                cursor.execute('TRUNCATE products_import_staging')
+                cursor.copy_expert(COPY_SQL, buffer)
+                # Temporary tables are never auto-analyzed; give the planner row counts
+                cursor.execute('ANALYZE products_import_staging')
+                cursor.execute(UPDATE_NUTRITION_SQL)
+                cursor.execute(RESERVE_NUTRITION_IDS_SQL)
+                cursor.execute(INSERT_NUTRITION_SQL)
+                cursor.execute(UPSERT_SQL)
+                inserted = [row[0] for row in cursor.fetchall()]
+
+        self.counts['inserted'] += sum(inserted)
+        self.counts['updated'] += len(inserted) - sum(inserted)
+        self.counts['unchanged'] += len(rows) - len(inserted)
+        if self.verbosity >= 1:
+            elapsed = time.monotonic() - self.started
+            self.stdout.write(
+                f"  {self.counts['read']} rows read, {self.counts['rejected']} rejected "
+                f"({self.counts['read'] / elapsed if elapsed else 0:.0f} rows/s)"
+            )
+
+    def _reject(self, line_number, raw, reason):
+        self.counts['rejected'] += 1
+        if self.rejects:
+            self.rejects.write(json.dumps({'line': line_number, 'error': reason, 'row': raw},
+                                          ensure_ascii=False, default=str))
+            self.rejects.write('\n')
+        elif self.verbosity >= 2:
+            self.stderr.write(f'  line {line_number}: {reason}')
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.spelling import refresh_terms
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the spelling correction dictionary from the active search documents'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        written, removed = refresh_terms()
+        if options['verbosity']:
+            self.stdout.write(self.style.SUCCESS(
+                f'Refreshed the spelling dictionary in {time.monotonic() - started:.1f}s: '
+                f'{written} terms written, {removed} removed.'
+            ))
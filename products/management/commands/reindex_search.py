@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+
+from products.models import Product
+
+REINDEX_SQL = """
+UPDATE products_product p
+SET search_vector = products_product_search_vector(p)
+WHERE p.id >= %s AND p.id < %s
+"""
+
+
+class Command(BaseCommand):
+    help = 'Backfill Product.search_vector in parallel, id-range batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of ids covered by one UPDATE (default: 5000)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of parallel database connections (default: 4)')
+        parser.add_argument('--only-missing', action='store_true',
+                            help='Only index products whose search_vector is NULL')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        batch_size = options['batch_size']
+        workers = options['workers']
+        if batch_size < 1 or workers < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+
+        bounds = Product.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No products to index.')
+            return
+
+        sql = REINDEX_SQL
+        if options['only_missing']:
+            sql += ' AND p.search_vector IS NULL'
+        else:
+            # Skip rows that are already up to date to avoid needless writes
+            sql += ' AND p.search_vector IS DISTINCT FROM products_product_search_vector(p)'
+
+        ranges = [
+            (start, start + batch_size)
+            for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size)
+        ]
+        self._sql = sql
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = len(ranges)
+        started = time.monotonic()
+
+        if workers == 1:
+            updated = self._reindex_ranges(ranges)
+        else:
+            # Each worker owns an interleaved slice of the ranges and its own connection
+            slices = [ranges[i::workers] for i in range(workers)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                updated = sum(executor.map(self._reindex_in_thread, slices))
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Reindexed {updated} products in {self._total} batches ({elapsed:.1f}s).'
+        ))
+
+    def _reindex_in_thread(self, ranges):
+        try:
+            return self._reindex_ranges(ranges)
+        finally:
+            connection.close()
+
+    def _reindex_ranges(self, ranges):
+        """Run one short autocommitted UPDATE per range so row locks are held briefly."""
+        updated = 0
+        for start, end in ranges:
+            with connection.cursor() as cursor:
+                cursor.execute(self._sql, [start, end])
+                updated += cursor.rowcount
+            with self._lock:
+                self._done += 1
+                if self.verbosity >= 2:
+                    self.stdout.write(f'  batch {self._done}/{self._total}: ids [{start}, {end})')
+        return updated
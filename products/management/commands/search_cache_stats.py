@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.cache import SearchResultCache, get_generation
+
+
+class Command(BaseCommand):
+    help = 'Show hit and miss counts of the search result cache'
+
+    def handle(self, *args, **options):
+        stats = SearchResultCache().stats()
+        self.stdout.write(f"Generation: {get_generation()}")
+        self.stdout.write(f"Hits:       {stats['hits']}")
+        self.stdout.write(f"Misses:     {stats['misses']}")
+        self.stdout.write(f"Hit ratio:  {stats['hit_ratio']:.2%}")
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.engine import SearchEngine
+
+
+class Command(BaseCommand):
+    help = 'Build the in-memory search engine from the database and report its memory footprint'
+
+    def handle(self, *args, **options):
+        engine = SearchEngine()
+        started = time.monotonic()
+        engine.build()
+        elapsed = time.monotonic() - started
+
+        report = engine.memory_report()
+        self.stdout.write(f'Built in {elapsed:.2f}s')
+        for name, value in report.items():
+            if name.endswith('_bytes'):
+                value = f'{value / (1024 * 1024):.2f} MiB'
+            self.stdout.write(f'{name:<26}{value}')
@@ -0,0 +1,252 @@
+"""
+Per-request instrumentation.
+
+RequestMetricsMiddleware counts and times the SQL statements of every
+request (through an execute wrapper installed on each connection) and
+collects the time spent in named phases: `timed('search')` in
+ProductSearchService.search, the pagination COUNT, the ranked page query,
+serialization, rendering and throttling. Phase times are exclusive, a
+phase nested in another is not counted twice. The result is sent as a
+`Server-Timing` header, added to per-endpoint latency histograms served by
+/api/metrics/ and, for searches slower than SLOW_SEARCH_THRESHOLD_MS,
+written to the `products.slow_search` log.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+
+slow_search_logger = logging.getLogger('products.slow_search')
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Timings of one request; calling it runs and times one SQL statement"""
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        # Exclusive seconds per phase, in the order the phases first ran
+        self.phases = {}
+        self._children = []
+        # Set by the search view: normalized query, filters and cache status
+        self.search = None
+        # Ranked queryset of a search that ran, for the sampled EXPLAIN
+        self.explain_queryset = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += time.perf_counter() - started
+
+    @contextmanager
+    def timed(self, phase):
+        started = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.add(phase, elapsed - self._children.pop())
+            if self._children:
+                self._children[-1] += elapsed
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total):
+        metrics = [f'sql;dur={self.sql_time * 1000:.1f};desc="{self.sql_count} queries"']
+        metrics += [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in self.phases.items()]
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+def current_metrics():
+    """RequestMetrics of the request being handled, or None outside of requests"""
+    return _current.get()
+
+
+@contextmanager
+def timed(phase):
+    """Time a phase of the current request; a no-op outside of requests"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.timed(phase):
+        yield
+
+
+def count_sql(execute, sql, params, many, context):
+    """Execute wrapper of every connection, counting statements for the current request"""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def install_sql_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver adding count_sql to each connection, so SQL
+    is counted on whichever thread runs it (sync views under ASGI run on
+    executor threads, see async_views).
+    """
+    if count_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_sql)
+
+
+class LatencyHistograms:
+    """Request latency histograms per endpoint, kept per worker process"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.since = datetime.now(timezone.utc)
+
+    def observe(self, endpoint, seconds, metrics):
+        milliseconds = seconds * 1000
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None:
+                entry = self.endpoints[endpoint] = {
+                    'count': 0, 'sum_ms': 0.0, 'sql_queries': 0, 'sql_ms': 0.0,
+                    'counts': [0] * (len(self.buckets) + 1), 'phases_ms': {},
+                }
+            entry['count'] += 1
+            entry['sum_ms'] += milliseconds
+            entry['sql_queries'] += metrics.sql_count
+            entry['sql_ms'] += metrics.sql_time * 1000
+            # Buckets are upper bounds (le), the last one is +Inf
+            entry['counts'][bisect_left(self.buckets, milliseconds)] += 1
+            for phase, phase_seconds in metrics.phases.items():
+                entry['phases_ms'][phase] = entry['phases_ms'].get(phase, 0.0) + phase_seconds * 1000
+
+    def snapshot(self):
+        """Cumulative histograms and totals; divide by `count` for means"""
+        with self.lock:
+            endpoints = {}
+            for endpoint, entry in sorted(self.endpoints.items()):
+                cumulative, buckets = 0, []
+                for bound, count in zip(self.buckets + ('+Inf',), entry['counts']):
+                    cumulative += count
+                    buckets.append({'le': bound, 'count': cumulative})
+                endpoints[endpoint] = {
+                    'count': entry['count'],
+                    'sum_ms': round(entry['sum_ms'], 3),
+                    'mean_ms': round(entry['sum_ms'] / entry['count'], 3),
+                    'buckets': buckets,
+                    'sql_queries': entry['sql_queries'],
+                    'sql_ms': round(entry['sql_ms'], 3),
+                    'phases_ms': {phase: round(value, 3) for phase, value in entry['phases_ms'].items()},
+                }
+            return {'pid': os.getpid(), 'since': self.since.isoformat(timespec='seconds'), 'endpoints': endpoints}
+
+
+_histograms = None
+_histograms_lock = threading.Lock()
+
+
+def get_histograms():
+    global _histograms
+    if _histograms is None:
+        with _histograms_lock:
+            if _histograms is None:
+                _histograms = LatencyHistograms(settings.METRICS_LATENCY_BUCKETS_MS)
+    return _histograms
+
+
+def log_slow_search(metrics, total):
+    """Write a slow search to the log, with an EXPLAIN (ANALYZE, BUFFERS) plan for a sample of them"""
+    record = {
+        **metrics.search,
+        'duration_ms': round(total * 1000, 1),
+        'sql_queries': metrics.sql_count,
+        'sql_ms': round(metrics.sql_time * 1000, 1),
+        'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in metrics.phases.items()},
+    }
+    queryset = metrics.explain_queryset
+    if queryset is not None and random.random() < settings.SLOW_SEARCH_EXPLAIN_SAMPLE_RATE:
+        # ANALYZE runs the ranking query a second time, hence the sampling
+        try:
+            record['plan'] = queryset.explain(analyze=True, buffers=True)
+        except DatabaseError as exc:
+            record['plan_error'] = str(exc)
+    slow_search_logger.warning('Slow search: %s', json.dumps(record, ensure_ascii=False, default=str))
+
+
+class RequestMetricsMiddleware:
+    """Collect RequestMetrics for every request; install it first in MIDDLEWARE"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - started
+        if self._finish(request, response, metrics, total):
+            log_slow_search(metrics, total)
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - started
+        if self._finish(request, response, metrics, total):
+            # The sampled EXPLAIN queries the database
+            await sync_to_async(log_slow_search)(metrics, total)
+        return response
+
+    @staticmethod
+    def _finish(request, response, metrics, total):
+        """Record the request; return whether it goes to the slow search log"""
+        match = request.resolver_match
+        get_histograms().observe(match.view_name if match else 'unmatched', total, metrics)
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing(total)
+        return metrics.search is not None and total * 1000 >= settings.SLOW_SEARCH_THRESHOLD_MS
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns; time that too
+        metrics = _current.get()
+        if metrics is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: metrics.add('render', time.perf_counter() - started)
+            )
+        return response
@@ -0,0 +1,104 @@
+from django.db import migrations
+
+# Builds the weighted document for one product row. Names are weighted
+# highest, brand and category names next, descriptions last. English text
+# goes through the english config and Arabic text through the arabic one.
+SEARCH_VECTOR_FUNCTION = """
+CREATE OR REPLACE FUNCTION products_product_search_vector(p products_product)
+RETURNS tsvector
+LANGUAGE sql STABLE
+AS $$
+    SELECT
+        setweight(to_tsvector('english', coalesce(p.name, '')), 'A') ||
+        setweight(to_tsvector('arabic', coalesce(p.name_ar, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT b.name FROM products_brand b WHERE b.id = p.brand_id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', coalesce(
+            (SELECT c.name FROM products_category c WHERE c.id = p.category_id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', coalesce(p.description, '')), 'C') ||
+        setweight(to_tsvector('arabic', coalesce(p.description_ar, '')), 'C')
+$$;
+"""
+
+PRODUCT_TRIGGER = """
+CREATE OR REPLACE FUNCTION products_product_search_vector_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.search_vector := products_product_search_vector(NEW);
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER products_product_search_vector_update
+BEFORE INSERT OR UPDATE OF name, name_ar, description, description_ar, brand_id, category_id
+ON products_product
+FOR EACH ROW EXECUTE FUNCTION products_product_search_vector_trigger();
+"""
+
+# Renaming a brand or category changes the document of every product that
+# points at it, so those rows are re-vectorized in the same transaction.
+RELATED_NAME_TRIGGERS = """
+CREATE OR REPLACE FUNCTION products_brand_search_vector_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE products_product p
+    SET search_vector = products_product_search_vector(p)
+    WHERE p.brand_id = NEW.id;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_brand_search_vector_update
+AFTER UPDATE OF name ON products_brand
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION products_brand_search_vector_trigger();
+
+CREATE OR REPLACE FUNCTION products_category_search_vector_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE products_product p
+    SET search_vector = products_product_search_vector(p)
+    WHERE p.category_id = NEW.id;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_category_search_vector_update
+AFTER UPDATE OF name ON products_category
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION products_category_search_vector_trigger();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS products_category_search_vector_update ON products_category;
+DROP FUNCTION IF EXISTS products_category_search_vector_trigger();
+DROP TRIGGER IF EXISTS products_brand_search_vector_update ON products_brand;
+DROP FUNCTION IF EXISTS products_brand_search_vector_trigger();
+DROP TRIGGER IF EXISTS products_product_search_vector_update ON products_product;
+DROP FUNCTION IF EXISTS products_product_search_vector_trigger();
+DROP FUNCTION IF EXISTS products_product_search_vector(products_product);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_enable_pg_trgm'),
+    ]
+
+    # Existing rows are not backfilled here; on large catalogs run
+    # `python manage.py reindex_search` after migrating.
+    operations = [
+        migrations.RunSQL(
+            SEARCH_VECTOR_FUNCTION + PRODUCT_TRIGGER + RELATED_NAME_TRIGGERS,
+            DROP_TRIGGERS,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:03
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Build the index without blocking writes on large tables
+    atomic = False
+
+    dependencies = [
+        ('products', '0005_search_vector_triggers'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='brand',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='brand_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
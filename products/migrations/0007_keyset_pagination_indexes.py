@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the indexes without blocking writes on large tables
+    atomic = False
+
+    dependencies = [
+        ('products', '0006_trigram_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['name', 'id'], name='product_active_name_id'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['price', 'id'], name='product_active_price_id'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['created_at', 'id'], name='product_active_created_id'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# Bulk loads (`import_products --defer-search-vector`) set
+# products.defer_search_vector = on for their own session and index the
+# loaded rows once at the end; every other session keeps the trigger.
+DEFERRABLE_PRODUCT_TRIGGER = """
+CREATE OR REPLACE FUNCTION products_product_search_vector_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF current_setting('products.defer_search_vector', true) = 'on' THEN
+        NEW.search_vector := NULL;
+    ELSE
+        NEW.search_vector := products_product_search_vector(NEW);
+    END IF;
+    RETURN NEW;
+END;
+$$;
+"""
+
+PRODUCT_TRIGGER = """
+CREATE OR REPLACE FUNCTION products_product_search_vector_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.search_vector := products_product_search_vector(NEW);
+    RETURN NEW;
+END;
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DEFERRABLE_PRODUCT_TRIGGER, PRODUCT_TRIGGER),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:50
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0008_defer_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('name_ar', models.CharField(blank=True, max_length=255, null=True)),
+                ('sku', models.CharField(max_length=100)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('brand_id', models.BigIntegerField()),
+                ('brand_name', models.CharField(max_length=100)),
+                ('category_id', models.BigIntegerField()),
+                ('category_name', models.CharField(max_length=100)),
+                ('is_active', models.BooleanField(default=True)),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True)),
+            ],
+            options={
+                'ordering': ['name'],
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='search_document_vector'), django.contrib.postgres.indexes.GinIndex(fields=['name'], name='search_document_name_trgm', opclasses=['gin_trgm_ops']), models.Index(condition=models.Q(('is_active', True)), fields=['brand_id'], name='search_document_active_brand'), models.Index(condition=models.Q(('is_active', True)), fields=['category_id'], name='search_document_active_cat')],
+            },
+        ),
+    ]
@@ -0,0 +1,145 @@
+from django.db import migrations
+
+DOCUMENT_COLUMNS = [
+    'id', 'name', 'name_ar', 'sku', 'price', 'brand_id', 'brand_name',
+    'category_id', 'category_name', 'is_active', 'search_vector',
+]
+# Product columns copied into the document; a change to any of them rewrites it
+PRODUCT_COLUMNS = ['name', 'name_ar', 'sku', 'price', 'brand_id', 'category_id', 'is_active', 'search_vector']
+CHANGED_ROWS = (
+    f"WHERE ({', '.join(f'o.{column}' for column in PRODUCT_COLUMNS)}) "
+    f"IS DISTINCT FROM ({', '.join(f'p.{column}' for column in PRODUCT_COLUMNS)})"
+)
+
+
+def upsert_documents(source, where=''):
+    """INSERT ... ON CONFLICT writing the documents of the product rows in `source` (alias p)"""
+    return f"""
+    INSERT INTO products_searchdocument ({', '.join(DOCUMENT_COLUMNS)})
+    SELECT p.id, p.name, p.name_ar, p.sku, p.price, p.brand_id, b.name,
+           p.category_id, c.name, p.is_active, p.search_vector
+    FROM {source}
+    JOIN products_brand b ON b.id = p.brand_id
+    JOIN products_category c ON c.id = p.category_id
+    {where}
+    ON CONFLICT (id) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in DOCUMENT_COLUMNS[1:])}
+    """
+
+
+# Statement-level triggers read the changed rows from transition tables, so
+# a bulk upsert (import_products) or backfill (reindex_search) writes the
+# documents with one set-based statement instead of one per row. The
+# search_vector is already final here: it is set by a BEFORE trigger, or by
+# the UPDATE that reindex_search runs after a deferred load.
+PRODUCT_TRIGGERS = f"""
+CREATE OR REPLACE FUNCTION products_product_search_document_insert()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    {upsert_documents('new_rows p')};
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_product_search_document_insert
+AFTER INSERT ON products_product
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION products_product_search_document_insert();
+
+CREATE OR REPLACE FUNCTION products_product_search_document_update()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    {upsert_documents('new_rows p JOIN old_rows o ON o.id = p.id', CHANGED_ROWS)};
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_product_search_document_update
+AFTER UPDATE ON products_product
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION products_product_search_document_update();
+
+CREATE OR REPLACE FUNCTION products_product_search_document_delete()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    DELETE FROM products_searchdocument d USING old_rows o WHERE d.id = o.id;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_product_search_document_delete
+AFTER DELETE ON products_product
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION products_product_search_document_delete();
+"""
+
+# A rename re-vectorizes the products (0005), but the name is copied even
+# when the vector stays the same, e.g. for a change of case.
+RELATED_NAME_TRIGGERS = """
+CREATE OR REPLACE FUNCTION products_brand_search_document_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE products_searchdocument SET brand_name = NEW.name
+    WHERE brand_id = NEW.id AND brand_name IS DISTINCT FROM NEW.name;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_brand_search_document_update
+AFTER UPDATE OF name ON products_brand
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION products_brand_search_document_trigger();
+
+CREATE OR REPLACE FUNCTION products_category_search_document_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE products_searchdocument SET category_name = NEW.name
+    WHERE category_id = NEW.id AND category_name IS DISTINCT FROM NEW.name;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_category_search_document_update
+AFTER UPDATE OF name ON products_category
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION products_category_search_document_trigger();
+"""
+
+# Existing products are copied afterwards in short keyset batches by the
+# backfill_search_documents command; copying the whole catalog here would
+# hold the lock these triggers take on products_product until it is done.
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS products_category_search_document_update ON products_category;
+DROP FUNCTION IF EXISTS products_category_search_document_trigger();
+DROP TRIGGER IF EXISTS products_brand_search_document_update ON products_brand;
+DROP FUNCTION IF EXISTS products_brand_search_document_trigger();
+DROP TRIGGER IF EXISTS products_product_search_document_delete ON products_product;
+DROP FUNCTION IF EXISTS products_product_search_document_delete();
+DROP TRIGGER IF EXISTS products_product_search_document_update ON products_product;
+DROP FUNCTION IF EXISTS products_product_search_document_update();
+DROP TRIGGER IF EXISTS products_product_search_document_insert ON products_product;
+DROP FUNCTION IF EXISTS products_product_search_document_insert();
+DELETE FROM products_searchdocument;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0009_search_document'),
+    ]
+
+    operations = [
+        migrations.RunSQL(PRODUCT_TRIGGERS + RELATED_NAME_TRIGGERS, DROP_TRIGGERS),
+    ]
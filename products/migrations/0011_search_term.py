@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:05
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_search_document_triggers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('term', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('frequency', models.IntegerField()),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['term'], name='search_term_trgm', opclasses=['gin_trgm_ops']), models.Index(fields=['term'], name='search_term_prefix', opclasses=['varchar_pattern_ops'])],
+            },
+        ),
+    ]
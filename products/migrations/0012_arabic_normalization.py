@@ -0,0 +1,95 @@
+import importlib
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+search_vector_triggers = importlib.import_module('products.migrations.0005_search_vector_triggers')
+
+# Same mapping as products.arabic.normalize_arabic: alef forms, taa marbuta,
+# alef maqsura and hamza seats become the bare letter, Arabic-Indic and
+# extended digits become 0-9, and translate() drops the characters of the
+# first string that have no counterpart in the second: tatweel, tashkeel
+# (U+064B-U+065F) and superscript alef.
+VARIANTS = '\u0623\u0625\u0622\u0671\u0629\u0649\u0624\u0626' + ''.join(chr(0x0660 + digit) for digit in range(10)) \
+    + ''.join(chr(0x06F0 + digit) for digit in range(10))
+NORMALIZED = '\u0627\u0627\u0627\u0627\u0647\u064A\u0648\u064A' + '0123456789' * 2
+REMOVED = '\u0640' + ''.join(chr(code) for code in range(0x064B, 0x0660)) + '\u0670'
+
+# IMMUTABLE, so it can define index expressions
+NORMALIZE_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION products_normalize_arabic(text)
+RETURNS text
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+RETURN translate($1, '{VARIANTS + REMOVED}', '{NORMALIZED}');
+"""
+
+# 0005's document with every text normalized before it is parsed
+SEARCH_VECTOR_FUNCTION = """
+CREATE OR REPLACE FUNCTION products_product_search_vector(p products_product)
+RETURNS tsvector
+LANGUAGE sql STABLE
+AS $$
+    SELECT
+        setweight(to_tsvector('english', products_normalize_arabic(coalesce(p.name, ''))), 'A') ||
+        setweight(to_tsvector('arabic', products_normalize_arabic(coalesce(p.name_ar, ''))), 'A') ||
+        setweight(to_tsvector('english', products_normalize_arabic(coalesce(
+            (SELECT b.name FROM products_brand b WHERE b.id = p.brand_id), ''
+        ))), 'B') ||
+        setweight(to_tsvector('english', products_normalize_arabic(coalesce(
+            (SELECT c.name FROM products_category c WHERE c.id = p.category_id), ''
+        ))), 'B') ||
+        setweight(to_tsvector('english', products_normalize_arabic(coalesce(p.description, ''))), 'C') ||
+        setweight(to_tsvector('arabic', products_normalize_arabic(coalesce(p.description_ar, ''))), 'C')
+$$;
+"""
+
+# A stored generated column would rewrite products_searchdocument under an
+# ACCESS EXCLUSIVE lock. The column is added empty instead (no rewrite), kept
+# by this trigger for written documents, and existing documents are filled
+# in short batches by `python manage.py backfill_search_documents`.
+NAME_AR_TRIGGER = """
+CREATE OR REPLACE FUNCTION products_searchdocument_name_ar_normalized()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.name_ar_normalized := products_normalize_arabic(NEW.name_ar);
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER products_searchdocument_name_ar_normalized
+BEFORE INSERT OR UPDATE OF name_ar ON products_searchdocument
+FOR EACH ROW EXECUTE FUNCTION products_searchdocument_name_ar_normalized();
+"""
+DROP_NAME_AR_TRIGGER = """
+DROP TRIGGER IF EXISTS products_searchdocument_name_ar_normalized ON products_searchdocument;
+DROP FUNCTION IF EXISTS products_searchdocument_name_ar_normalized();
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_search_term'),
+    ]
+
+    # Like 0005, existing search vectors are not rewritten here. Queries are
+    # normalized as soon as this release serves them, so before routing
+    # searches to it run, in this order:
+    #   python manage.py backfill_search_documents  (name_ar_normalized)
+    #   python manage.py reindex_search             (normalized search vectors)
+    operations = [
+        migrations.RunSQL(NORMALIZE_FUNCTION, 'DROP FUNCTION IF EXISTS products_normalize_arabic(text);'),
+        migrations.RunSQL(SEARCH_VECTOR_FUNCTION, search_vector_triggers.SEARCH_VECTOR_FUNCTION),
+        migrations.AddField(
+            model_name='searchdocument',
+            name='name_ar_normalized',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunSQL(NAME_AR_TRIGGER, DROP_NAME_AR_TRIGGER),
+        # Built while the column is still empty, so it is quick
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name_ar_normalized'], name='search_document_name_ar_norm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:23
+
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0012_arabic_normalization'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['product', 'rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['name'], name='search_document_name_gist', opclasses=['gist_trgm_ops']),
+        ),
+        migrations.AddField(
+            model_name='relatedproduct',
+            name='product',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='related_products', to='products.product'),
+        ),
+        migrations.AddField(
+            model_name='relatedproduct',
+            name='related',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.product'),
+        ),
+        migrations.AddConstraint(
+            model_name='relatedproduct',
+            constraint=models.UniqueConstraint(fields=('product', 'rank'), name='related_product_rank'),
+        ),
+    ]
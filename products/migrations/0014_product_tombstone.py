@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0013_related_product'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTombstone',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('sku', models.CharField(max_length=100)),
+                ('deleted_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['deleted_at', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['updated_at', 'id'], name='product_updated_id'),
+        ),
+        migrations.AddIndex(
+            model_name='producttombstone',
+            index=models.Index(fields=['deleted_at', 'id'], name='product_tombstone_deleted_id'),
+        ),
+    ]
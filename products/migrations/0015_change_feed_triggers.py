@@ -0,0 +1,83 @@
+from django.db import migrations
+
+# Columns whose change is a change of the product for the change feed;
+# search_vector is derived from them (and from brand and category names)
+PRODUCT_COLUMNS = [
+    'name', 'name_ar', 'description', 'description_ar', 'sku', 'price',
+    'brand_id', 'category_id', 'nutrition_facts_id', 'is_active',
+]
+
+CHANGED = (
+    f"({', '.join(f'NEW.{column}' for column in PRODUCT_COLUMNS)})\n"
+    f"            IS DISTINCT FROM ({', '.join(f'OLD.{column}' for column in PRODUCT_COLUMNS)})"
+)
+
+
+def touch_function(changed):
+    """The touch trigger function, setting updated_at of inserted rows and of updated rows where `changed`"""
+    return f"""
+CREATE OR REPLACE FUNCTION products_product_touch_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR {changed} THEN
+        NEW.updated_at := clock_timestamp();
+    ELSE
+        NEW.updated_at := OLD.updated_at;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+"""
+
+
+# updated_at is the position of a product in the change feed, so the
+# database sets it for every write, QuerySet.update() and imports included.
+# clock_timestamp() is the time of the write itself, never earlier than the
+# start of its transaction, which is what products.changes relies on to
+# hold back changes that may not be committed yet. Writes that change none
+# of the columns, such as reindex_search, keep the previous value.
+TOUCH_FUNCTION = touch_function(CHANGED)
+TOUCH_TRIGGER = TOUCH_FUNCTION + """
+CREATE TRIGGER products_product_touch
+BEFORE INSERT OR UPDATE ON products_product
+FOR EACH ROW EXECUTE FUNCTION products_product_touch_trigger();
+"""
+
+TOMBSTONE_TRIGGER = """
+CREATE OR REPLACE FUNCTION products_product_tombstone_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO products_producttombstone (id, sku, deleted_at)
+    SELECT o.id, o.sku, clock_timestamp() FROM old_rows o
+    ON CONFLICT (id) DO UPDATE SET sku = EXCLUDED.sku, deleted_at = EXCLUDED.deleted_at;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER products_product_tombstone
+AFTER DELETE ON products_product
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION products_product_tombstone_trigger();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS products_product_tombstone ON products_product;
+DROP FUNCTION IF EXISTS products_product_tombstone_trigger();
+DROP TRIGGER IF EXISTS products_product_touch ON products_product;
+DROP FUNCTION IF EXISTS products_product_touch_trigger();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0014_product_tombstone'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TOUCH_TRIGGER + TOMBSTONE_TRIGGER, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,72 @@
+import importlib
+
+from django.db import migrations
+
+change_feed_triggers = importlib.import_module('products.migrations.0015_change_feed_triggers')
+
+# The change feed serves products with their brand, category and nutrition
+# facts (the export shape), so editing one of those rows is a change of
+# every product embedding it. Product updates made from a trigger of such a
+# row touch the product: those of the triggers below, and the re-vectorizing
+# of the products of a renamed brand or category (0005).
+TOUCH_FUNCTION = change_feed_triggers.touch_function(
+    f'pg_trigger_depth() > 1 OR {change_feed_triggers.CHANGED}'
+)
+
+# Columns of each embedded row whose change touches its products. Brand and
+# category names are left out: renames already update the products (0005).
+RELATED_COLUMNS = {
+    'products_brand': ('brand_id', ['description', 'country_of_origin']),
+    'products_category': ('category_id', ['description']),
+    'products_nutritionfact': (
+        'nutrition_facts_id', ['calories', 'protein', 'carbohydrates', 'fat', 'sugar', 'sodium'],
+    ),
+}
+
+
+def touch_trigger(table, foreign_key, columns):
+    """
+    Statement-level, like the search document triggers (0010): a bulk update
+    (import_products' nutrition facts) touches its products in one statement.
+    """
+    return f"""
+CREATE OR REPLACE FUNCTION {table}_touch_products_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE products_product p SET updated_at = clock_timestamp()
+    FROM new_rows n JOIN old_rows o ON o.id = n.id
+    WHERE p.{foreign_key} = n.id
+      AND ({', '.join(f'n.{column}' for column in columns)})
+          IS DISTINCT FROM ({', '.join(f'o.{column}' for column in columns)});
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER {table}_touch_products
+AFTER UPDATE ON {table}
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION {table}_touch_products_trigger();
+"""
+
+
+TRIGGERS = TOUCH_FUNCTION + ''.join(
+    touch_trigger(table, foreign_key, columns) for table, (foreign_key, columns) in RELATED_COLUMNS.items()
+)
+
+DROP_TRIGGERS = ''.join(f"""
+DROP TRIGGER IF EXISTS {table}_touch_products ON {table};
+DROP FUNCTION IF EXISTS {table}_touch_products_trigger();
+""" for table in RELATED_COLUMNS) + change_feed_triggers.TOUCH_FUNCTION
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0015_change_feed_triggers'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TRIGGERS, DROP_TRIGGERS),
+    ]
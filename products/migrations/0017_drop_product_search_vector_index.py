@@ -0,0 +1,20 @@
+from django.contrib.postgres.operations import RemoveIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Search matches and ranks on products_searchdocument (0009), so the
+    # search_vector index of 0001 only costs every product write. Dropped
+    # without blocking writes.
+    atomic = False
+
+    dependencies = [
+        ('products', '0016_change_feed_related_rows'),
+    ]
+
+    operations = [
+        RemoveIndexConcurrently(
+            model_name='product',
+            name='products_pr_search__98d711_gin',
+        ),
+    ]
@@ -1,5 +1,5 @@
 from django.db import models
-from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.indexes import GinIndex, GistIndex
 from django.contrib.postgres.search import SearchVectorField
 
 class Category(models.Model):
@@ -20,6 +20,12 @@ class Brand(models.Model):
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            # Trigram index for fuzzy brand matching (name % query)
+            GinIndex(fields=['name'], name='brand_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
 class NutritionFact(models.Model):
     calories = models.FloatField(blank=True, null=True)
     protein = models.FloatField(blank=True, null=True)  # in grams
@@ -50,9 +56,125 @@ class Product(models.Model):
     
     def __str__(self):
         return self.name
-    
+
     class Meta:
+        # Search reads SearchDocument's full-text and trigram indexes, not these columns
         indexes = [
-            GinIndex(fields=['search_vector']),
+            # Keyset pagination over the listing orderings, with id as tie-breaker
+            models.Index(fields=['name', 'id'], name='product_active_name_id', condition=models.Q(is_active=True)),
+            models.Index(fields=['price', 'id'], name='product_active_price_id', condition=models.Q(is_active=True)),
+            models.Index(fields=['created_at', 'id'], name='product_active_created_id', condition=models.Q(is_active=True)),
+            # Change feed order, inactive products included (see products.changes)
+            models.Index(fields=['updated_at', 'id'], name='product_updated_id'),
         ]
         ordering = ['name']
+
+
+class ProductTombstone(models.Model):
+    """
+    A deleted product, reported by the change feed (see products.changes).
+    Written by a trigger on products_product (migration 0014).
+    """
+    # Same value as the deleted Product.id
+    id = models.BigIntegerField(primary_key=True)
+    sku = models.CharField(max_length=100)
+    deleted_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.sku
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='product_tombstone_deleted_id'),
+        ]
+        ordering = ['deleted_at', 'id']
+
+
+class SearchDocument(models.Model):
+    """
+    Denormalized copy of the searchable columns of a product, with brand and
+    category names inlined, so search reads a single table without joins.
+    Rows are written by triggers on products_product, products_brand and
+    products_category (migration 0009); never save them from Python.
+    """
+    # Same value as Product.id
+    id = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=255)
+    name_ar = models.CharField(max_length=255, blank=True, null=True)
+    # name_ar with Arabic spelling variants folded (see products.arabic), for trigram
+    # matching. Written by a trigger (migration 0012), NULL until backfilled
+    name_ar_normalized = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    sku = models.CharField(max_length=100)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    brand_id = models.BigIntegerField()
+    brand_name = models.CharField(max_length=100)
+    category_id = models.BigIntegerField()
+    category_name = models.CharField(max_length=100)
+    is_active = models.BooleanField(default=True)
+    # Copied from Product.search_vector
+    search_vector = SearchVectorField(null=True)
+
+    # Product lookups of ProductListSerializer's columns and their columns here
+    PRODUCT_COLUMNS = {'brand__name': 'brand_name', 'category__name': 'category_name'}
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='search_document_vector'),
+            # Trigram indexes for fuzzy matching (query <% name)
+            GinIndex(fields=['name'], name='search_document_name_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['name_ar_normalized'], name='search_document_name_ar_norm', opclasses=['gin_trgm_ops']),
+            # Related products: the nearest names of a category (ORDER BY name <-> name, see products.related)
+            GistIndex(fields=['name'], name='search_document_name_gist', opclasses=['gist_trgm_ops']),
+            # Brand and category filters, and the fuzzy brand source (brands matched in products_brand)
+            models.Index(fields=['brand_id'], name='search_document_active_brand', condition=models.Q(is_active=True)),
+            models.Index(fields=['category_id'], name='search_document_active_cat', condition=models.Q(is_active=True)),
+        ]
+        ordering = ['name']
+
+
+class SearchTerm(models.Model):
+    """
+    Spell correction dictionary: every word of the active search documents'
+    names, brand and category names, with the number of documents containing
+    it. Rebuilt in batches by products.spelling.refresh_terms.
+    """
+    term = models.CharField(max_length=100, primary_key=True)
+    frequency = models.IntegerField()
+
+    def __str__(self):
+        return self.term
+
+    class Meta:
+        indexes = [
+            # Corrections: the dictionary terms most similar to a query word (term % word)
+            GinIndex(fields=['term'], name='search_term_trgm', opclasses=['gin_trgm_ops']),
+            # Known words: partial keywords are prefixes of a term (term LIKE 'word%')
+            models.Index(fields=['term'], name='search_term_prefix', opclasses=['varchar_pattern_ops']),
+        ]
+
+
+class RelatedProduct(models.Model):
+    """
+    Precomputed neighbours of an active product, best first, served by
+    /api/products/{id}/related/. Written by the compute_related_products
+    command (see products.related); never save them from Python.
+    """
+    # Read by rank through the unique (product, rank) index
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_products', db_index=False)
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    # Start of the statement that wrote the row; products updated after it are recomputed
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.product_id} -> {self.related_id}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='related_product_rank'),
+        ]
+        ordering = ['product', 'rank']
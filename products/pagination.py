@@ -0,0 +1,227 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .metrics import timed
+
+
+class TimedPaginator(Paginator):
+    """Paginator reporting its COUNT(*) as the `count` phase of the request metrics"""
+
+    @cached_property
+    def count(self):
+        with timed('count'):
+            return super().count
+
+
+class EstimatedCountPaginator(TimedPaginator):
+    """
+    Paginator for tables too large to count on every page view, such as the
+    admin changelists. Counts are the planner's row estimate of the query
+    (EXPLAIN, from the statistics ANALYZE and autovacuum keep); estimates
+    below ESTIMATED_COUNT_THRESHOLD are replaced by an exact COUNT(*).
+    """
+
+    @cached_property
+    def count(self):
+        with timed('count'):
+            estimate = estimate_count(self.object_list)
+        if estimate < settings.ESTIMATED_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+def estimate_count(queryset):
+    """The planner's estimate of the number of rows `queryset` returns"""
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class PageNumberPagination(pagination.PageNumberPagination):
+    django_paginator_class = TimedPaginator
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over the queryset's own ordering, e.g.
+    (-relevance, name, id) for search or (price, id) for listing.
+
+    The cursor encodes the ordering values of the last (or first) row of
+    the current page, so every page is a `WHERE (...) > (...) LIMIT n`
+    query: no COUNT(*) and no OFFSET, and deep pages cost the same as the
+    first one. Clients opt in with `?pagination=cursor` and then follow
+    the `next`/`previous` links.
+    """
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    mode_query_value = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = 'Invalid cursor'
+
+    @classmethod
+    def is_requested(cls, request):
+        return (
+            cls.cursor_query_param in request.query_params or
+            request.query_params.get(cls.mode_query_param) == cls.mode_query_value
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        if isinstance(queryset, list):
+            return self._paginate_list(queryset, request)
+        self.offset = None
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor['r']
+        if cursor is not None:
+            if not isinstance(cursor['v'], list):
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(self._seek_filter(cursor['v'], reverse))
+        if reverse:
+            queryset = queryset.reverse()
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        self.page = rows
+        # Paging backwards always leaves a next page, paging forwards a previous one
+        self.has_next = has_more if not reverse else True
+        self.has_previous = cursor is not None and (has_more if reverse else True)
+        return rows
+
+    def _paginate_list(self, items, request):
+        """
+        Ranked lists computed in memory (e.g. by InMemorySearchBackend) are
+        sliced by position; the cursor carries the offset into the list.
+        """
+        self.ordering = ['rank']
+        cursor = self.decode_cursor(request)
+        self.offset = 0 if cursor is None else cursor['v']
+        if not isinstance(self.offset, int) or self.offset < 0:
+            raise NotFound(self.invalid_cursor_message)
+        self.page = items[self.offset:self.offset + self.page_size]
+        self.has_next = self.offset + self.page_size < len(items)
+        self.has_previous = self.offset > 0
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        if self.offset is not None:
+            return self.encode_cursor(self.offset + self.page_size, reverse=False)
+        return self.encode_cursor(self._row_values(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        if self.offset is not None:
+            return self.encode_cursor(max(self.offset - self.page_size, 0), reverse=False)
+        return self.encode_cursor(self._row_values(self.page[0]), reverse=True)
+
+    def get_ordering(self, queryset):
+        """Return the queryset ordering with a unique `id` tie-breaker appended"""
+        ordering = [
+            field for field in (queryset.query.order_by or queryset.model._meta.ordering)
+            if isinstance(field, str)
+        ]
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            # Follow the direction of the last field so one index can serve the scan
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append('-id' if descending else 'id')
+        return ordering
+
+    def _seek_filter(self, values, reverse):
+        """
+        Build `(a, b, c) > (x, y, z)` for the current ordering, honouring the
+        direction of each field, as an OR of equality prefixes.
+        """
+        if len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        fields = []
+        for field, value in zip(self.ordering, values):
+            descending = field.startswith('-') != reverse
+            fields.append((field.lstrip('-'), 'lt' if descending else 'gt', value))
+
+        condition = Q()
+        for index, (name, lookup, value) in enumerate(fields):
+            step = Q(**{f'{name}__{lookup}': value})
+            for prev_name, _, prev_value in fields[:index]:
+                step &= Q(**{prev_name: prev_value})
+            condition |= step
+
+        # Redundant bound on the leading field lets Postgres start the index scan there
+        name, lookup, value = fields[0]
+        return Q(**{f'{name}__{lookup}e': value}) & condition
+
+    def _row_values(self, row):
+        return [self._dump_value(getattr(row, field.lstrip('-'))) for field in self.ordering]
+
+    def encode_cursor(self, values, reverse):
+        payload = json.dumps({'o': self.ordering, 'v': values, 'r': reverse}, separators=(',', ':'))
+        token = base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+        url = remove_query_param(self.base_url, self.mode_query_param)
+        return replace_query_param(url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            padded = token + '=' * (-len(token) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+            if cursor['o'] != self.ordering:
+                raise ValueError
+            cursor['r'] = bool(cursor['r'])
+        except (TypeError, ValueError, KeyError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    @staticmethod
+    def _dump_value(value):
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
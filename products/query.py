@@ -0,0 +1,97 @@
+"""
+Parsing of user search input into a Postgres tsquery.
+
+The syntax follows websearch_to_tsquery: words are ANDed, `or` between
+words gives alternatives, `-word` excludes a word and "quoted words" must
+appear as a phrase. Unlike websearch_to_tsquery, an unquoted word also
+matches as a prefix of the names, brand and category (weights A and B of
+search_vector), e.g. `choc` -> 'choc':*AB | 'choc'. Partial keywords are
+thus answered by the search_vector GIN index instead of ILIKE scans, while
+descriptions only match whole words. Each token is normalized with the
+text search config of its script: Arabic tokens with 'arabic', everything
+else with 'english', matching how search_vector is built.
+"""
+import re
+from functools import reduce
+
+from django.contrib.postgres.search import SearchQuery
+
+# A quoted phrase (the closing quote is optional) or a bare token
+TOKEN = re.compile(r'"([^"]*)"?|(\S+)')
+# Characters that can be part of a lexeme; everything else separates words
+# and keeps tsquery syntax out of the raw query
+WORD = re.compile(r'[^\W_]+')
+# Weights of the fields partial keywords complete against (names, brand, category)
+PREFIX_WEIGHTS = 'AB'
+
+
+def has_arabic(text):
+    return any('\u0600' <= c <= '\u06FF' for c in text)
+
+
+def token_config(text):
+    return 'arabic' if has_arabic(text) else 'english'
+
+
+def tokenize(query_string):
+    """
+    Split input into alternatives of terms: a list of OR groups, each a
+    list of (words, prefix, negated) terms that are ANDed together.
+    """
+    groups = [[]]
+    negate_next = False
+    for match in TOKEN.finditer(query_string or ''):
+        phrase, token = match.groups()
+        if token is not None and token.lower() == 'or':
+            if groups[-1]:
+                groups.append([])
+            continue
+        if token is not None and token.startswith('-') and len(token) > 1:
+            negate_next, token = True, token[1:]
+        words = WORD.findall(phrase if phrase is not None else token)
+        if words:
+            groups[-1].append((words, phrase is None, negate_next))
+        negate_next = False
+    return [group for group in groups if group]
+
+
+def term_query(words, prefix):
+    """Raw tsquery for one term; words are alphanumeric so they need no escaping"""
+    if prefix:
+        operands = [f"('{word}' | '{word}':*{PREFIX_WEIGHTS})" for word in words]
+    else:
+        operands = [f"'{word}'" for word in words]
+    return SearchQuery(' <-> '.join(operands), config=token_config(' '.join(words)), search_type='raw')
+
+
+def fuzzy_text(query_string):
+    """The words to match by trigram similarity: no operators, quotes or excluded terms"""
+    return ' '.join(
+        word for group in tokenize(query_string) for words, _, negated in group if not negated for word in words
+    )
+
+
+def exclusion_query(query_string):
+    """
+    SearchQuery matching any `-word` of the input, or None. Excluded terms
+    apply to every retrieval source, not only to the full-text match.
+    """
+    terms = [
+        term_query(words, prefix)
+        for group in tokenize(query_string) for words, prefix, negated in group if negated
+    ]
+    return reduce(lambda left, right: left | right, terms) if terms else None
+
+
+def parse_search_query(query_string):
+    """Return the SearchQuery for `query_string`, or None when it has no words"""
+    alternatives = []
+    for group in tokenize(query_string):
+        terms = [
+            ~term_query(words, prefix) if negated else term_query(words, prefix)
+            for words, prefix, negated in group
+        ]
+        alternatives.append(reduce(lambda left, right: left & right, terms))
+    if not alternatives:
+        return None
+    return reduce(lambda left, right: left | right, alternatives)
@@ -0,0 +1,108 @@
+"""
+Precomputed related products (/api/products/{id}/related/).
+
+The RELATED_PRODUCTS_LIMIT best neighbours of every active product are
+stored in RelatedProduct by the compute_related_products command, so a
+product page reads them with one indexed lookup instead of running a fuzzy
+search for the product's name on every view.
+
+Candidates are the RELATED_PRODUCTS_CANDIDATES active products of the same
+category with the nearest names (name <-> name over the trigram GiST index
+of the search documents). Each is scored with:
+- BRAND_WEIGHT when it has the same brand,
+- NAME_WEIGHT times the trigram similarity of the names,
+- VECTOR_WEIGHT times the share of the product's name lexemes (weight A of
+  search_vector: English and normalized Arabic stems) it has too.
+
+Refreshes are incremental: a product is recomputed when it was updated after
+its neighbours were computed, when one of its neighbours was or has been
+deactivated, or when it has no neighbours. Deactivated products lose theirs.
+New products enter the lists of existing ones as those are recomputed, or on
+the next full refresh.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import RelatedProduct
+
+BRAND_WEIGHT = 0.3
+NAME_WEIGHT = 0.4
+VECTOR_WEIGHT = 0.3
+
+STALE_SQL = """
+SELECT p.id FROM products_product p
+WHERE p.id >= %s AND p.id < %s AND CASE
+    WHEN p.is_active THEN NOT EXISTS (
+        SELECT 1 FROM products_relatedproduct r WHERE r.product_id = p.id AND r.computed_at >= p.updated_at
+    ) OR EXISTS (
+        SELECT 1 FROM products_relatedproduct r JOIN products_product n ON n.id = r.related_id
+        WHERE r.product_id = p.id AND (n.updated_at > r.computed_at OR NOT n.is_active)
+    )
+    ELSE EXISTS (SELECT 1 FROM products_relatedproduct r WHERE r.product_id = p.id)
+END
+"""
+
+DELETE_SQL = 'DELETE FROM products_relatedproduct WHERE product_id = ANY(%s)'
+
+INSERT_SQL = """
+INSERT INTO products_relatedproduct (product_id, related_id, rank, score, computed_at)
+SELECT s.id, n.id, n.rank, n.score, statement_timestamp()
+FROM products_searchdocument s
+CROSS JOIN LATERAL (
+    SELECT tsvector_to_array(ts_filter(s.search_vector, '{a}')) AS lexemes
+) words
+CROSS JOIN LATERAL (
+    SELECT scored.id, scored.score, row_number() OVER (ORDER BY scored.score DESC, scored.id) AS rank
+    FROM (
+        SELECT c.id,
+            CASE WHEN c.brand_id = s.brand_id THEN %(brand_weight)s ELSE 0 END
+            + %(name_weight)s * similarity(c.name, s.name)
+            + %(vector_weight)s * (
+                SELECT count(*) FROM unnest(tsvector_to_array(ts_filter(c.search_vector, '{a}'))) AS lexeme
+                WHERE lexeme = ANY(words.lexemes)
+            )::float / greatest(cardinality(words.lexemes), 1) AS score
+        FROM (
+            SELECT id, name, brand_id, search_vector FROM products_searchdocument c
+            WHERE c.category_id = s.category_id AND c.is_active AND c.id <> s.id
+            ORDER BY c.name <-> s.name
+            LIMIT %(candidates)s
+        ) c
+    ) scored
+    ORDER BY scored.score DESC, scored.id
+    LIMIT %(limit)s
+) n
+WHERE s.id = ANY(%(ids)s) AND s.is_active
+"""
+
+
+def stale_product_ids(start, end):
+    """Ids in [start, end) whose neighbours are missing or out of date"""
+    with connection.cursor() as cursor:
+        cursor.execute(STALE_SQL, [start, end])
+        return [pk for pk, in cursor.fetchall()]
+
+
+def refresh_related(product_ids):
+    """Recompute the neighbours of the products, return the number of rows written"""
+    if not product_ids:
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(DELETE_SQL, [product_ids])
+        cursor.execute(INSERT_SQL, {
+            'ids': product_ids,
+            'brand_weight': BRAND_WEIGHT,
+            'name_weight': NAME_WEIGHT,
+            'vector_weight': VECTOR_WEIGHT,
+            'candidates': settings.RELATED_PRODUCTS_CANDIDATES,
+            'limit': settings.RELATED_PRODUCTS_LIMIT,
+        })
+        return cursor.rowcount
+
+
+def related_rows(product_id, columns):
+    """`columns` of the product's active neighbours, best first (Product lookups, e.g. brand__name)"""
+    return list(
+        RelatedProduct.objects.filter(product_id=product_id, related__is_active=True)
+        .order_by('rank')
+        .values_list(*(f'related__{column}' for column in columns))
+    )
@@ -0,0 +1,64 @@
+import json
+from json.encoder import encode_basestring
+
+from rest_framework.compat import SHORT_SEPARATORS
+from rest_framework.renderers import JSONRenderer
+
+from .serializers import EncodedRows
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that writes EncodedRows, anywhere in dicts and lists of the
+    response data (the paginated response, the batch search results), with
+    their precompiled encoder. The bytes are the same as JSONRenderer's;
+    everything else, and indented output such as the browsable API's, goes
+    through JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not self._has_rows(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        # RowEncoder writes compact, non-ASCII-escaped JSON like the default settings
+        if indent is not None or not self.compact or self.ensure_ascii:
+            return super().render(self._plain(data), accepted_media_type, renderer_context)
+        text = self._encode(data)
+        # Same escaping as JSONRenderer
+        return text.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029').encode()
+
+    @classmethod
+    def _has_rows(cls, data):
+        if isinstance(data, EncodedRows):
+            return True
+        if isinstance(data, dict):
+            return any(cls._has_rows(value) for value in data.values())
+        if isinstance(data, list):
+            return any(cls._has_rows(value) for value in data)
+        return False
+
+    @classmethod
+    def _plain(cls, data):
+        """`data` with the EncodedRows replaced by lists of dicts"""
+        if isinstance(data, EncodedRows):
+            return list(data)
+        if isinstance(data, dict):
+            return {key: cls._plain(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [cls._plain(value) for value in data]
+        return data
+
+    def _encode(self, data):
+        if isinstance(data, EncodedRows):
+            return data.to_json()
+        if not self._has_rows(data):
+            return self._dumps(data)
+        if isinstance(data, dict):
+            return '{' + ','.join(
+                encode_basestring(str(key)) + ':' + self._encode(value) for key, value in data.items()
+            ) + '}'
+        return '[' + ','.join(self._encode(value) for value in data) + ']'
+
+    def _dumps(self, value):
+        return json.dumps(value, cls=self.encoder_class, ensure_ascii=self.ensure_ascii,
+                          allow_nan=not self.strict, separators=SHORT_SEPARATORS)
@@ -0,0 +1,247 @@
+"""
+Read-replica routing (DATABASE_ROUTERS).
+
+Replicas are the DATABASES aliases in settings.DATABASE_REPLICAS (see
+DB_REPLICAS). Reads go to a replica only inside `replica_reads()`, which
+wraps the read-only catalog viewsets and ProductSearchService, and only when:
+
+- the client did not write in the last DB_PRIMARY_PIN_SECONDS: a request
+  that writes gets a cookie pinning the client's reads to the primary
+  (ReplicaPinningMiddleware), so it sees its own writes;
+- the catalog was not written in the last DB_REPLICA_MAX_LAG seconds,
+  otherwise a search cache miss could store what a replica has not
+  replayed yet under the new catalog generation;
+- a replica is healthy: ReplicaMonitor checks the replay lag of each
+  replica every DB_REPLICA_CHECK_INTERVAL seconds and leaves out those
+  lagging more than DB_REPLICA_MAX_LAG or failing the check. A replica is
+  only caught up once it replayed the primary's current WAL position, so
+  one whose WAL receiver disconnected falls behind as the primary writes.
+
+One replica is chosen at random per request, so a request reads one
+consistent snapshot. Everything else, all writes and migrations use the
+primary (`default`).
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connections
+
+from .cache import get_write_age
+from .degradation import is_query_canceled
+
+logger = logging.getLogger(__name__)
+
+PIN_COOKIE = 'primary_pin'
+
+# WAL position of the primary, which a caught up replica has replayed
+PRIMARY_LSN_SQL = 'SELECT pg_current_wal_lsn()'
+
+# Seconds the replica is behind, given the primary's WAL position: 0 when it
+# replayed up to that position (matching its own received position is not
+# enough, that is also what a replica cut off from the primary looks like)
+# or is not in recovery at all, infinite when it never replayed a transaction
+LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_replay_lsn() >= %s::pg_lsn THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity')
+END
+"""
+
+_state = ContextVar('db_routing', default=None)
+
+
+class RoutingState:
+    """Routing decisions of one request (or one replica_reads() block outside of requests)"""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.replica_reads = False
+        self.wrote = False
+        self.alias = None
+
+    def read_alias(self):
+        if not self.replica_reads or self.pinned or self.wrote:
+            return DEFAULT_DB_ALIAS
+        if self.alias is None:
+            self.alias = choose_replica()
+        return self.alias
+
+
+class ReplicaMonitor:
+    """Replay lag of each replica, checked at most every DB_REPLICA_CHECK_INTERVAL seconds"""
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+        # None until checked, and for replicas that failed their last check
+        self.lags = dict.fromkeys(self.aliases)
+        self.checked = dict.fromkeys(self.aliases, float('-inf'))
+        self.lock = threading.Lock()
+
+    def healthy(self):
+        """Replicas that answered their last check and lag at most DB_REPLICA_MAX_LAG"""
+        now = time.monotonic()
+        with self.lock:
+            # Claim the due checks, so concurrent requests don't repeat them
+            due = [alias for alias in self.aliases if now - self.checked[alias] >= settings.DB_REPLICA_CHECK_INTERVAL]
+            for alias in due:
+                self.checked[alias] = now
+        if due:
+            primary_lsn = self.primary_lsn()
+            for alias in due:
+                self.lags[alias] = self.check(alias, primary_lsn) if primary_lsn is not None else None
+        return [
+            alias for alias in self.aliases
+            if self.lags[alias] is not None and self.lags[alias] <= settings.DB_REPLICA_MAX_LAG
+        ]
+
+    @staticmethod
+    def primary_lsn():
+        """Current WAL position of the primary, None when it cannot be queried"""
+        try:
+            with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+                cursor.execute(PRIMARY_LSN_SQL)
+                return cursor.fetchone()[0]
+        except DatabaseError as exc:
+            logger.warning('Primary WAL position unavailable for the replica checks: %s', exc)
+            return None
+
+    def check(self, alias, primary_lsn):
+        """Lag of the replica in seconds behind `primary_lsn`, None when it cannot be queried"""
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL, [primary_lsn])
+                return float(cursor.fetchone()[0])
+        except DatabaseError as exc:
+            logger.warning('Replica %s failed its check: %s', alias, exc)
+            connections[alias].close()
+            return None
+
+    def recheck(self, alias):
+        """Check the replica again on the next request, e.g. after an error on it"""
+        with self.lock:
+            self.checked[alias] = float('-inf')
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_replica_monitor():
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = ReplicaMonitor(settings.DATABASE_REPLICAS)
+    return _monitor
+
+
+def choose_replica():
+    """A healthy replica, or the primary when none is or the catalog changed too recently"""
+    if not settings.DATABASE_REPLICAS:
+        return DEFAULT_DB_ALIAS
+    write_age = get_write_age()
+    if write_age is not None and write_age < settings.DB_REPLICA_MAX_LAG:
+        return DEFAULT_DB_ALIAS
+    healthy = get_replica_monitor().healthy()
+    return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+
+def read_alias():
+    """Database the current context reads from"""
+    state = _state.get()
+    return DEFAULT_DB_ALIAS if state is None else state.read_alias()
+
+
+@contextmanager
+def replica_reads():
+    """Let the reads in the block go to a replica, see the module docstring"""
+    state = _state.get()
+    token = None
+    if state is None:
+        state = RoutingState()
+        token = _state.set(state)
+    previous, state.replica_reads = state.replica_reads, True
+    try:
+        yield state
+    except OperationalError as exc:
+        if state.alias in settings.DATABASE_REPLICAS and not is_query_canceled(exc):
+            # The error may come from the replica (a cancelled statement does not); find out
+            # before the next request uses it
+            get_replica_monitor().recheck(state.alias)
+        raise
+    finally:
+        state.replica_reads = previous
+        if token is not None:
+            _state.reset(token)
+
+
+class ReplicaRouter:
+    """Route reads in replica_reads() blocks to a replica and everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        return read_alias()
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            # Reads after a write in the same request go to the primary too
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas follow the primary's schema through replication
+        return False if db in settings.DATABASE_REPLICAS else None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Track the routing state of each request. Requests that write set a
+    cookie that keeps the client's reads on the primary for
+    DB_PRIMARY_PIN_SECONDS, longer than replicas may lag.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._pin(state, response)
+
+    async def __acall__(self, request):
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self._pin(state, response)
+
+    @staticmethod
+    def _pin(state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.DB_PRIMARY_PIN_SECONDS, httponly=True, samesite='Lax'
+            )
+        return response
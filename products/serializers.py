@@ -1,4 +1,11 @@
+import json
+from collections.abc import Sequence
+from json.encoder import encode_basestring
+
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
 from .models import Category, Brand, NutritionFact, Product
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -31,4 +38,133 @@ class ProductDetailSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Product
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class SearchQuerySerializer(serializers.Serializer):
+    """One search of a batch search request"""
+    q = serializers.CharField(required=False, allow_blank=True, default='')
+    category = serializers.IntegerField(required=False, allow_null=True, default=None)
+    brand = serializers.IntegerField(required=False, allow_null=True, default=None)
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True, default=None)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True, default=None)
+    limit = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_limit(self, value):
+        if value > settings.SEARCH_BATCH_MAX_LIMIT:
+            raise serializers.ValidationError(f'Ensure this value is less than or equal to {settings.SEARCH_BATCH_MAX_LIMIT}.')
+        return value
+
+    def to_internal_value(self, data):
+        values = super().to_internal_value(data)
+        values.setdefault('limit', api_settings.PAGE_SIZE)
+        return values
+
+def _encode_json(value):
+    """Encode one value the way rest_framework's JSONRenderer does (compact, unicode)"""
+    return json.dumps(value, cls=encoders.JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+
+class RowEncoder:
+    """
+    JSON encoding of a serializer's output straight from value tuples, e.g.
+    `Product.objects.values_list(*encoder.columns)`, skipping model instances
+    and the per-row walk over field objects. The per-field encoders are
+    chosen once; fields without a fast encoder go through their own
+    to_representation, so the output always matches the serializer.
+    """
+
+    def __init__(self, serializer_class):
+        self.names, self.columns, self.represent, self.encode = [], [], [], []
+        for name, field in serializer_class().fields.items():
+            self.names.append(name)
+            self.columns.append('__'.join(field.source_attrs))
+            represent, encode = self._compile(field)
+            self.represent.append(represent)
+            self.encode.append(encode)
+        # '{"id":', ',"name":', ...
+        self.prefixes = [
+            ('{' if index == 0 else ',') + encode_basestring(name) + ':'
+            for index, name in enumerate(self.names)
+        ]
+        self.columns = tuple(self.columns)
+
+    @staticmethod
+    def _compile(field):
+        """
+        Return (to Python representation, to JSON text) functions for a
+        non-null database value of the field's column. Database drivers
+        return str, int and bool for these columns, so C functions can
+        encode them directly.
+        """
+        if isinstance(field, serializers.BooleanField):
+            return bool, {True: 'true', False: 'false'}.__getitem__
+        if isinstance(field, serializers.CharField):
+            return str, encode_basestring
+        if isinstance(field, serializers.IntegerField) and not (
+            isinstance(field, serializers.BigIntegerField)
+            and getattr(field, 'coerce_to_string', api_settings.COERCE_BIGINT_TO_STRING)
+        ):
+            return int, int.__repr__
+        if (
+            isinstance(field, serializers.DecimalField) and field.decimal_places
+            and getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+            and not field.localize and not field.normalize_output
+        ):
+            def represent(value):
+                # numeric(n, decimal_places) columns are already quantized; skip quantize()
+                text = str(value)
+                if text.rfind('.') == len(text) - field.decimal_places - 1 and 'E' not in text:
+                    return text
+                return field.to_representation(value)
+            return represent, lambda value: '"' + represent(value) + '"'
+        return field.to_representation, lambda value: _encode_json(field.to_representation(value))
+
+    def to_json(self, rows):
+        """JSON array text of the rows"""
+        prefixes, encode = self.prefixes, self.encode
+        pieces = []
+        for row in rows:
+            for prefix, value, encode_value in zip(prefixes, row, encode):
+                pieces.append(prefix)
+                # DRF skips to_representation for None
+                pieces.append('null' if value is None else encode_value(value))
+            pieces.append('},')
+        if not pieces:
+            return '[]'
+        pieces[-1] = '}]'
+        return '[' + ''.join(pieces)
+
+    def to_dict(self, row):
+        return {
+            name: None if value is None else represent(value)
+            for name, value, represent in zip(self.names, row, self.represent)
+        }
+
+
+class EncodedRows(Sequence):
+    """
+    Rows of a RowEncoder, used in place of `serializer.data`. FastJSONRenderer
+    writes them with `to_json()`; indexing and iteration give the same dicts
+    as the serializer, for any other consumer of `response.data`.
+    """
+
+    def __init__(self, encoder, rows):
+        self.encoder = encoder
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.encoder.to_dict(row) for row in self.rows[index]]
+        return self.encoder.to_dict(self.rows[index])
+
+    def __eq__(self, other):
+        return list(self) == list(other) if isinstance(other, (list, Sequence)) else NotImplemented
+
+    def to_json(self):
+        return self.encoder.to_json(self.rows)
+
+
+product_list_encoder = RowEncoder(ProductListSerializer)
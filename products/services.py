@@ -1,89 +1,400 @@
-from django.db.models import Q, Value, F, FloatField
+import threading
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import OperationalError
+from django.utils.module_loading import import_string
+from django.db.models import Value, F, FloatField, CharField, IntegerField, QuerySet
 from django.db.models.functions import Greatest
-from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
-from .models import Product
+from django.contrib.postgres.search import (
+    SearchRank, TrigramSimilarity, TrigramWordSimilarity
+)
+from .arabic import normalize_arabic
+from .degradation import (
+    TIER_FULL, TIER_PREFIX, TIERS, deadline, get_load_governor, is_query_canceled
+)
+from .facets import facet_counts, filter_conditions, relaxed_filters
+from .metrics import timed
+from .models import Brand, SearchDocument
+from .query import exclusion_query, fuzzy_text, parse_search_query
+from .routers import read_alias, replica_reads
+from .spelling import Correction, correct_queries, lookup_words
 
-class ProductSearchService:
 
-    @staticmethod
-    def search(query_string, **filters):
+@dataclass
+class SearchResult:
+    """Ranked products for a search plus metadata about how they were retrieved"""
+    queryset: QuerySet = None
+    # True when at least one retrieval source hit SEARCH_CANDIDATE_LIMIT,
+    # i.e. lower ranked matches may have been left out
+    truncated: bool = False
+    # Backends that rank outside the database return ordered product ids
+    # instead of a queryset; only the requested page is then loaded
+    ranked_ids: list = None
+    # The spell-corrected query the results are for, None when the input was searched as is
+    did_you_mean: str = None
+    # Degradation tier the search ran at, see products.degradation
+    tier: str = TIER_FULL
+
+
+class SearchBackend:
+    """Interface of the engines ProductSearchService can delegate to"""
+
+    def search(self, query_string, tier=TIER_FULL, **filters):
+        """
+        Return a SearchResult for the query and filters. Backends that query
+        the database do less work at lower `tier`s (see products.degradation).
+        """
+        raise NotImplementedError
+
+    def facets(self, query_string, facets, tier=TIER_FULL, **filters):
+        """Return the counts per value of each facet, see products.facets"""
+        raise NotImplementedError
+
+    def search_batch(self, queries):
         """
-        Perform a comprehensive search on products using multiple techniques:
-        1. Full-text search using PostgreSQL's search capabilities
-        2. Trigram similarity for fuzzy matching/misspellings
-        3. Direct field matching for partial keywords
+        Return the ranked product ids of each `(query_string, filters, limit)`
+        search, at most `limit` of them, in input order. Backends that can
+        run the searches together override this.
+        """
+        results = []
+        for query_string, filters, limit in queries:
+            result = self.search(query_string, **filters)
+            if result.ranked_ids is not None:
+                results.append(list(result.ranked_ids[:limit]))
+            else:
+                results.append(list(result.queryset.values_list('id', flat=True)[:limit]))
+        return results
+
+    def warm_up(self):
+        """Prepare the backend when a worker starts"""
+
+
+class ORMSearchBackend(SearchBackend):
+    """
+    Default backend: ranks products with a Postgres query through the ORM.
+    Matching, ranking and filtering read the SearchDocument table, not the
+    joined product, brand and category tables.
+    """
+
+    def search(self, query_string, tier=TIER_FULL, **filters):
+        """
+        Perform a comprehensive search on products in two phases:
+        
+        Retrieval - collect at most SEARCH_CANDIDATE_LIMIT ids from each source:
+        1. Full-text search using PostgreSQL's search capabilities; every
+           word is a prefix match, which also covers partial keywords
+           (see products.query for the syntax)
+        2. Trigram similarity for fuzzy matching/misspellings (pg_trgm `%`/`<%` operators),
+           skipped for names when spell correction resolved every word
+        
+        Ranking - compute the full relevance formula only for those candidates.
+        
+        Lower tiers retrieve from full-text only: `full_text` ranks by
+        SearchRank alone, `prefix` orders the matches by name.
         """
         # Initialize queryset
-        queryset = Product.objects.filter(is_active=True)
+        queryset = SearchDocument.objects.filter(is_active=True)
         
         # If no search query, return filtered queryset
         if not query_string or not query_string.strip():
-            queryset = ProductSearchService._apply_filters(queryset, **filters)
-            return queryset.order_by('name').select_related('brand', 'category')
+            queryset = ORMSearchBackend._apply_filters(queryset, **filters)
+            return SearchResult(queryset.order_by('name'))
         
-        # Clean the query string
-        query_string = query_string.strip()
+        queryset = ORMSearchBackend._apply_filters(queryset, **filters)
+        queryset, query_string, search_query, fuzzy_string, correction = ORMSearchBackend._parse(
+            query_string, queryset
+        )
         
-        # Check if query contains Arabic characters
-        has_arabic = any('\u0600' <= c <= '\u06FF' for c in query_string) # Retrun True if any character is Arabic
+        if tier == TIER_PREFIX:
+            # Unranked: any SEARCH_CANDIDATE_LIMIT matches, read with the page
+            candidates = ORMSearchBackend._candidate_union(queryset, fuzzy_string, search_query, ('full_text',))
+            queryset = SearchDocument.objects.filter(id__in=candidates).annotate(
+                relevance=Value(0.0, output_field=FloatField())
+            ).order_by('name')
+            return SearchResult(queryset, did_you_mean=correction.did_you_mean, tier=tier)
         
-        # Create appropriate search configurations
-        search_configs = ['english']
-        if has_arabic:
-            search_configs.append('arabic')
+        candidate_ids, truncated = ORMSearchBackend._retrieve_candidates(
+            queryset,
+            fuzzy_string,
+            search_query,
+            ORMSearchBackend._source_names(tier, correction)
+        )
         
+        queryset = ORMSearchBackend._ranked(
+            SearchDocument.objects.filter(id__in=candidate_ids), query_string, fuzzy_string, search_query,
+            fuzzy=tier == TIER_FULL
+        )
+        return SearchResult(queryset, truncated=truncated, did_you_mean=correction.did_you_mean, tier=tier)
+
+    def search_batch(self, queries):
+        """
+        Run every search of the batch in one statement: a UNION ALL of the
+        searches' ranking queries, each with its retrieval as a subquery and
+        LIMITed to its own page. Rows are ordered per search in Python.
+        The words of all searches are spell-corrected with one lookup.
+        """
+        corrections = ORMSearchBackend._correct([query_string or '' for query_string, _, _ in queries])
+        parts = []
+        for index, (query_string, filters, limit) in enumerate(queries):
+            queryset = ORMSearchBackend._apply_filters(SearchDocument.objects.filter(is_active=True), **filters)
+            if not query_string or not query_string.strip():
+                ranked = queryset.annotate(relevance=Value(0.0, output_field=FloatField())).order_by('name')
+            else:
+                queryset, query_string, search_query, fuzzy_string, correction = ORMSearchBackend._parse(
+                    query_string, queryset, corrections[index]
+                )
+                candidates = ORMSearchBackend._candidate_union(
+                    queryset, fuzzy_string, search_query, ORMSearchBackend._source_names(TIER_FULL, correction)
+                )
+                ranked = ORMSearchBackend._ranked(
+                    SearchDocument.objects.filter(id__in=candidates), query_string, fuzzy_string, search_query
+                )
+            parts.append(
+                ranked.annotate(batch_index=Value(index, output_field=IntegerField()))
+                .values_list('batch_index', 'id', 'relevance', 'name')[:limit]
+            )
+        results = [[] for _ in queries]
+        if not parts:
+            return results
+        rows = parts[0].union(*parts[1:], all=True) if len(parts) > 1 else parts[0]
+        # UNION ALL does not keep the order of its parts
+        for index, product_id, relevance, name in sorted(rows, key=lambda row: (row[0], -row[2], row[3], row[1])):
+            results[index].append(product_id)
+        return results
+
+    @staticmethod
+    def _correct(query_strings, lookup=lookup_words):
+        """
+        Spell corrections of the stripped query strings, after folding their
+        Arabic spelling variants like the indexed text (see products.arabic)
+        """
+        query_strings = [normalize_arabic(query_string.strip()) for query_string in query_strings]
+        if not settings.SEARCH_SPELL_CORRECTION:
+            return [Correction(query_string) for query_string in query_strings]
+        return correct_queries(query_strings, lookup)
+
+    @staticmethod
+    def _parse(query_string, queryset, correction=None):
+        """
+        Return `queryset` without the products excluded by `-word` terms,
+        the stripped and spell-corrected query string, its SearchQuery, its
+        trigram text and the Correction (looked up unless given).
+        """
+        if correction is None:
+            correction = ORMSearchBackend._correct([query_string])[0]
+        query_string = correction.query_string
+        # `-word` excludes from every source
+        excluded = exclusion_query(query_string)
+        if excluded is not None:
+            queryset = queryset.exclude(search_vector=excluded)
+        # Prefix tsquery with websearch-style operators, each token normalized
+        # with the config of its script (None when the input has no words);
+        # trigram matching sees the plain words
+        return queryset, query_string, parse_search_query(query_string), fuzzy_text(query_string), correction
+
+    @staticmethod
+    def _source_names(tier, correction):
+        """Retrieval sources of a search at `tier`"""
+        if tier != TIER_FULL:
+            return ('full_text',)
+        if correction.complete:
+            # Every word is a catalog word, full-text finds them without trigram scans of names
+            return ('full_text', 'brand')
+        return ('full_text', 'name', 'name_ar', 'brand')
+
+    @staticmethod
+    def _ranked(candidates, query_string, fuzzy_string, search_query, fuzzy=True):
+        """
+        Annotate the candidates with the relevance formula and order them by
+        it; without `fuzzy` the relevance is the weighted full-text rank only.
+        """
+        # Check if query contains Arabic characters
+        has_arabic = any('\u0600' <= c <= '\u06FF' for c in query_string)
         
         # Divide your queryset to get a readable code and result
-        queryset = queryset.annotate(
+        weights = settings.SEARCH_RELEVANCE_WEIGHTS
+        name_ar_weight = weights['name_ar_arabic'] if has_arabic else weights['name_ar']
+        if search_query is not None:
+            full_text_rank = SearchRank(F('search_vector'), search_query)
+        else:
+            full_text_rank = Value(0.0, output_field=FloatField())
+        if not fuzzy:
+            return candidates.annotate(
+                relevance=full_text_rank * Value(weights['full_text'], output_field=FloatField())
+            ).order_by('-relevance', 'name')
+        queryset = candidates.annotate(
             # Full-text search ranking
-            full_text_rank=SearchRank(
-                F('search_vector'),
-                SearchQuery(query_string, config=search_configs[0])
-            ),
-            name_similarity=TrigramSimilarity('name', query_string),
-            name_ar_similarity=TrigramSimilarity('name_ar', query_string),
-            brand_similarity=TrigramSimilarity('brand__name', query_string),
+            full_text_rank=full_text_rank,
+            name_similarity=TrigramSimilarity('name', fuzzy_string),
+            name_ar_similarity=TrigramSimilarity('name_ar_normalized', fuzzy_string),
+            brand_similarity=TrigramSimilarity('brand_name', fuzzy_string),
             # Choose the most relevant field 
             relevance=Greatest(
-                F('full_text_rank') * Value(2.0, output_field=FloatField()),  # Full-text gets higher weight
-                F('name_similarity'),
-                F('name_ar_similarity') * Value(0.9 if has_arabic else 0.7, output_field=FloatField()),
-                F('brand_similarity') * Value(0.8, output_field=FloatField()),
+                F('full_text_rank') * Value(weights['full_text'], output_field=FloatField()),
+                F('name_similarity') * Value(weights['name'], output_field=FloatField()),
+                F('name_ar_similarity') * Value(name_ar_weight, output_field=FloatField()),
+                F('brand_similarity') * Value(weights['brand'], output_field=FloatField()),
                 Value(0.0, output_field=FloatField())  # Fallback value
             )
-        ).filter(
-            # Combined filter condition for better performance
-            Q(search_vector=SearchQuery(query_string, config=search_configs[0])) |
-            Q(name__icontains=query_string) |
-            Q(name_ar__icontains=query_string) |
-            Q(brand__name__icontains=query_string) |
-            Q(category__name__icontains=query_string) |
-            # Trigram similarity conditions for fuzzy matching
-            Q(name_similarity__gt=0.3) |
-            Q(name_ar_similarity__gt=0.3) |
-            Q(brand_similarity__gt=0.3)
         )
         
-        # Apply additional filters
-        queryset = ProductSearchService._apply_filters(queryset, **filters)
-        
-        # Order by relevance and optimize with select_related
-        return queryset.order_by('-relevance', 'name').select_related('brand', 'category')
-    
+        # Order by relevance
+        return queryset.order_by('-relevance', 'name')
+
+    def facets(self, query_string, facets, tier=TIER_FULL, **filters):
+        """
+        Count the search's candidates per brand, category and price bucket
+        in one query. Each facet's candidates are retrieved like in search()
+        at `tier`, with every filter except the facet's own applied inside
+        the retrieval sources, before their candidate limit.
+        """
+        queryset = SearchDocument.objects.filter(is_active=True)
+        searched = bool(query_string and query_string.strip())
+        if searched:
+            queryset, _, search_query, fuzzy_string, correction = ORMSearchBackend._parse(query_string, queryset)
+            names = ORMSearchBackend._source_names(tier, correction)
+        candidates = {}
+        for facet in facets:
+            facet_queryset = ORMSearchBackend._apply_filters(queryset, **relaxed_filters(facet, filters))
+            if searched:
+                # The retrieval UNION ALL becomes a subquery of the facet's aggregate
+                facet_queryset = SearchDocument.objects.filter(id__in=ORMSearchBackend._candidate_union(
+                    facet_queryset, fuzzy_string, search_query, names
+                ))
+            candidates[facet] = facet_queryset
+        return facet_counts(candidates, facets)
+
+    @staticmethod
+    def _candidate_sources(queryset, query_string, search_query, names=None):
+        """
+        Querysets of the retrieval sources, each ordered by its own score;
+        only those in `names` when given (see _source_names).
+        """
+        sources = {
+            # Full-text and partial keyword match through the search_vector GIN index
+            'full_text': queryset.filter(search_vector=search_query).annotate(
+                score=SearchRank(F('search_vector'), search_query)
+            ).order_by('-score') if search_query is not None else queryset.none(),
+            # Index-backed trigram conditions for fuzzy matching; thresholds come
+            # from SEARCH_TRIGRAM_* settings (see signals.set_trigram_thresholds)
+            'name': queryset.filter(name__trigram_word_similar=query_string).annotate(
+                score=TrigramWordSimilarity(query_string, 'name')
+            ).order_by('-score'),
+            'name_ar': queryset.filter(name_ar_normalized__trigram_word_similar=query_string).annotate(
+                score=TrigramWordSimilarity(query_string, 'name_ar_normalized')
+            ).order_by('-score'),
+            # Brand names repeat in every document, so match them in the small brand table
+            'brand': queryset.filter(
+                brand_id__in=Brand.objects.filter(name__trigram_similar=query_string).values('id')
+            ).order_by(),
+        }
+        return {source: source_qs for source, source_qs in sources.items() if names is None or source in names}
+
+    @staticmethod
+    def _candidate_union(queryset, query_string, search_query, names=None):
+        """Lazy UNION ALL of the candidate ids of every source, for use as a subquery"""
+        limit = settings.SEARCH_CANDIDATE_LIMIT
+        sources = ORMSearchBackend._candidate_sources(queryset, query_string, search_query, names)
+        parts = [source_qs.values_list('id')[:limit] for source_qs in sources.values()]
+        return parts[0].union(*parts[1:], all=True) if len(parts) > 1 else parts[0]
+
+    @staticmethod
+    def _retrieve_candidates(queryset, query_string, search_query, names=None):
+        """
+        Fetch the top candidate ids of every retrieval source in one UNION ALL query.
+        Returns the distinct ids and whether any source was cut off at the limit.
+        """
+        limit = settings.SEARCH_CANDIDATE_LIMIT
+        sources = ORMSearchBackend._candidate_sources(queryset, query_string, search_query, names)
+        querysets = [
+            source_qs.annotate(source=Value(source, output_field=CharField()))
+            .values_list('id', 'source')[:limit]
+            for source, source_qs in sources.items()
+        ]
+        rows = querysets[0].union(*querysets[1:], all=True) if len(querysets) > 1 else querysets[0]
+
+        candidate_ids = set()
+        per_source = dict.fromkeys(sources, 0)
+        for product_id, source in rows:
+            candidate_ids.add(product_id)
+            per_source[source] += 1
+        truncated = any(count >= limit for count in per_source.values())
+        return candidate_ids, truncated
+
     @staticmethod
     def _apply_filters(queryset, **filters):
         """Apply additional filters to the queryset"""
-        
-        if 'category' in filters and filters['category']:
-            queryset = queryset.filter(category__id=filters['category'])
-            
-        if 'brand' in filters and filters['brand']:
-            queryset = queryset.filter(brand__id=filters['brand'])
-            
-        if 'min_price' in filters and filters['min_price'] is not None:
-            queryset = queryset.filter(price__gte=filters['min_price'])
-            
-        if 'max_price' in filters and filters['max_price'] is not None:
-            queryset = queryset.filter(price__lte=filters['max_price'])
-            
-        return queryset
\ No newline at end of file
+        return queryset.filter(filter_conditions(**filters))
+
+
+class ProductSearchService:
+
+    _backend = None
+    _backend_lock = threading.Lock()
+
+    @staticmethod
+    def get_backend():
+        """Return the process-wide instance of the SEARCH_BACKEND class"""
+        if ProductSearchService._backend is None:
+            with ProductSearchService._backend_lock:
+                if ProductSearchService._backend is None:
+                    ProductSearchService._backend = import_string(settings.SEARCH_BACKEND)()
+        return ProductSearchService._backend
+
+    @staticmethod
+    def warm_up():
+        """Called once per worker process, e.g. to load an in-memory index"""
+        ProductSearchService.get_backend().warm_up()
+
+    @staticmethod
+    def search(query_string, tier=TIER_FULL, **filters):
+        """Search products with the configured backend, see ORMSearchBackend.search"""
+        # Retrieval for the ORM backend (it ranks when the page is read), ranking too for others
+        with timed('search'), replica_reads():
+            result = ProductSearchService.get_backend().search(query_string, tier=tier, **filters)
+            if result.queryset is not None:
+                # The ranking query runs when the caller reads the page, maybe outside of replica_reads()
+                result.queryset = result.queryset.using(read_alias())
+            return result
+
+    @staticmethod
+    def search_tiered(query_string, read, facets=(), **filters):
+        """
+        Search at the tier the current load allows and return `read(result,
+        facet_counts)` with the tier it ran at (backends ranking outside the
+        database always run at `full`). The search, the facet counts
+        and `read`, which evaluates the ranked queryset, run under the tier's
+        deadline; when it is missed the next tier is tried (see products.degradation).
+        """
+        governor = get_load_governor()
+        tiers = TIERS[governor.start_tier():] if settings.SEARCH_DEGRADATION else TIERS[:1]
+        with governor.track(), replica_reads():
+            for tier in tiers:
+                milliseconds = settings.SEARCH_TIER_DEADLINES_MS[tier] if settings.SEARCH_DEGRADATION else 0
+                try:
+                    with deadline(milliseconds, read_alias()):
+                        result = ProductSearchService.search(query_string, tier=tier, **filters)
+                        facet_counts = ProductSearchService.facets(
+                            query_string, facets, tier=tier, **filters
+                        ) if facets else None
+                        value = read(result, facet_counts)
+                except OperationalError as exc:
+                    if not is_query_canceled(exc) or tier == tiers[-1]:
+                        raise
+                    governor.record(tier, deadline_missed=True)
+                    continue
+                governor.record(result.tier)
+                return value, result.tier
+
+    @staticmethod
+    def search_batch(queries):
+        """Ranked ids of several searches with the configured backend, see ORMSearchBackend.search_batch"""
+        with timed('search'), replica_reads():
+            return ProductSearchService.get_backend().search_batch(queries)
+
+    @staticmethod
+    def facets(query_string, facets, tier=TIER_FULL, **filters):
+        """Facet counts of a search with the configured backend, see ORMSearchBackend.facets"""
+        with timed('facets'), replica_reads():
+            return ProductSearchService.get_backend().facets(query_string, facets, tier=tier, **filters)
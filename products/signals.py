@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import transaction
+
+from .cache import bump_generation
+
+
+def set_trigram_thresholds(sender, connection, **kwargs):
+    """
+    Apply the configured pg_trgm thresholds to every new database connection,
+    so the `%` and `<%` operators used by the search service match them.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT set_config('pg_trgm.similarity_threshold', %s, false), "
+            "set_config('pg_trgm.word_similarity_threshold', %s, false)",
+            [
+                str(settings.SEARCH_TRIGRAM_SIMILARITY_THRESHOLD),
+                str(settings.SEARCH_TRIGRAM_WORD_SIMILARITY_THRESHOLD),
+            ]
+        )
+
+
+def bump_search_generation(sender, **kwargs):
+    """
+    Invalidate cached search results after any catalog write. The generation
+    is bumped again on commit, because a search running concurrently with the
+    write could have cached pre-commit results under the first bump.
+    """
+    bump_generation()
+    transaction.on_commit(bump_generation)
@@ -0,0 +1,191 @@
+"""
+Spell correction of search input against the term dictionary (SearchTerm).
+
+Every query word that is neither a dictionary term nor the start of one
+(a partial keyword) is replaced by the most similar term, preferring
+frequent ones. All words, of all the queries of a batch, are looked up in
+one query against the small dictionary instead of comparing the input
+with every product. The corrected query then runs through the indexed
+full-text path, and the response reports it as `did_you_mean`.
+
+Excluded (`-word`) words, words shorter than SEARCH_SPELL_MIN_LENGTH and
+words with digits (sizes, codes) are never corrected. Dictionary terms
+are Arabic-normalized (products.arabic), so queries must be too.
+
+The dictionary is rebuilt from the active search documents by
+refresh_terms(), which the refresh_search_terms command runs. It recounts
+every word of the catalog, so its cost grows with the catalog and it is
+meant to run periodically, off the write path. Between refreshes,
+import_products adds the words first seen in the products it changed with
+add_terms(), whose cost follows the size of the import. Product writes do
+not update the dictionary, so they never contend on the counters of
+common words.
+"""
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .cache import bump_terms_version
+from .query import WORD, tokenize
+from .routers import read_alias
+
+# Words of a search document as the dictionary holds them: Arabic-normalized,
+# lowercased and unstemmed
+DOCUMENT_WORDS = (
+    "to_tsvector('simple', products_normalize_arabic("
+    "concat_ws(' ', d.name, d.name_ar, d.brand_name, d.category_name)))"
+)
+# Longer tokens (e.g. URLs) are never worth correcting to and would not fit SearchTerm.term
+MAX_TERM_LENGTH = 100
+
+# ts_stat counts the documents containing each word of the active catalog in
+# one pass; only terms whose count changed are written. Returns the number
+# of terms written and removed.
+REFRESH_SQL = f"""
+WITH fresh AS (
+    SELECT word AS term, ndoc AS frequency
+    FROM ts_stat($$SELECT {DOCUMENT_WORDS} FROM products_searchdocument d WHERE d.is_active$$)
+    WHERE length(word) <= {MAX_TERM_LENGTH}
+), removed AS (
+    DELETE FROM products_searchterm t
+    WHERE NOT EXISTS (SELECT 1 FROM fresh f WHERE f.term = t.term)
+    RETURNING 1
+), written AS (
+    INSERT INTO products_searchterm AS t (term, frequency)
+    SELECT term, frequency FROM fresh
+    ON CONFLICT (term) DO UPDATE SET frequency = EXCLUDED.frequency
+    WHERE t.frequency <> EXCLUDED.frequency
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM written), (SELECT count(*) FROM removed)
+"""
+# Words of the documents of products changed since a point in time that are
+# not terms yet. No active document contained them at the last refresh, so
+# their count in the changed documents is (at least, when other products
+# changed since that refresh) their count in the catalog. Counts of known
+# terms, and terms no product contains anymore, wait for the next refresh.
+ADD_TERMS_SQL = f"""
+WITH added AS (
+    INSERT INTO products_searchterm (term, frequency)
+    SELECT w.word, count(*)
+    FROM products_product p
+    JOIN products_searchdocument d ON d.id = p.id
+    CROSS JOIN unnest(tsvector_to_array({DOCUMENT_WORDS})) AS w(word)
+    WHERE p.updated_at >= %s AND d.is_active AND length(w.word) <= {MAX_TERM_LENGTH}
+    GROUP BY w.word
+    ORDER BY w.word
+    ON CONFLICT (term) DO NOTHING
+    RETURNING 1
+)
+SELECT count(*) FROM added
+"""
+# Concurrent refreshes would write the same terms in different orders
+REFRESH_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('products_searchterm'))"
+
+CORRECT_SQL = """
+SELECT q.word, known.term IS NOT NULL, known.term = q.word, fix.term
+FROM unnest(%s::text[]) AS q(word)
+LEFT JOIN LATERAL (
+    SELECT term FROM products_searchterm WHERE term LIKE q.word || '%%'
+    ORDER BY term = q.word DESC LIMIT 1
+) known ON true
+LEFT JOIN LATERAL (
+    SELECT term FROM products_searchterm
+    WHERE known.term IS NULL AND term %% q.word AND similarity(term, q.word) >= %s
+    ORDER BY similarity(term, q.word) DESC, frequency DESC, term
+    LIMIT 1
+) fix ON true
+"""
+
+
+@dataclass
+class Correction:
+    # The query with corrected words replaced, or the input when nothing changed
+    query_string: str
+    # The corrected query to show the user, None when nothing was corrected
+    did_you_mean: str = None
+    # True when every searched word is a dictionary term or was corrected to one, i.e.
+    # full-text search alone finds the intended products. A word that only starts a
+    # term is not enough: its stem may not be a prefix of the term's (chocolat, chocol)
+    complete: bool = False
+
+
+def _words(query_string):
+    """Distinct lowercased words of the query, excluded words left out"""
+    return list(dict.fromkeys(
+        word.lower()
+        for group in tokenize(query_string) for words, _, negated in group if not negated for word in words
+    ))
+
+
+def refresh_terms(using=DEFAULT_DB_ALIAS):
+    """
+    Bring the dictionary up to date with the active search documents and
+    return the number of terms written and removed
+    """
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(REFRESH_LOCK_SQL)
+        cursor.execute(REFRESH_SQL)
+        written, removed = cursor.fetchone()
+    if written or removed:
+        # Corrections, and so cached results of misspelled searches, may change
+        transaction.on_commit(bump_terms_version, using=using)
+    return written, removed
+
+
+def add_terms(since, using=DEFAULT_DB_ALIAS):
+    """
+    Add the words first seen in products changed since `since` (a database
+    timestamp) to the dictionary and return their number
+    """
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(REFRESH_LOCK_SQL)
+        cursor.execute(ADD_TERMS_SQL, [since])
+        added, = cursor.fetchone()
+    if added:
+        transaction.on_commit(bump_terms_version, using=using)
+    return added
+
+
+def lookup_words(words):
+    """
+    {word: (known, exact, fix)} for each of `words`: whether a term starts
+    with it, whether it is a term, and the term to correct it to (looked up
+    for unknown words only). One query against the dictionary table.
+    """
+    with connections[read_alias()].cursor() as cursor:
+        cursor.execute(CORRECT_SQL, [words, settings.SEARCH_SPELL_MIN_SIMILARITY])
+        return {word: (known, exact, fix) for word, known, exact, fix in cursor.fetchall()}
+
+
+def correct_queries(query_strings, lookup=lookup_words):
+    """
+    Correct the words of each query with the term dictionary, looking all
+    of them up with one `lookup` call (see lookup_words)
+    """
+    words = [_words(query_string) for query_string in query_strings]
+    # Every word is looked up, shorter ones and numbers may still be known terms
+    checked = sorted({word for query_words in words for word in query_words})
+    lookup = {
+        word: (known, exact, fix if len(word) >= settings.SEARCH_SPELL_MIN_LENGTH and word.isalpha() else None)
+        for word, (known, exact, fix) in (lookup(checked) if checked else {}).items()
+    }
+
+    results = []
+    for query_string, query_words in zip(query_strings, words):
+        corrections = {word: lookup[word][2] for word in query_words if lookup[word][2]}
+        complete = bool(query_words) and all(
+            exact or fix is not None for known, exact, fix in (lookup[word] for word in query_words)
+        )
+        if not corrections:
+            results.append(Correction(query_string, complete=complete))
+            continue
+        corrected = WORD.sub(lambda match: corrections.get(match.group().lower(), match.group()), query_string)
+        results.append(Correction(corrected, did_you_mean=corrected, complete=complete))
+    return results
+
+
+def correct_query(query_string, lookup=lookup_words):
+    """Correct the words of `query_string` with the term dictionary"""
+    return correct_queries([query_string], lookup)[0]
@@ -0,0 +1,18 @@
+'use strict';
+{
+    const $ = django.jQuery;
+
+    // Reload the changelist with the chosen value of an autocomplete list filter
+    $(function() {
+        $('select.autocomplete-filter').on('change', function() {
+            const url = new URL(window.location.href);
+            url.searchParams.delete('p');
+            if (this.value) {
+                url.searchParams.set(this.dataset.filterParameter, this.value);
+            } else {
+                url.searchParams.delete(this.dataset.filterParameter);
+            }
+            window.location.href = url.href;
+        });
+    });
+}
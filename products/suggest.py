@@ -0,0 +1,294 @@
+"""
+Precomputed prefix index behind /api/products/suggest/.
+
+Every product name, Arabic name, brand name and category name is an entry
+weighted by the number of active products it covers. Each entry is indexed
+under every word-start suffix ("dark chocolate", "chocolate") in one sorted
+key list, so a prefix lookup is a bisect followed by a top-N over the
+matching range. Top-N lists of prefixes with large ranges (short or
+very common prefixes) are memoized until an entry under them changes.
+
+The index also keeps the entries each product counts towards, so a
+changed product moves its weight from its previous entries to its current
+ones without recounting them. Writes made in this process are applied
+once they commit; those of other processes are found by their updated_at
+and tombstones (products.changes), in a background thread, so suggest
+requests never wait for them. The whole catalog is only read when the
+index is built.
+"""
+import bisect
+import heapq
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+
+from .arabic import normalize_arabic
+from .cache import get_generation
+from .changes import changed_product_ids, horizon
+from .models import Brand, Category, Product
+
+PRODUCT, PRODUCT_AR, BRAND, CATEGORY = range(4)
+KIND_NAMES = {PRODUCT: 'product', PRODUCT_AR: 'product', BRAND: 'brand', CATEGORY: 'category'}
+# Product field of each kind of entry
+LOOKUPS = {PRODUCT: 'name', PRODUCT_AR: 'name_ar', BRAND: 'brand__name', CATEGORY: 'category__name'}
+KINDS = len(LOOKUPS)
+# Entries of a product without a text of that kind, or of an inactive product
+NO_ENTRY = -1
+NO_ENTRIES = array('i', [NO_ENTRY] * KINDS)
+# Products re-read per query
+REFRESH_BATCH_SIZE = 5000
+
+
+def normalize(text):
+    return ' '.join(normalize_arabic(text or '').lower().split())
+
+
+def _word_suffixes(key):
+    words = key.split(' ')
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class SuggestionIndex:
+
+    # Attributes replaced together when a rebuilt index is swapped in
+    STATE = (
+        'keys', 'key_entries', 'texts', 'kinds', 'weights', 'entry_of', 'top_cache',
+        'product_ids', 'product_entries', 'generation', 'synced_at',
+    )
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held while products are read and applied, so an older read never overwrites a newer one
+        self._update_lock = threading.RLock()
+        self._syncing = False
+        self.keys = []  # sorted word-start suffixes
+        self.key_entries = array('I')  # entry id of each key
+        self.texts = []
+        self.kinds = array('b')
+        self.weights = array('I')
+        self.entry_of = {}  # (kind, normalized text) -> entry id
+        self.top_cache = {}
+        self.product_ids = array('q')  # sorted
+        self.product_entries = array('i')  # KINDS entry ids per product, in product_ids order
+        self.generation = None
+        self.synced_at = None  # horizon the next catch-up reads changes from
+        self.checked_at = 0.0
+
+    # Building
+
+    def build(self):
+        """Load the entries of every product from the database and swap them in"""
+        fresh = SuggestionIndex()
+        fresh._load()
+        with self._update_lock, self._lock:
+            for name in self.STATE:
+                setattr(self, name, getattr(fresh, name))
+            self.checked_at = time.monotonic()
+
+    def _load(self):
+        self.generation = get_generation()
+        self.synced_at = horizon()
+        rows = Product.objects.order_by('id').values_list('id', 'is_active', *LOOKUPS.values())
+        for product_id, is_active, *texts in rows.iterator(chunk_size=REFRESH_BATCH_SIZE):
+            self.product_ids.append(product_id)
+            self.product_entries.extend(self._entries(texts, sort=False) if is_active else NO_ENTRIES)
+        for entry in self.product_entries:
+            if entry != NO_ENTRY:
+                self.weights[entry] += 1
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.keys = [self.keys[i] for i in order]
+        self.key_entries = array('I', (self.key_entries[i] for i in order))
+
+    def _entries(self, texts, sort=True):
+        """Entry ids of a product's texts (see LOOKUPS), adding entries with weight 0 for new texts"""
+        entries = array('i')
+        for kind, text in enumerate(texts):
+            key = normalize(text)
+            if not key:
+                entries.append(NO_ENTRY)
+                continue
+            # Names differing only in case, spacing or Arabic variants share one entry
+            entry = self.entry_of.get((kind, key))
+            if entry is None:
+                entry = self.entry_of[(kind, key)] = len(self.texts)
+                self.texts.append(text)
+                self.kinds.append(kind)
+                self.weights.append(0)
+                for suffix in _word_suffixes(key):
+                    if sort:
+                        position = bisect.bisect_left(self.keys, suffix)
+                        self.keys.insert(position, suffix)
+                        self.key_entries.insert(position, entry)
+                    else:
+                        self.keys.append(suffix)
+                        self.key_entries.append(entry)
+            entries.append(entry)
+        return entries
+
+    def _slot(self, product_id, add=False):
+        """Position of `product_id` in product_ids, added (without entries) with `add`, else None"""
+        position = bisect.bisect_left(self.product_ids, product_id)
+        if position < len(self.product_ids) and self.product_ids[position] == product_id:
+            return position
+        if not add:
+            return None
+        self.product_ids.insert(position, product_id)
+        self.product_entries[position * KINDS:position * KINDS] = NO_ENTRIES
+        return position
+
+    def _forget_top_lists(self, entry):
+        """Drop memoized top lists that may now contain (or miss) `entry`"""
+        for suffix in _word_suffixes(normalize(self.texts[entry])):
+            for length in range(1, len(suffix) + 1):
+                self.top_cache.pop(suffix[:length], None)
+
+    # Incremental updates
+
+    def refresh_products(self, product_ids):
+        """
+        Re-read the given products and move their weight from the entries
+        they counted towards to their current ones (none when they are
+        inactive or deleted)
+        """
+        product_ids = sorted(set(product_ids))
+        with self._update_lock:
+            for start in range(0, len(product_ids), REFRESH_BATCH_SIZE):
+                batch = product_ids[start:start + REFRESH_BATCH_SIZE]
+                rows = Product.objects.filter(id__in=batch, is_active=True).values_list('id', *LOOKUPS.values())
+                texts_of = {product_id: texts for product_id, *texts in rows}
+                with self._lock:
+                    self._apply(batch, texts_of)
+
+    def _apply(self, product_ids, texts_of):
+        changed = set()
+        for product_id in product_ids:
+            texts = texts_of.get(product_id)
+            entries = self._entries(texts) if texts is not None else NO_ENTRIES
+            slot = self._slot(product_id, add=texts is not None)
+            if slot is None:
+                continue
+            span = slice(slot * KINDS, (slot + 1) * KINDS)
+            previous = self.product_entries[span]
+            if previous == entries:
+                continue
+            self.product_entries[span] = entries
+            for entry in previous:
+                if entry != NO_ENTRY:
+                    self.weights[entry] -= 1
+                    changed.add(entry)
+            for entry in entries:
+                if entry != NO_ENTRY:
+                    self.weights[entry] += 1
+                    changed.add(entry)
+        for entry in changed:
+            self._forget_top_lists(entry)
+
+    def sync(self):
+        """
+        Catch up with writes made by other processes, at most every
+        SUGGEST_SYNC_INTERVAL seconds and once the catalog generation moved.
+        The catch-up runs in a background thread; lookups keep using the
+        current entries meanwhile.
+        """
+        if time.monotonic() - self.checked_at < settings.SUGGEST_SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._syncing or time.monotonic() - self.checked_at < settings.SUGGEST_SYNC_INTERVAL:
+                return
+            self.checked_at = time.monotonic()
+            generation = get_generation()
+            if generation == self.generation:
+                return
+            self._syncing = True
+        threading.Thread(
+            target=self._sync_in_background, args=(generation,), name='suggest-sync', daemon=True
+        ).start()
+
+    def _sync_in_background(self, generation):
+        try:
+            self.catch_up(generation)
+        finally:
+            self._syncing = False
+            # The thread's own database connection
+            connection.close()
+
+    def catch_up(self, generation):
+        """
+        Re-read the products updated or deleted since the last catch-up.
+        Brand and category renames touch their products (migrations 0005
+        and 0016), so their entries move too.
+        """
+        with self._update_lock:
+            since = horizon()
+            self.refresh_products(changed_product_ids(self.synced_at))
+            with self._lock:
+                self.generation = generation
+                self.synced_at = since
+
+    # Lookups
+
+    def suggest(self, prefix, limit):
+        """Return up to `limit` (text, kind, weight) completions of `prefix`, heaviest first"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            cached = self.top_cache.get(prefix)
+            if cached is not None and len(cached) >= limit:
+                entries = cached[:limit]
+            else:
+                low = bisect.bisect_left(self.keys, prefix)
+                high = bisect.bisect_left(self.keys, prefix + '\uffff')
+                memoize = high - low >= settings.SUGGEST_MEMOIZE_MIN_KEYS
+                size = max(limit, settings.SUGGEST_MAX_LIMIT) if memoize else limit
+                candidates = {self.key_entries[i] for i in range(low, high)}
+                entries = heapq.nsmallest(
+                    size,
+                    (entry for entry in candidates if self.weights[entry]),
+                    key=lambda entry: (-self.weights[entry], self.texts[entry]),
+                )
+                if memoize:
+                    self.top_cache[prefix] = entries
+                entries = entries[:limit]
+            return [(self.texts[entry], KIND_NAMES[self.kinds[entry]], self.weights[entry]) for entry in entries]
+
+    # Signal receivers
+
+    def connect_signals(self):
+        # Bound methods are weakly referenced, so a discarded index disconnects itself
+        post_save.connect(self._product_changed, sender=Product)
+        post_delete.connect(self._product_changed, sender=Product)
+        for model in (Brand, Category):
+            post_save.connect(self._named_row_changed, sender=model)
+
+    def _product_changed(self, sender, instance, **kwargs):
+        product_ids = [instance.pk]
+        transaction.on_commit(lambda: self.refresh_products(product_ids))
+
+    def _named_row_changed(self, sender, instance, created, **kwargs):
+        if created:
+            return
+        # A rename moves the products to the new name's entry
+        products = Product.objects.filter(**{'brand_id' if sender is Brand else 'category_id': instance.pk})
+        transaction.on_commit(lambda: self.refresh_products(products.values_list('id', flat=True)))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_suggestion_index():
+    """Return the process-wide suggestion index, building it on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = SuggestionIndex()
+                index.build()
+                index.connect_signals()
+                _index = index
+    return _index
@@ -1,8 +1,47 @@
-from django.test import TestCase
-from django.urls import reverse
+import asyncio
+import csv
+import importlib
+import json
+import os
+import tempfile
+import threading
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.db.models import BooleanField, ExpressionWrapper, Q, Value
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve, reverse
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Category, Brand, NutritionFact, Product
+
+from .arabic import REMOVED, VARIANTS, normalize_arabic
+from .benchmark import generate_products, percentile
+from .cache import SearchResultCache, bump_generation, get_generation
+from .engine import (
+    InMemorySearchBackend, exclusion_terms, parse_query, query_matches, rank_operands, similarity, term_matches,
+    word_similarity,
+)
+from .metrics import RequestMetrics, get_histograms
+from .models import Category, Brand, NutritionFact, Product, RelatedProduct, SearchDocument, SearchTerm
+from .pagination import EstimatedCountPaginator, KeysetPagination
+from .query import exclusion_query, parse_search_query, tokenize
+from .routers import replica_reads
+from .renderers import FastJSONRenderer
+from .serializers import EncodedRows, ProductListSerializer, product_list_encoder
+from .services import ORMSearchBackend, ProductSearchService
+from .signals import set_trigram_thresholds
+from .spelling import add_terms, correct_query, lookup_words, refresh_terms
+from . import async_views, degradation, routers, suggest
 
 class ProductSearchAPITestCase(TestCase):
     def setUp(self):
@@ -109,3 +148,1598 @@ class ProductSearchAPITestCase(TestCase):
         response = self.client.get(url, {'q': 'Inactive'})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['count'], 0)  # Should not find inactive products
+
+    def test_search_misspelled_brand(self):
+        """Test that a misspelled brand name is matched through the trigram index"""
+        url = reverse('product-search')
+        response = self.client.get(url, {'q': 'Almarai'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['name'], 'Milk')
+
+    def test_search_query_operators(self):
+        """Test websearch-style operators and prefix matching"""
+        url = reverse('product-search')
+        names = lambda q: sorted(item['name'] for item in self.client.get(url, {'q': q}).data['results'])
+        self.assertEqual(names('milk or cola'), ['Cola Drink', 'Milk'])
+        self.assertEqual(names('dai -cola'), ['Milk'])  # category prefix
+        self.assertEqual(names('"cola drink"'), ['Cola Drink'])
+        # Partial words complete against names only; descriptions need whole words
+        self.assertEqual(names('cow'), ['Milk'])
+        self.assertEqual(names('refresh'), ['Cola Drink'])
+        self.assertEqual(names('refr'), [])
+
+    def test_search_reports_truncation(self):
+        """Test that the response says whether the candidate limit was hit"""
+        url = reverse('product-search')
+        response = self.client.get(url, {'q': 'Milk'})
+        self.assertFalse(response.data['truncated'])
+        with override_settings(SEARCH_CANDIDATE_LIMIT=1):
+            response = self.client.get(url, {'q': 'co'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['truncated'])
+
+    def test_trigram_threshold_setting(self):
+        """Test that the word similarity threshold is configurable"""
+        url = reverse('product-search')
+        self.assertEqual(self.client.get(url, {'q': 'Drnk'}).data['count'], 0)
+        try:
+            with override_settings(SEARCH_TRIGRAM_WORD_SIMILARITY_THRESHOLD=0.35):
+                set_trigram_thresholds(sender=None, connection=connection)
+                bump_generation()  # Drop the result cached with the old threshold
+                response = self.client.get(url, {'q': 'Drnk'})
+        finally:
+            set_trigram_thresholds(sender=None, connection=connection)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['name'], 'Cola Drink')
+
+
+class SearchVectorTriggerTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        self.almarai = Brand.objects.create(name='Al Marai')
+        self.milk = Product.objects.create(
+            name='Milk',
+            name_ar='حليب',
+            description='Fresh cow milk',
+            sku='MILK001',
+            price=3.99,
+            brand=self.almarai,
+            category=self.dairy,
+        )
+
+    def _lexemes(self, product):
+        product.refresh_from_db()
+        return str(product.search_vector)
+
+    def test_vector_populated_on_insert(self):
+        """Test that the trigger fills search_vector from product, brand and category"""
+        vector = self._lexemes(self.milk)
+        self.assertIn("'milk'", vector)
+        self.assertIn("'حليب'", vector)
+        self.assertIn("'marai'", vector)
+        self.assertIn("'dairi'", vector)
+
+    def test_vector_refreshed_on_brand_rename(self):
+        """Test that renaming a brand re-vectorizes its products"""
+        self.almarai.name = 'Nadec'
+        self.almarai.save()
+        vector = self._lexemes(self.milk)
+        self.assertIn("'nadec'", vector)
+        self.assertNotIn("'marai'", vector)
+
+    def test_vector_refreshed_on_category_rename(self):
+        """Test that renaming a category re-vectorizes its products"""
+        self.dairy.name = 'Beverages'
+        self.dairy.save()
+        self.assertIn("'beverag'", self._lexemes(self.milk))
+
+    def test_reindex_search_command(self):
+        """Test that reindex_search backfills missing vectors"""
+        Product.objects.filter(pk=self.milk.pk).update(search_vector=None)
+        call_command('reindex_search', workers=1, batch_size=1, stdout=StringIO())
+        self.assertIn("'milk'", self._lexemes(self.milk))
+
+
+class SearchDocumentTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        self.almarai = Brand.objects.create(name='Al Marai')
+        self.milk = Product.objects.create(name='Milk', name_ar='حليب', sku='MILK001', price=3.99,
+                                           brand=self.almarai, category=self.dairy)
+
+    def _document(self):
+        return SearchDocument.objects.values(
+            'name', 'name_ar', 'sku', 'price', 'brand_id', 'brand_name', 'category_name', 'is_active'
+        ).get(pk=self.milk.pk)
+
+    def test_document_follows_product_writes(self):
+        """Test that inserts, updates and deletes of products are copied to their documents"""
+        document = SearchDocument.objects.get(pk=self.milk.pk)
+        self.assertEqual(document.brand_name, 'Al Marai')
+        self.assertEqual(document.category_name, 'Dairy')
+        self.assertEqual(str(document.search_vector), str(Product.objects.get(pk=self.milk.pk).search_vector))
+
+        nadec = Brand.objects.create(name='Nadec')
+        Product.objects.filter(pk=self.milk.pk).update(price='4.50', brand=nadec, is_active=False)
+        document = self._document()
+        self.assertEqual((document['price'], document['brand_id'], document['brand_name'], document['is_active']),
+                         (Decimal('4.50'), nadec.id, 'Nadec', False))
+
+        self.milk.delete()
+        self.assertFalse(SearchDocument.objects.exists())
+
+    def test_document_follows_brand_and_category_renames(self):
+        """Test that renamed brands and categories are copied, even when the vector is unchanged"""
+        self.almarai.name = 'AL MARAI'
+        self.almarai.save()
+        self.dairy.name = 'Dairy & Eggs'
+        self.dairy.save()
+        document = self._document()
+        self.assertEqual((document['brand_name'], document['category_name']), ('AL MARAI', 'Dairy & Eggs'))
+
+    def test_backfill_writes_missing_documents(self):
+        """Test that the backfill command creates missing documents in keyset batches and keeps the others"""
+        for index in range(4):
+            Product.objects.create(name=f'Yogurt {index}', sku=f'YOG{index}', price='1.00',
+                                   brand=self.almarai, category=self.dairy)
+        SearchDocument.objects.exclude(pk=self.milk.pk).delete()
+        # Documents written before the column was maintained
+        SearchDocument.objects.filter(pk=self.milk.pk).update(name_ar_normalized=None)
+        out = StringIO()
+        call_command('backfill_search_documents', batch_size=2, stdout=out)
+        self.assertIn('Wrote 4 search documents and normalized 1 Arabic names in 3 batches', out.getvalue())
+        self.assertEqual(SearchDocument.objects.count(), 5)
+        self.assertEqual(SearchDocument.objects.get(sku='YOG3').brand_name, 'Al Marai')
+        self.assertEqual(SearchDocument.objects.get(pk=self.milk.pk).name_ar_normalized, 'حليب')
+
+    def test_search_reads_only_search_documents(self):
+        """Test that the search queries never read the product or category tables"""
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get(reverse('product-search'), {'q': 'milk', 'facets': 'brand,category'})
+        self.assertEqual(response.data['results'][0]['brand_name'], 'Al Marai')
+        # Brand names are fuzzy matched in products_brand, see ORMSearchBackend._candidate_sources
+        product_tables = ('"products_product"', '"products_category"')
+        for query in queries.captured_queries:
+            self.assertFalse(any(table in query['sql'] for table in product_tables), query['sql'])
+
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        almarai = Brand.objects.create(name='Al Marai')
+        for index, (name, price) in enumerate([('Milk', 3.99), ('Milk Powder', 12.50),
+                                               ('Laban', 1.25), ('Milk Drink', 3.99)]):
+            Product.objects.create(name=name, sku=f'SKU{index}', price=price,
+                                   brand=almarai, category=dairy)
+        self.client = APIClient()
+
+    def _walk(self, url, params):
+        names, response = [], self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            names.extend(item['name'] for item in response.data['results'])
+            if not response.data['next']:
+                return names, response
+            response = self.client.get(response.data['next'])
+
+    @patch.object(KeysetPagination, 'page_size', 1)
+    def test_list_cursor_pages(self):
+        """Test that cursor pages follow the requested ordering, including ties"""
+        url = reverse('product-list')
+        names, last = self._walk(url, {'pagination': 'cursor', 'ordering': '-price'})
+        self.assertEqual(names, ['Milk Powder', 'Milk Drink', 'Milk', 'Laban'])
+        previous = self.client.get(last.data['previous'])
+        self.assertEqual([item['name'] for item in previous.data['results']], ['Milk'])
+        self.assertIsNotNone(previous.data['next'])
+
+    @patch.object(KeysetPagination, 'page_size', 2)
+    def test_search_cursor_pages_match_page_numbers(self):
+        """Test that search cursor pages return the same order as page numbers"""
+        url = reverse('product-search')
+        expected = [item['name'] for item in self.client.get(url, {'q': 'milk'}).data['results']]
+        names, last = self._walk(url, {'q': 'milk', 'pagination': 'cursor'})
+        self.assertEqual(names, expected)
+        self.assertIn('truncated', last.data)
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.client.get(reverse('product-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SearchResultCacheTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        self.almarai = Brand.objects.create(name='Al Marai')
+        self.milk = Product.objects.create(name='Milk', sku='MILK001', price=3.99,
+                                           brand=self.almarai, category=self.dairy)
+        self.client = APIClient()
+        self.url = reverse('product-search')
+
+    def test_repeated_search_is_served_from_cache(self):
+        """Test that an identical (normalized) search is a cache hit"""
+        stats = SearchResultCache().stats()
+        first = self.client.get(self.url, {'q': 'Milk'})
+        second = self.client.get(self.url, {'q': '  milk '})
+        self.assertEqual(first['X-Search-Cache'], 'MISS')
+        self.assertEqual(second['X-Search-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        new_stats = SearchResultCache().stats()
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+
+    def test_filters_and_pages_are_cached_separately(self):
+        """Test that filters and page parameters are part of the cache key"""
+        self.client.get(self.url, {'q': 'Milk'})
+        response = self.client.get(self.url, {'q': 'Milk', 'brand': self.almarai.id + 1})
+        self.assertEqual(response['X-Search-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 0)
+
+    def test_catalog_writes_invalidate_cache(self):
+        """Test that saving or deleting a product, brand or category drops cached results"""
+        self.client.get(self.url, {'q': 'Milk'})
+        Product.objects.create(name='Milk Powder', sku='MILK002', price=9.99,
+                               brand=self.almarai, category=self.dairy)
+        response = self.client.get(self.url, {'q': 'Milk'})
+        self.assertEqual(response['X-Search-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 2)
+
+        self.almarai.name = 'Nadec'
+        self.almarai.save()
+        self.assertEqual(self.client.get(self.url, {'q': 'Milk'})['X-Search-Cache'], 'MISS')
+
+        self.milk.delete()
+        response = self.client.get(self.url, {'q': 'Milk'})
+        self.assertEqual(response['X-Search-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 1)
+
+
+class SearchFacetsTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        self.beverages = Category.objects.create(name='Beverages')
+        self.almarai = Brand.objects.create(name='Al Marai')
+        self.nadec = Brand.objects.create(name='Nadec')
+        for sku, name, price, brand, category in [
+            ('MILK001', 'Milk', '3.99', self.almarai, self.dairy),
+            ('MILK002', 'Milk Powder', '24.50', self.almarai, self.dairy),
+            ('MILK003', 'Milk', '4.25', self.nadec, self.dairy),
+            ('MILK004', 'Milkshake', '7.00', self.nadec, self.beverages),
+            ('COLA001', 'Cola', '1.99', self.nadec, self.beverages),
+        ]:
+            Product.objects.create(sku=sku, name=name, price=price, brand=brand, category=category)
+        self.client = APIClient()
+        self.url = reverse('product-search')
+
+    @staticmethod
+    def counts(values):
+        return {value['name']: value['count'] for value in values}
+
+    def test_facets_count_the_search_results(self):
+        """Test that facet counts cover the matching products in one query"""
+        with self.assertNumQueries(2):  # The spelling lookup, then the counts
+            facets = ProductSearchService.facets('milk', ['brand', 'category', 'price'])
+        self.assertEqual(self.counts(facets['brand']), {'Al Marai': 2, 'Nadec': 2})
+        self.assertEqual(self.counts(facets['category']), {'Dairy': 3, 'Beverages': 1})
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [0, 2, 1, 0, 1, 0])
+        self.assertEqual(facets['price'][1], {'min': 2, 'max': 5, 'count': 2})
+
+    def test_facets_ignore_their_own_filter(self):
+        """Test that each facet applies every active filter except its own"""
+        response = self.client.get(self.url, {
+            'q': 'milk', 'brand': self.nadec.id, 'max_price': '5', 'facets': 'brand,category,price',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        facets = response.data['facets']
+        self.assertEqual(self.counts(facets['brand']), {'Al Marai': 1, 'Nadec': 1})
+        self.assertEqual(self.counts(facets['category']), {'Dairy': 1})
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [0, 1, 1, 0, 0, 0])
+
+    @override_settings(SEARCH_CANDIDATE_LIMIT=1)
+    def test_facets_count_filtered_candidates_before_the_limit(self):
+        """Test that the other facets' filters apply inside retrieval, so capped counts match the results"""
+        # Ranks above every Nadec milk, so it would take the only candidate slot unfiltered
+        Product.objects.create(sku='MILK005', name='Milk Milk', description='Milk', price='3.00',
+                               brand=self.almarai, category=self.beverages)
+        response = self.client.get(self.url, {'q': 'milk', 'brand': self.nadec.id, 'facets': 'brand,category'})
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(sum(self.counts(response.data['facets']['category']).values()), 1)
+
+    def test_facets_are_opt_in_and_cached_with_the_page(self):
+        """Test that facets are only computed on request and cached with the result page"""
+        self.assertNotIn('facets', self.client.get(self.url, {'q': 'milk'}).data)
+        first = self.client.get(self.url, {'q': 'milk', 'facets': 'category, unknown'})
+        self.assertEqual(first['X-Search-Cache'], 'MISS')
+        self.assertEqual(list(first.data['facets']), ['category'])
+        with self.assertNumQueries(1):  # Hydrating the page
+            second = self.client.get(self.url, {'q': 'Milk', 'facets': 'category'})
+        self.assertEqual(second['X-Search-Cache'], 'HIT')
+        self.assertEqual(second.data['facets'], first.data['facets'])
+
+    def test_facets_of_filter_only_search(self):
+        """Test facet counts without a query string"""
+        response = self.client.get(self.url, {'category': self.beverages.id, 'facets': 'category'})
+        self.assertEqual(self.counts(response.data['facets']['category']), {'Dairy': 3, 'Beverages': 2})
+
+
+class SearchBatchTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        beverages = Category.objects.create(name='Beverages')
+        self.almarai = Brand.objects.create(name='Al Marai')
+        for sku, name, price, category in [
+            ('MILK001', 'Milk', '3.99', dairy),
+            ('MILK002', 'Milk Powder', '24.50', dairy),
+            ('COLA001', 'Cola', '1.99', beverages),
+            ('JUIC001', 'Orange Juice', '5.50', beverages),
+        ]:
+            Product.objects.create(sku=sku, name=name, price=price, brand=self.almarai, category=category)
+        self.client = APIClient()
+        self.url = reverse('product-search-batch')
+
+    def test_batch_runs_searches_in_one_query(self):
+        """Test that every search of the batch is answered, in input order, with one search query"""
+        queries = [
+            {'q': 'cola'},
+            {'q': 'milk', 'max_price': '10'},
+            {'brand': self.almarai.id, 'limit': 2},
+            {'q': 'milk -powder'},
+        ]
+        # The spelling lookup of all searches, the searches, then hydrating their products
+        with self.assertNumQueries(3):
+            response = self.client.post(self.url, queries, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['ok'] * 4)
+        self.assertEqual([[row['name'] for row in result['results']] for result in results], [
+            ['Cola'], ['Milk'], ['Cola', 'Milk'], ['Milk'],
+        ])
+        self.assertEqual(results[2]['count'], 2)
+        # Rendered by FastJSONRenderer like the serializer would
+        self.assertEqual(json.loads(response.content), json.loads(JSONRenderer().render(
+            {'results': [{**result, 'results': list(result['results'])} for result in results]}
+        )))
+
+    def test_batch_matches_single_searches(self):
+        """Test that the batch ranks like the search endpoint"""
+        response = self.client.post(self.url, [{'q': 'milk'}], format='json')
+        single = self.client.get(reverse('product-search'), {'q': 'milk'})
+        self.assertEqual(response.data['results'][0]['results'], single.data['results'])
+
+    def test_invalid_searches_report_errors_in_place(self):
+        """Test that an invalid search gets an error status without failing the batch"""
+        response = self.client.post(self.url, [{'q': 'juice'}, {'min_price': 'cheap'}, {'limit': 0}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['ok', 'error', 'error'])
+        self.assertEqual(results[0]['results'][0]['name'], 'Orange Juice')
+        self.assertIn('min_price', results[1]['errors'])
+        self.assertIn('limit', results[2]['errors'])
+
+    @override_settings(SEARCH_BATCH_MAX_QUERIES=2)
+    def test_batch_must_be_a_short_list(self):
+        """Test that the body must be a list of at most SEARCH_BATCH_MAX_QUERIES searches"""
+        self.assertEqual(self.client.post(self.url, {'q': 'milk'}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(self.url, [{'q': 'milk'}] * 3, format='json').status_code, 400)
+
+    def test_batch_is_cached_as_a_whole(self):
+        """Test that a repeated batch is served from one cache entry"""
+        queries = [{'q': 'milk'}, {'q': 'Cola '}]
+        self.assertEqual(self.client.post(self.url, queries, format='json')['X-Search-Cache'], 'MISS')
+        with self.assertNumQueries(1):  # Hydrating the products
+            response = self.client.post(self.url, [{'q': 'MILK'}, {'q': 'cola'}], format='json')
+        self.assertEqual(response['X-Search-Cache'], 'HIT')
+        self.assertEqual(response.data['results'][1]['results'][0]['name'], 'Cola')
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Dairy')
+        self.brand = Brand.objects.create(name='Al Marai')
+        self.product = Product.objects.create(
+            sku='MILK001', name='Milk', price='3.99', brand=self.brand, category=self.category
+        )
+        self.client = APIClient()
+
+    def test_unchanged_catalog_answers_not_modified(self):
+        """Test that a matching If-None-Match gets a 304 without querying the database"""
+        for url, params in [
+            (reverse('product-list'), {}),
+            (reverse('product-detail', args=[self.product.id]), {}),
+            (reverse('product-search'), {'q': 'milk'}),
+            (reverse('category-list'), {}),
+        ]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('public', response['Cache-Control'])
+            self.assertIn('Accept', response['Vary'])
+            self.assertIn('Last-Modified', response)
+            with self.assertNumQueries(0):
+                cached = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(cached['ETag'], response['ETag'])
+            self.assertIn('max-age', cached['Cache-Control'])
+
+    def test_writes_change_the_etag(self):
+        """Test that a catalog write, including a nutrition fact, invalidates earlier ETags"""
+        url = reverse('product-detail', args=[self.product.id])
+        etag = self.client.get(url)['ETag']
+        self.product.nutrition_facts = NutritionFact.objects.create(calories=42)
+        self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['nutrition_facts']['calories'], 42)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_media_type(self):
+        """Test that the JSON and browsable API representations have different ETags"""
+        url = reverse('brand-list')
+        self.assertNotEqual(
+            self.client.get(url, HTTP_ACCEPT='application/json')['ETag'],
+            self.client.get(url, HTTP_ACCEPT='text/html')['ETag'],
+        )
+
+    def test_catalog_lists_are_cached_until_a_write(self):
+        """Test that category and brand lists come from the cache and follow writes"""
+        url = reverse('category-list')
+        self.assertEqual(self.client.get(url).data['count'], 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['count'], 1)
+        Category.objects.create(name='Beverages')
+        self.assertEqual(self.client.get(url).data['count'], 2)
+
+    def test_errors_are_not_cacheable(self):
+        """Test that missing products get no validators"""
+        response = self.client.get(reverse('product-detail', args=[self.product.id + 1]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('ETag', response)
+
+
+REPLICA = 'replica_test'
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA], DB_REPLICA_MAX_LAG=0.0, DB_REPLICA_CHECK_INTERVAL=0.0)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Primary and replica are two Postgres databases: the test database and a
+    clone of it. They do not replicate, so rows written to only one of them
+    show which database a request read.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added once the test case is set up, since the test runner only knows configured databases
+        creation = connections['default'].creation
+        connections.close_all()  # Postgres clones a database only when nobody is connected to it
+        creation.clone_test_db(suffix='replica', verbosity=0)
+        connections.settings[REPLICA] = creation.get_test_db_clone_settings('replica')
+        cls.databases = {*cls.databases, REPLICA}
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[REPLICA].close()
+        connections['default'].creation.destroy_test_db(verbosity=0, suffix='replica')
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        cls.databases = cls.databases - {REPLICA}
+        super().tearDownClass()
+
+    def setUp(self):
+        # Anonymous throttling counts the requests of every earlier test
+        caches['default'].clear()
+        routers._monitor = None
+        self.addCleanup(setattr, routers, '_monitor', None)
+        for database, name in [('default', 'Primary Milk'), (REPLICA, 'Replica Milk')]:
+            brand = Brand.objects.using(database).create(name='Almarai')
+            category = Category.objects.using(database).create(name='Dairy')
+            Product.objects.using(database).create(
+                name=name, sku='MILK1', price='3.99', brand=brand, category=category
+            )
+        self.client = APIClient()
+        self.url = reverse('product-search')
+
+    def tearDown(self):
+        Brand.objects.using(REPLICA).all().delete()
+        Category.objects.using(REPLICA).all().delete()
+
+    def search(self, **headers):
+        return [row['name'] for row in self.client.get(self.url, {'q': 'milk'}, **headers).data['results']]
+
+    def test_searches_and_catalog_reads_use_the_replica(self):
+        """Test that search, listing and detail reads go to a healthy replica"""
+        self.assertEqual(self.search(), ['Replica Milk'])
+        self.assertEqual(self.client.get(reverse('product-list')).data['results'][0]['name'], 'Replica Milk')
+        self.assertEqual(Product.objects.get().name, 'Primary Milk')  # Outside of the viewsets
+
+    def test_client_that_wrote_reads_from_the_primary(self):
+        """Test that a request that writes pins its client to the primary"""
+        def write(request):
+            with replica_reads():
+                Brand.objects.create(name='Nadec')
+                return HttpResponse()
+
+        response = routers.ReplicaPinningMiddleware(write)(RequestFactory().post('/'))
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], settings.DB_PRIMARY_PIN_SECONDS)
+        self.client.cookies[routers.PIN_COOKIE] = '1'
+        self.assertEqual(self.search(), ['Primary Milk'])
+
+    @override_settings(DB_REPLICA_MAX_LAG=60.0)
+    def test_recent_catalog_write_reads_from_the_primary(self):
+        """Test that reads stay on the primary while replicas may not have replayed a write"""
+        self.assertEqual(self.search(), ['Primary Milk'])
+
+    def test_lagging_or_failing_replica_is_skipped(self):
+        """Test that a replica behind by more than DB_REPLICA_MAX_LAG, or failing its check, is not used"""
+        with patch.object(routers.ReplicaMonitor, 'check', return_value=30.0):
+            self.assertEqual(self.search(), ['Primary Milk'])
+        replica = connections[REPLICA]
+        port = replica.settings_dict['PORT']
+        replica.close()
+        replica.settings_dict['PORT'] = '1'
+        try:
+            with self.assertLogs('products.routers', 'WARNING'):
+                self.assertEqual(self.search(), ['Primary Milk'])
+        finally:
+            replica.settings_dict['PORT'] = port
+        self.assertEqual(self.search(), ['Replica Milk'])
+
+    def test_replica_behind_the_primary_position_is_skipped(self):
+        """Test that a replica that has not replayed the primary's WAL position is not used"""
+        # The clone is not in recovery; checking it as if it were, it has replayed nothing
+        lag_sql = routers.LAG_SQL.replace('NOT pg_is_in_recovery()', 'false')
+        with patch.object(routers, 'LAG_SQL', lag_sql):
+            monitor = routers.ReplicaMonitor([REPLICA])
+            self.assertEqual(monitor.healthy(), [])
+            self.assertEqual(monitor.lags[REPLICA], float('inf'))
+        self.assertEqual(self.search(), ['Replica Milk'])
+
+
+class ProductExportTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        beverages = Category.objects.create(name='Beverages')
+        brand = Brand.objects.create(name='Almarai', country_of_origin='Saudi Arabia')
+        self.milk = Product.objects.create(
+            sku='MILK001', name='Milk', name_ar='حليب', price='3.99', brand=brand, category=self.dairy,
+            nutrition_facts=NutritionFact.objects.create(calories=42, protein=3.4),
+        )
+        Product.objects.create(sku='MILK002', name='Milk Powder', price='24.50', brand=brand, category=self.dairy)
+        Product.objects.create(sku='COLA001', name='Cola', price='1.99', brand=brand, category=beverages)
+        self.client = APIClient()
+        self.url = reverse('product-export')
+
+    def export(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson_rows_match_product_details(self):
+        """Test that NDJSON rows are the detail representation, read in one query"""
+        with self.assertNumQueries(1):
+            response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['Cola', 'Milk', 'Milk Powder'])
+        detail = self.client.get(reverse('product-detail', args=[self.milk.id])).json()
+        del detail['search_vector']
+        self.assertEqual(rows[1], detail)
+        self.assertIsNone(rows[2]['nutrition_facts'])
+
+    def test_csv_with_filters_and_ordering(self):
+        """Test CSV output with flattened nested columns, filters and ordering"""
+        response, content = self.export(output='csv', category=self.dairy.id, ordering='-price')
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual([row['sku'] for row in rows], ['MILK002', 'MILK001'])
+        self.assertEqual(rows[1]['brand.country_of_origin'], 'Saudi Arabia')
+        self.assertEqual(rows[1]['nutrition_facts.calories'], '42.0')
+        self.assertEqual(rows[0]['nutrition_facts.calories'], '')
+
+    def test_search_export_keeps_rank_order(self):
+        """Test that an export with a query has the search results in rank order"""
+        _, content = self.export(q='milk', max_price='10')
+        self.assertEqual([json.loads(line)['sku'] for line in content.splitlines()], ['MILK001'])
+        self.assertEqual(self.client.get(self.url, {'output': 'xml'}).status_code, 400)
+
+    def test_export_command(self):
+        """Test that export_products writes the same rows in small chunks"""
+        out = StringIO()
+        call_command('export_products', query='milk', chunk_size=1, stdout=out, stderr=StringIO())
+        _, content = self.export(q='milk')
+        self.assertEqual(out.getvalue(), content)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'products.csv')
+            call_command('export_products', output=path, stderr=StringIO())
+            with open(path, encoding='utf-8') as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 3)
+
+
+class SpellCorrectionTestCase(TestCase):
+    def setUp(self):
+        self.dairy = Category.objects.create(name='Dairy')
+        self.brand = Brand.objects.create(name='Almarai')
+        self.milk = Product.objects.create(
+            sku='MILK001', name='Chocolate Milk', price='3.99', brand=self.brand, category=self.dairy
+        )
+        Product.objects.create(sku='CHEESE001', name='Cheddar Cheese', price='9.99', brand=self.brand, category=self.dairy)
+        call_command('refresh_search_terms', stdout=StringIO())
+        self.client = APIClient()
+        self.url = reverse('product-search')
+
+    def frequencies(self, *terms):
+        return dict(SearchTerm.objects.filter(term__in=terms).values_list('term', 'frequency'))
+
+    def test_dictionary_follows_refreshes(self):
+        """Test that a refresh counts the words of active products only, and writes wait for it"""
+        self.assertEqual(self.frequencies('chocolate', 'almarai', 'dairy'),
+                         {'chocolate': 1, 'almarai': 2, 'dairy': 2})
+        self.assertEqual(refresh_terms(), (0, 0))
+        self.milk.name = 'Strawberry Milk'
+        self.milk.save()
+        Product.objects.filter(sku='CHEESE001').update(is_active=False)
+        self.assertEqual(self.frequencies('chocolate', 'strawberry'), {'chocolate': 1})
+
+        generation = get_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh_terms()
+        self.assertEqual(self.frequencies('chocolate', 'strawberry', 'cheddar', 'almarai'),
+                         {'strawberry': 1, 'almarai': 1})
+        self.assertNotEqual(get_generation(), generation)
+        self.milk.delete()
+        refresh_terms()
+        self.assertFalse(SearchTerm.objects.exists())
+
+    def test_new_words_are_added_incrementally(self):
+        """Test that add_terms adds the new words of changed products and leaves known terms"""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT clock_timestamp()')
+            since, = cursor.fetchone()
+        self.milk.name = 'Strawberry Milk'
+        self.milk.save()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.assertEqual(add_terms(since), 1)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.frequencies('strawberry', 'chocolate', 'almarai'),
+                         {'strawberry': 1, 'chocolate': 1, 'almarai': 2})
+        self.assertEqual(add_terms(since), 0)
+
+    def test_misspelled_query_is_corrected(self):
+        """Test that a misspelling is searched corrected and reported as did_you_mean"""
+        response = self.client.get(self.url, {'q': 'choclate milk'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['did_you_mean'], 'chocolate milk')
+        self.assertEqual([product['sku'] for product in response.data['results']], ['MILK001'])
+
+    def test_known_words_are_kept(self):
+        """Test that known words, partial keywords, excluded and numeric words are not corrected"""
+        correction = correct_query('choc milk -chedar 500ml')
+        self.assertIsNone(correction.did_you_mean)
+        self.assertEqual(correction.query_string, 'choc milk -chedar 500ml')
+        # A partial keyword may not match the stemmed full-text lexemes, so trigram sources stay on
+        self.assertFalse(correct_query('chocolat').complete)
+        self.assertTrue(correct_query('almarai chocolate').complete)
+        response = self.client.get(self.url, {'q': 'chocolate'})
+        self.assertIsNone(response.data['did_you_mean'])
+
+    @override_settings(SEARCH_SPELL_CORRECTION=False)
+    def test_correction_can_be_disabled(self):
+        """Test that without correction misspellings still match by trigram similarity"""
+        result = ProductSearchService.search('chocolat')
+        self.assertIsNone(result.did_you_mean)
+        self.assertEqual([product.sku for product in result.queryset], ['MILK001'])
+
+
+class SearchDegradationTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        brand = Brand.objects.create(name='Almarai')
+        for sku, name in [('MILK001', 'Milk'), ('MILK002', 'Milk Powder'), ('MILK003', 'Chocolate Milk')]:
+            Product.objects.create(sku=sku, name=name, price='3.99', brand=brand, category=dairy)
+        call_command('refresh_search_terms', stdout=StringIO())
+        self.url = reverse('product-search')
+        caches['default'].clear()
+        degradation._governor = None
+        self.addCleanup(setattr, degradation, '_governor', None)
+
+    def test_tier_is_reported(self):
+        """Test that the tier is in the response, its header, and the metrics endpoint"""
+        response = APIClient().get(self.url, {'q': 'milk'})
+        self.assertEqual((response.data['tier'], response['X-Search-Tier']), ('full', 'full'))
+        client = APIClient()
+        client.force_authenticate(get_user_model()(username='admin', is_staff=True))
+        load = client.get(reverse('metrics')).data['search_load']
+        self.assertEqual(load['tiers']['full'], 1)
+        self.assertEqual(load['inflight'], 0)
+
+    def test_overload_starts_at_cheaper_tiers(self):
+        """Test that a latency above the SLO degrades searches, and twice above it to prefix-only"""
+        governor = degradation.get_load_governor()
+        governor.latency_ms = settings.SEARCH_LATENCY_SLO_MS * 1.5
+        response = APIClient().get(self.url, {'q': 'almari'})
+        self.assertEqual(response.data['tier'], 'full_text')
+        # The brand misspelling is spell-corrected, trigram sources are not needed
+        self.assertEqual(response.data['count'], 3)
+        governor.latency_ms = settings.SEARCH_LATENCY_SLO_MS * 5
+        response = APIClient().get(self.url, {'q': 'milk'})
+        self.assertEqual(response.data['tier'], 'prefix')
+        self.assertEqual([product['name'] for product in response.data['results']],
+                         ['Chocolate Milk', 'Milk', 'Milk Powder'])
+
+    def test_degraded_results_are_not_revalidated(self):
+        """Test that degraded results carry no validators and a short max-age"""
+        degradation.get_load_governor().latency_ms = settings.SEARCH_LATENCY_SLO_MS * 5
+        response = APIClient().get(self.url, {'q': 'milk'})
+        self.assertEqual(response['X-Search-Tier'], 'prefix')
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn(f'max-age={settings.SEARCH_DEGRADED_CACHE_TIMEOUT}', response['Cache-Control'])
+        # A cache revalidating its degraded copy by date gets the search run again
+        last_modified = APIClient().get(reverse('product-list'))['Last-Modified']
+        response = APIClient().get(self.url, {'q': 'milk'}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Search-Tier'], 'prefix')
+
+    @override_settings(SEARCH_TIER_DEADLINES_MS={'full': 50, 'full_text': 1000, 'prefix': 1000})
+    def test_missed_deadline_falls_to_next_tier(self):
+        """Test that a search cancelled by its deadline is answered by the next tier"""
+        def read(result, facet_counts):
+            if result.tier == 'full':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_sleep(1)')
+            return list(result.queryset.values_list('name', flat=True))
+
+        names, tier = ProductSearchService.search_tiered('milk', read)
+        self.assertEqual(tier, 'full_text')
+        self.assertEqual(len(names), 3)
+        self.assertEqual(degradation.get_load_governor().snapshot()['deadlines_missed']['full'], 1)
+        # The connection's own timeout is back once the search is done
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone()[0], '0')
+
+
+class ArabicNormalizationTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        brand = Brand.objects.create(name='Almarai')
+        self.chocolate = Product.objects.create(
+            sku='CHOC001', name='Hazelnut Chocolate', name_ar='شوكولاتة بالبندق', price='4.50',
+            brand=brand, category=dairy,
+        )
+        self.rice = Product.objects.create(
+            sku='RICE001', name='Basmati Rice', name_ar='أرز بسمتي', price='12.00', brand=brand, category=dairy,
+        )
+        self.yogurt = Product.objects.create(
+            sku='YOG001', name='Yogurt', name_ar='زبادي طبيعي ١ كجم', price='6.00', brand=brand, category=dairy,
+        )
+        call_command('refresh_search_terms', stdout=StringIO())
+
+    def test_python_and_sql_normalizers_agree(self):
+        """Test that queries are normalized exactly like the stored text"""
+        samples = ['أإآٱ ةىؤئ', '٠١٢٣٤٥٦٧٨٩ ۰۱۲۳۴۵۶۷۸۹', 'حَلِيبٌ ـطازجـ' + REMOVED, 'Milk 1L', '']
+        with connection.cursor() as cursor:
+            for text in samples:
+                cursor.execute('SELECT products_normalize_arabic(%s)', [text])
+                self.assertEqual(cursor.fetchone()[0], normalize_arabic(text))
+        self.assertEqual(normalize_arabic(''.join(VARIANTS) + REMOVED), ''.join(VARIANTS.values()))
+        self.assertEqual(
+            SearchDocument.objects.get(id=self.rice.id).name_ar_normalized, 'ارز بسمتي'
+        )
+        self.rice.name_ar = 'أرز مصري'
+        self.rice.save()
+        self.assertEqual(SearchDocument.objects.get(id=self.rice.id).name_ar_normalized, 'ارز مصري')
+
+    def test_spelling_variants_find_the_same_products(self):
+        """Test that hamza, taa marbuta, alef maqsura, tashkeel, tatweel and digit variants match"""
+        cases = {
+            'شوكولاته': self.chocolate, 'شَوكُولاتة': self.chocolate, 'شوكـولاتة بالبندق': self.chocolate,
+            'ارز': self.rice, 'إرز بسمتى': self.rice,
+            'زبادى': self.yogurt, 'زبادي 1 كجم': self.yogurt,
+        }
+        for query, product in cases.items():
+            with self.subTest(query=query):
+                result = ProductSearchService.search(query)
+                self.assertEqual([item.id for item in result.queryset], [product.id])
+
+    def test_spelling_dictionary_is_normalized(self):
+        """Test that the term dictionary holds normalized words, so variants are not corrected away"""
+        self.assertTrue(SearchTerm.objects.filter(term='شوكولاته').exists())
+        self.assertFalse(SearchTerm.objects.filter(term='شوكولاتة').exists())
+        self.assertIsNone(correct_query(normalize_arabic('شوكولاتة')).did_you_mean)
+
+
+class RelatedProductsTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        snacks = Category.objects.create(name='Snacks')
+        almarai = Brand.objects.create(name='Almarai')
+        nadec = Brand.objects.create(name='Nadec')
+        self.milk = Product.objects.create(sku='MILK001', name='Full Fat Milk', price='3.99', brand=almarai, category=dairy)
+        self.low_fat = Product.objects.create(sku='MILK002', name='Low Fat Milk', price='3.99', brand=almarai, category=dairy)
+        self.other_brand = Product.objects.create(sku='MILK003', name='Full Fat Milk', price='3.49', brand=nadec, category=dairy)
+        self.labneh = Product.objects.create(sku='LAB001', name='Labneh', price='5.99', brand=almarai, category=dairy)
+        self.chips = Product.objects.create(sku='CHIPS001', name='Milk Chocolate Chips', price='2.50', brand=almarai, category=snacks)
+        caches['default'].clear()
+
+    def refresh(self, **options):
+        out = StringIO()
+        # One worker: other connections would not see this test's uncommitted products
+        call_command('compute_related_products', workers=1, stdout=out, **options)
+        return out.getvalue()
+
+    def related(self, product):
+        response = APIClient().get(reverse('product-related', args=[product.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['sku'] for item in response.data['results']]
+
+    def test_neighbours_are_ranked_within_the_category(self):
+        """Test that neighbours come from the same category, same brand and similar names first"""
+        self.assertIn('Refreshed 5 products', self.refresh())
+        with self.assertNumQueries(1):
+            self.assertEqual(self.related(self.milk), ['MILK002', 'MILK003', 'LAB001'])
+        self.assertEqual(self.related(self.chips), [])
+        self.assertEqual(APIClient().get(reverse('product-related', args=[0])).status_code, 404)
+
+    def test_refresh_is_incremental(self):
+        """Test that only changed products, and those listing them, are recomputed"""
+        self.refresh()
+        # Only the chips, which have no neighbours to tell when they were computed
+        self.assertIn('Refreshed 1 products', self.refresh())
+        self.low_fat.name = 'Strawberry Yogurt'
+        self.low_fat.save()
+        # Low fat itself, the three dairy products that list it, and the chips
+        self.assertIn('Refreshed 5 products', self.refresh())
+        self.assertEqual(self.related(self.milk), ['MILK003', 'MILK002', 'LAB001'])
+
+        self.other_brand.is_active = False
+        self.other_brand.save()
+        self.refresh()
+        self.assertEqual(self.related(self.milk), ['MILK002', 'LAB001'])
+        self.assertFalse(RelatedProduct.objects.filter(product=self.other_brand).exists())
+        self.assertEqual(APIClient().get(reverse('product-related', args=[self.other_brand.id])).status_code, 404)
+        self.assertIn('Refreshed 5 products', self.refresh(full=True))
+
+
+@override_settings(CHANGES_SETTLE_SECONDS=0)
+class ChangeFeedTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        brand = Brand.objects.create(name='Almarai')
+        self.products = [
+            Product.objects.create(sku=f'MILK00{index}', name=f'Milk {index}', price='3.99', brand=brand, category=dairy)
+            for index in range(3)
+        ]
+        self.url = reverse('product-changes')
+        caches['default'].clear()
+
+    def sync(self, since=None, limit=2):
+        """All changes after `since`, page by page, and the final cursor"""
+        changes = []
+        while True:
+            params = {'limit': limit} if since is None else {'since': since, 'limit': limit}
+            response = APIClient().get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            changes += response.data['changes']
+            since = response.data['cursor']
+            if not response.data['has_more']:
+                return changes, since
+
+    def test_feed_resumes_from_its_cursor(self):
+        """Test that pages follow each other in write order and a caught up cursor returns nothing"""
+        changes, cursor = self.sync()
+        self.assertEqual([change['id'] for change in changes], [product.id for product in self.products])
+        self.assertEqual(changes[0]['op'], 'upsert')
+        self.assertEqual(changes[0]['product']['sku'], 'MILK000')
+        self.assertEqual(self.sync(cursor), ([], cursor))
+        self.assertEqual(APIClient().get(self.url, {'since': 'nope'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_deactivations_and_deletions_are_reported(self):
+        """Test that update(), deactivation and deletion are changes, and saves that change nothing are not"""
+        _, cursor = self.sync()
+        first, second, third = self.products
+        deleted_id = second.id
+        third.save()
+        Product.objects.filter(id=first.id).update(is_active=False)
+        second.delete()
+        changes, _ = self.sync(cursor)
+        self.assertEqual(
+            [(change['op'], change['id']) for change in changes],
+            [('upsert', first.id), ('delete', deleted_id)],
+        )
+        self.assertFalse(changes[0]['product']['is_active'])
+        self.assertEqual(changes[1]['sku'], 'MILK001')
+
+    def test_related_row_edits_are_reported(self):
+        """Test that editing a brand, category or nutrition facts is a change of the products embedding them"""
+        first, second, third = self.products
+        facts = NutritionFact.objects.create(calories=42)
+        Product.objects.filter(id=third.id).update(nutrition_facts=facts)
+        _, cursor = self.sync()
+        Brand.objects.filter(id=first.brand_id).update(country_of_origin='Saudi Arabia')
+        changes, cursor = self.sync(cursor)
+        self.assertEqual([change['id'] for change in changes], [product.id for product in self.products])
+        self.assertEqual(changes[0]['product']['brand']['country_of_origin'], 'Saudi Arabia')
+
+        Category.objects.filter(id=first.category_id).update(name='Milk & Dairy')
+        changes, cursor = self.sync(cursor)
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(changes[0]['product']['category']['name'], 'Milk & Dairy')
+
+        NutritionFact.objects.filter(id=facts.id).update(calories=60)
+        # Updates that change nothing touch nothing
+        Brand.objects.filter(id=first.brand_id).update(country_of_origin='Saudi Arabia')
+        changes, _ = self.sync(cursor)
+        self.assertEqual([change['id'] for change in changes], [third.id])
+        self.assertEqual(changes[0]['product']['nutrition_facts']['calories'], 60)
+
+    @override_settings(CHANGES_SETTLE_SECONDS=60)
+    def test_recent_changes_are_held_back(self):
+        """Test that changes are only served once transactions started before them had time to commit"""
+        self.assertEqual(self.sync(), ([], None))
+
+
+class InMemorySearchEngineTestCase(TestCase):
+    """Parity of InMemorySearchBackend with the SQL (ORM) backend"""
+
+    queries = [
+        'milk', 'Milk', 'fresh milk', 'almarai', 'Al Marai', 'cola', 'coca cola', 'drnk',
+        'chocolat', 'juice orange', 'dairy', 'bev', 'حليب', 'عصير برتقال', 'water', 'zzz',
+        'choc', 'co', 'milk -powder', 'cola or juice', '"orange juice"', 'عص', 'the',
+        'choclate milk', 'almari', 'minral watr', 'شوكولاتا',
+    ]
+    # Relevance (SQL formula) by which the engine's top results may trail the SQL backend's
+    RELEVANCE_TOLERANCE = 0.1
+
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        beverages = Category.objects.create(name='Beverages')
+        snacks = Category.objects.create(name='Snacks')
+        almarai = Brand.objects.create(name='Al Marai')
+        coca_cola = Brand.objects.create(name='Coca-Cola')
+        galaxy = Brand.objects.create(name='Galaxy')
+        catalog = [
+            ('Milk', 'حليب', 'Fresh cow milk', 'حليب بقر طازج', '3.99', almarai, dairy),
+            ('Milk Powder', 'حليب بودرة', 'Full cream milk powder', None, '12.50', almarai, dairy),
+            ('Laban Drink', 'لبن', 'Fresh laban drink made from milk', 'مشروب لبن', '1.25', almarai, dairy),
+            ('Orange Juice', 'عصير برتقال', 'Fresh orange juice', 'عصير برتقال طازج', '4.50', almarai, beverages),
+            ('Cola Drink', 'مشروب الكولا', 'Refreshing cola beverage', 'مشروب كولا منعش', '1.99', coca_cola, beverages),
+            ('Diet Cola', None, 'Sugar free cola', None, '2.10', coca_cola, beverages),
+            ('Mineral Water', 'مياه معدنية', 'Still drinking water', None, '0.99', coca_cola, beverages),
+            ('Chocolate Bar', 'شوكولاتة', 'Milk chocolate bar', None, '2.75', galaxy, snacks),
+            ('Dark Chocolate', 'شوكولاتة داكنة', 'Dark chocolate with fresh milk', None, '3.25', galaxy, snacks),
+        ]
+        for index, (name, name_ar, description, description_ar, price, brand, category) in enumerate(catalog):
+            Product.objects.create(name=name, name_ar=name_ar, description=description,
+                                   description_ar=description_ar, sku=f'SKU{index}', price=price,
+                                   brand=brand, category=category)
+        Product.objects.create(name='Old Milk', sku='OLD', price='1.00', brand=almarai,
+                               category=dairy, is_active=False)
+        call_command('refresh_search_terms', stdout=StringIO())
+        self.filters = [
+            {},
+            {'category': str(dairy.id)},
+            {'brand': str(coca_cola.id)},
+            {'min_price': '2.00', 'max_price': '4.00'},
+        ]
+        self.backend = InMemorySearchBackend()
+        self.backend.warm_up()
+
+    def _sql_ids(self, query, **filters):
+        return list(ORMSearchBackend().search(query, **filters).queryset.values_list('id', flat=True))
+
+    def assertMatchesSQL(self, result, query, **filters):
+        """
+        Assert that the engine returned the products of the SQL backend, and
+        the same top three up to RELEVANCE_TOLERANCE: it scores full-text
+        matches with text_score instead of ts_rank, so near ties may swap.
+        """
+        expected = ORMSearchBackend().search(query, **filters)
+        relevance = dict(expected.queryset.values_list('id', 'relevance'))
+        self.assertEqual(sorted(result.ranked_ids), sorted(relevance))
+        top = sorted(relevance.values(), reverse=True)[:3]
+        for product_id in result.ranked_ids[:3]:
+            self.assertGreaterEqual(relevance[product_id], top[-1] - self.RELEVANCE_TOLERANCE)
+        self.assertEqual(result.did_you_mean, expected.did_you_mean)
+
+    def test_corrections_match_sql_dictionary(self):
+        """Test that the in-memory dictionary finds the terms CORRECT_SQL finds"""
+        words = ['choclate', 'almari', 'minral', 'watr', 'choc', 'milk', 'شوكولاتا', 'zzzz', 'dri']
+        self.assertEqual(self.backend.engine.lookup_terms(words), lookup_words(words))
+
+    def test_trigram_functions_match_pg_trgm(self):
+        """Test that the Python similarity functions match pg_trgm"""
+        pairs = [('drnk', 'Cola Drink'), ('word', 'two words'), ('Almarai', 'Al Marai'),
+                 ('chocolat', 'Dark Chocolate'), ('حليب', 'حليب بودرة'), ('milk', None), ('', 'milk')]
+        with connection.cursor() as cursor:
+            for query, text in pairs:
+                cursor.execute('SELECT similarity(%s, %s), word_similarity(%s, %s)', [query, text, query, text])
+                expected = cursor.fetchone()
+                self.assertAlmostEqual(similarity(query, text), expected[0] or 0.0, places=6)
+                self.assertAlmostEqual(word_similarity(query, text), expected[1] or 0.0, places=6)
+
+    def test_full_text_matches_postgres(self):
+        """Test that parsed queries match the products the SearchQuery matches"""
+        engine = self.backend.engine
+        queries = ['milk', 'fresh milk', 'cola drink', 'orange juice fresh', 'choc', 'co -diet',
+                   'milk or juic', '"dark chocolate" fresh', 'coca-cola', '"the milk of the cow"',
+                   'the', '-the milk', 'cola or juice -diet', 'حليب طازج', 'حل milk', 'عص']
+        for query in queries:
+            parsed, search_query, excluded = parse_query(query), parse_search_query(query), exclusion_query(query)
+            rows = Product.objects.filter(is_active=True).annotate(
+                matches=ExpressionWrapper(Q(search_vector=search_query), output_field=BooleanField())
+                if search_query is not None else Value(False),
+                excluded=ExpressionWrapper(Q(search_vector=excluded), output_field=BooleanField())
+                if excluded is not None else Value(False),
+            ).values_list('id', 'matches', 'excluded')
+            for product_id, matches, is_excluded in rows:
+                with self.subTest(query=query, product=product_id):
+                    entries = engine._doc_entries(engine.ordinal_of[product_id])
+                    self.assertEqual(query_matches(parsed, entries), matches)
+                    self.assertEqual(any(term_matches(term, entries) for term in exclusion_terms(parsed)),
+                                     is_excluded)
+        # Words of the spelling dictionary are stemmed when the engine loads
+        with self.assertNumQueries(0):
+            parse_query.__wrapped__('fresh chocolate milk -cola')
+
+    def test_search_parity_with_sql_backend(self):
+        """Test that both backends return the same products and about the same top results"""
+        for query in self.queries:
+            for filters in self.filters:
+                with self.subTest(query=query, filters=filters):
+                    self.assertMatchesSQL(self.backend.search(query, **filters), query, **filters)
+
+    def test_truncation_parity(self):
+        """Test that both backends agree on truncation"""
+        with override_settings(SEARCH_CANDIDATE_LIMIT=2):
+            for query in ['milk', 'cola', 'zzz']:
+                with self.subTest(query=query):
+                    self.assertEqual(self.backend.search(query).truncated,
+                                     ORMSearchBackend().search(query).truncated)
+
+    def test_incremental_updates(self):
+        """Test that model signals keep the engine current"""
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name='Goat Milk', sku='GOAT', price='5.00',
+                                             brand=Brand.objects.get(name='Al Marai'),
+                                             category=Category.objects.get(name='Dairy'))
+        self.assertEqual(self.backend.search('goat').ranked_ids, [product.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            brand = Brand.objects.get(name='Galaxy')
+            brand.name = 'Cadbury'
+            brand.save()
+        self.assertMatchesSQL(self.backend.search('cadbury'), 'cadbury')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.is_active = False
+            product.save()
+        self.assertEqual(self.backend.search('goat').ranked_ids, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(name='Milk').delete()
+        self.assertMatchesSQL(self.backend.search('milk'), 'milk')
+
+    def test_catch_up_with_other_processes(self):
+        """Test that products updated or deleted elsewhere are re-read, deletions by tombstone"""
+        engine = self.backend.engine
+        # Writes without the engine's signals, like those of another process
+        Product.objects.filter(name='Diet Cola').update(name='Diet Soda')
+        Product.objects.filter(name='Mineral Water').delete()
+        engine.catch_up(bump_generation())
+        self.assertMatchesSQL(self.backend.search('soda'), 'soda')
+        self.assertEqual(self.backend.search('water').ranked_ids, [])
+        self.assertEqual(engine.memory_report()['products'], 8)
+
+    def test_sync_catches_up_in_the_background(self):
+        """Test that searches keep being answered while a catch-up runs"""
+        engine = self.backend.engine
+        started, release = threading.Event(), threading.Event()
+
+        def catch_up(generation):
+            started.set()
+            release.wait(5)
+
+        bump_generation()
+        with override_settings(SEARCH_ENGINE_SYNC_INTERVAL=0), patch.object(engine, 'catch_up', side_effect=catch_up):
+            engine.sync()
+            self.assertTrue(started.wait(5))
+            # A second sync does not start another catch-up
+            engine.sync()
+            self.assertEqual([thread.name for thread in threading.enumerate()].count('search-engine-sync'), 1)
+            self.assertMatchesSQL(self.backend.search('milk'), 'milk')
+            release.set()
+
+    def test_memory_report(self):
+        """Test that the memory report accounts for the indexed products"""
+        report = self.backend.engine.memory_report()
+        self.assertEqual(report['products'], 9)
+        self.assertGreater(report['full_text_posting_bytes'], 0)
+        self.assertEqual(report['total_bytes'], sum(
+            value for name, value in report.items() if name.endswith('_bytes') and name != 'total_bytes'
+        ))
+
+    def test_search_endpoint_with_memory_backend(self):
+        """Test that the search endpoint serves pages from the in-memory backend"""
+        ProductSearchService._backend = self.backend
+        self.addCleanup(setattr, ProductSearchService, '_backend', None)
+        url = reverse('product-search')
+        bump_generation()
+        response = self.client.get(url, {'q': 'milk'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ranked_ids = self.backend.search('milk').ranked_ids
+        self.assertEqual(sorted(ranked_ids), sorted(self._sql_ids('milk')))
+        self.assertEqual(response.data['count'], len(ranked_ids))
+        self.assertEqual([item['name'] for item in response.data['results']],
+                         [Product.objects.get(id=pk).name for pk in ranked_ids])
+
+        with patch.object(KeysetPagination, 'page_size', 2):
+            response = self.client.get(url, {'q': 'milk', 'pagination': 'cursor'})
+            second = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(second.data['previous'])
+
+
+class SuggestionIndexTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.dairy = Category.objects.create(name='Dairy')
+        self.snacks = Category.objects.create(name='Snacks')
+        self.almarai = Brand.objects.create(name='Almarai')
+        self.galaxy = Brand.objects.create(name='Galaxy')
+        catalog = [
+            ('Fresh Milk', 'حليب طازج', self.almarai, self.dairy),
+            ('Milk Powder', None, self.almarai, self.dairy),
+            ('Milk Chocolate', 'شوكولاتة بالحليب', self.galaxy, self.snacks),
+            ('Dark Chocolate', None, self.galaxy, self.snacks),
+            ('Caramel Chocolate', None, self.galaxy, self.snacks),
+        ]
+        for index, (name, name_ar, brand, category) in enumerate(catalog):
+            Product.objects.create(name=name, name_ar=name_ar, sku=f'SUG{index}', price='2.00',
+                                   brand=brand, category=category)
+        Product.objects.create(name='Millet Flakes', sku='SUGOLD', price='2.00', brand=self.almarai,
+                               category=self.dairy, is_active=False)
+        # Each test gets an index built from its own data
+        suggest._index = None
+        self.addCleanup(setattr, suggest, '_index', None)
+
+    def _suggest(self, q, **params):
+        response = self.client.get(reverse('product-suggest'), {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(item['text'], item['type'], item['weight']) for item in response.data['suggestions']]
+
+    def test_prefix_matches_any_word(self):
+        suggestions = self._suggest('choc')
+        self.assertEqual(suggestions, [
+            ('Caramel Chocolate', 'product', 1),
+            ('Dark Chocolate', 'product', 1),
+            ('Milk Chocolate', 'product', 1),
+        ])
+        self.assertIn(('شوكولاتة بالحليب', 'product', 1), self._suggest('شوك'))
+
+    def test_weighted_by_active_product_count(self):
+        suggestions = self._suggest('g')
+        self.assertEqual(suggestions[0], ('Galaxy', 'brand', 3))
+        suggestions = self._suggest('mil')
+        # Inactive products are not suggested
+        self.assertNotIn('Millet Flakes', [text for text, _, _ in suggestions])
+        self.assertEqual(self._suggest('mil', limit=2), suggestions[:2])
+        self.assertEqual(self._suggest(''), [])
+
+    @override_settings(SUGGEST_MEMOIZE_MIN_KEYS=1)
+    def test_incremental_updates(self):
+        # Memoize every lookup so the updates must invalidate the cached top lists
+        self._suggest('al')
+        self._suggest('alm')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Almond Milk', sku='SUG9', price='3.00',
+                                   brand=self.almarai, category=self.dairy)
+        self.assertEqual(self._suggest('al'), [('Almarai', 'brand', 3), ('Almond Milk', 'product', 1)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.almarai.name = 'Al Marai'
+            self.almarai.save()
+        self.assertEqual(self._suggest('mara'), [('Al Marai', 'brand', 3)])
+        self.assertEqual(self._suggest('alm'), [('Almond Milk', 'product', 1)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(name='Dark Chocolate').get().delete()
+        self.assertNotIn(('Dark Chocolate', 'product', 1), self._suggest('dark'))
+        self.assertEqual(self._suggest('snacks'), [('Snacks', 'category', 2)])
+
+    def test_updates_move_weight_between_spellings(self):
+        """Test that an entry merged from several spellings keeps counting all of them"""
+        Product.objects.create(name='fresh  MILK', sku='SUG7', price='2.00', brand=self.almarai, category=self.dairy)
+        suggest._index = None
+        self.assertEqual(self._suggest('fresh'), [('Fresh Milk', 'product', 2)])
+        product = Product.objects.get(sku='SUG7')
+        with self.captureOnCommitCallbacks(execute=True):
+            product.price = '2.50'
+            product.save()
+        self.assertEqual(self._suggest('fresh'), [('Fresh Milk', 'product', 2)])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = 'Fresh Cream'
+            product.save()
+        self.assertEqual(self._suggest('fresh'), [('Fresh Cream', 'product', 1), ('Fresh Milk', 'product', 1)])
+
+    def test_catch_up_with_other_processes(self):
+        """Test that writes without this process's signals are applied without a rebuild"""
+        index = suggest.get_suggestion_index()
+        # Bulk SQL and uncommitted signal callbacks, like the writes of another process
+        Product.objects.filter(sku='SUG3').update(name='Dark Cocoa')
+        Product.objects.filter(sku='SUG4').delete()
+        Product.objects.filter(sku='SUGOLD').update(is_active=True)
+        Brand.objects.filter(id=self.galaxy.id).update(name='Galaxy Bars')
+        with patch.object(index, 'build') as build:
+            index.catch_up(bump_generation())
+        build.assert_not_called()
+        self.assertEqual(self._suggest('dark'), [('Dark Cocoa', 'product', 1)])
+        self.assertEqual(self._suggest('cara'), [])
+        self.assertEqual(self._suggest('mille'), [('Millet Flakes', 'product', 1)])
+        self.assertEqual(self._suggest('gal'), [('Galaxy Bars', 'brand', 2)])
+        self.assertEqual(self._suggest('alm'), [('Almarai', 'brand', 3)])
+
+    @override_settings(SUGGEST_SYNC_INTERVAL=0)
+    def test_sync_catches_up_in_the_background(self):
+        """Test that lookups keep being answered while a catch-up with another process's writes runs"""
+        index = suggest.get_suggestion_index()
+        started, release = threading.Event(), threading.Event()
+
+        def catch_up(generation):
+            started.set()
+            release.wait(5)
+
+        bump_generation()
+        with patch.object(index, 'catch_up', side_effect=catch_up):
+            index.sync()
+            self.assertTrue(started.wait(5))
+            # A second sync does not start another catch-up
+            index.sync()
+            self.assertEqual([thread.name for thread in threading.enumerate()].count('suggest-sync'), 1)
+            self.assertEqual(self._suggest('dark'), [('Dark Chocolate', 'product', 1)])
+            release.set()
+
+
+class ImportProductsCommandTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.almarai = Brand.objects.create(name='Almarai')
+        self.dairy = Category.objects.create(name='Dairy')
+        Product.objects.create(name='Old Milk', sku='MILK1', price='2.00', brand=self.almarai, category=self.dairy)
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(content)
+        return path
+
+    def _import(self, path, **options):
+        out = StringIO()
+        call_command('import_products', path, stdout=out, **options)
+        return out.getvalue()
+
+    def test_csv_upsert_on_sku(self):
+        path = self._write('feed.csv', (
+            'sku,name,name_ar,price,brand,category,calories,protein\n'
+            'MILK1,Fresh Milk,حليب,3.99,Almarai,Dairy,60,3.2\n'
+            'TEA1,Black Tea,,1.50,Lipton,Beverages,,\n'
+            'TEA2,,,1.00,Lipton,Beverages,,\n'
+        ))
+        output = self._import(path, batch_size=2)
+        self.assertIn('1 inserted, 1 updated, 0 unchanged, 1 rejected', output)
+
+        milk = Product.objects.select_related('nutrition_facts').get(sku='MILK1')
+        self.assertEqual((milk.name, milk.name_ar, str(milk.price)), ('Fresh Milk', 'حليب', '3.99'))
+        self.assertEqual((milk.brand_id, milk.nutrition_facts.calories), (self.almarai.id, 60.0))
+        tea = Product.objects.get(sku='TEA1')
+        self.assertEqual((tea.brand.name, tea.category.name, tea.nutrition_facts), ('Lipton', 'Beverages', None))
+        self.assertIn('tea', str(tea.search_vector))
+        # The spelling dictionary is refreshed once the import is done
+        self.assertTrue(SearchTerm.objects.filter(term='lipton').exists())
+
+        # A second run of the same feed changes nothing
+        output = self._import(path)
+        self.assertIn('0 inserted, 0 updated, 2 unchanged, 1 rejected', output)
+        self.assertEqual(Brand.objects.filter(name='Lipton').count(), 1)
+
+    def test_jsonl_rejects_and_deferred_search_vector(self):
+        path = self._write('feed.jsonl', '\n'.join([
+            json.dumps({'sku': 'CHOC1', 'name': 'Dark Chocolate', 'price': 2.75, 'brand': 'Galaxy',
+                        'category': 'Snacks', 'nutrition_facts': {'calories': 550, 'sugar': 30}}),
+            json.dumps({'sku': 'CHOC2', 'name': 'Milk Chocolate', 'price': 'free', 'brand': 'Galaxy',
+                        'category': 'Snacks'}),
+            '{not json',
+            json.dumps({'sku': 'MILK1', 'name': 'Old Milk', 'price': '2.00', 'brand': 'Almarai',
+                        'category': 'Dairy', 'is_active': False}),
+        ]))
+        rejects = os.path.join(self.directory.name, 'rejects.jsonl')
+        output = self._import(path, rejects=rejects, defer_search_vector=True, workers=1)
+        self.assertIn('1 inserted, 1 updated, 0 unchanged, 2 rejected', output)
+
+        with open(rejects, encoding='utf-8') as handle:
+            rejected = [json.loads(line) for line in handle]
+        self.assertEqual([(row['line'], row['error']) for row in rejected],
+                         [(2, 'price is not a number'), (3, rejected[1]['error'])])
+        self.assertTrue(rejected[1]['error'].startswith('invalid JSON'))
+
+        chocolate = Product.objects.get(sku='CHOC1')
+        self.assertEqual(chocolate.nutrition_facts.sugar, 30.0)
+        self.assertFalse(Product.objects.get(sku='MILK1').is_active)
+        # Vectors skipped during the load are filled in at the end
+        self.assertFalse(Product.objects.filter(search_vector__isnull=True).exists())
+        self.assertIn('chocol', str(chocolate.search_vector))
+
+
+class SearchQueryParserTestCase(TestCase):
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Dark choc'), [[(['Dark'], True, False), (['choc'], True, False)]])
+        self.assertEqual(tokenize('milk OR juice -diet'), [
+            [(['milk'], True, False)],
+            [(['juice'], True, False), (['diet'], True, True)],
+        ])
+        self.assertEqual(tokenize('"dark chocolate" coca-cola'), [
+            [(['dark', 'chocolate'], False, False), (['coca', 'cola'], True, False)],
+        ])
+        # tsquery syntax in the input is treated as separators
+        self.assertEqual(tokenize("a & b | !c:* 'd'"), [[(['a'], True, False), (['b'], True, False),
+                                                        (['c'], True, False), (['d'], True, False)]])
+        self.assertEqual(tokenize('or - ""'), [])
+
+    def test_configs_per_token(self):
+        query = parse_query('milk حليب')
+        self.assertEqual(len(query), 1)  # one alternative of two terms
+        self.assertEqual(rank_operands(query), [('milk', True), ('حليب', True)])
+        self.assertIsNone(parse_search_query('!!!'))
+        self.assertEqual(parse_query('the'), ())  # only stop words
+
+
+class SearchBenchmarkTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_generated_catalog_is_deterministic(self):
+        first = list(generate_products(200, seed=7))
+        self.assertEqual(first, list(generate_products(200, seed=7)))
+        self.assertNotEqual(first, list(generate_products(200, seed=8)))
+        self.assertEqual(len({row['sku'] for row in first}), 200)
+        self.assertTrue(all(row['name_ar'] and row['brand'] and row['category'] for row in first))
+        self.assertTrue(any('nutrition_facts' in row for row in first))
+        self.assertEqual(percentile([1, 2, 3, 4], 0.5), 2.5)
+
+    def test_benchmark_saves_and_compares_baselines(self):
+        catalog = os.path.join(self.directory.name, 'catalog.jsonl')
+        call_command('generate_catalog', products=300, output=catalog, stdout=StringIO())
+        call_command('import_products', catalog, verbosity=0, stdout=StringIO())
+
+        baseline = os.path.join(self.directory.name, 'baseline.json')
+        options = {'rounds': 1, 'warmup': 0, 'stdout': StringIO(), 'stderr': StringIO()}
+        call_command('benchmark_search', save=baseline, **options)
+        with open(baseline, encoding='utf-8') as handle:
+            report = json.load(handle)
+        self.assertEqual(set(report['results']), {'service', 'endpoint'})
+        overall = report['results']['endpoint']['overall']
+        self.assertEqual(overall['errors'], 0)
+        self.assertGreaterEqual(overall['p99_ms'], overall['p50_ms'])
+        self.assertGreater(overall['queries_per_request'], 0)
+        self.assertIn('misspelled', report['results']['service']['kinds'])
+
+        out = StringIO()
+        call_command('benchmark_search', compare=baseline, target='service', **{**options, 'stdout': out})
+        self.assertIn('service/all: p50_ms', out.getvalue())
+
+
+class RequestMetricsTestCase(TestCase):
+    def setUp(self):
+        brand = Brand.objects.create(name='Almarai')
+        category = Category.objects.create(name='Dairy')
+        Product.objects.create(name='Fresh Milk', sku='MILK1', price='3.99', brand=brand, category=category)
+        self.category = category
+        get_histograms().reset()
+        self.client = APIClient()
+        self.admin = get_user_model()(username='admin', is_staff=True)
+
+    def test_metrics_are_staff_only(self):
+        """Test that anonymous and non-staff requests are refused"""
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(get_user_model()(username='user'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_200_OK)
+
+    def test_server_timing_and_histograms(self):
+        response = self.client.get(reverse('product-search'), {'q': 'milk'})
+        timing = response['Server-Timing']
+        for phase in ('sql;', 'search;', 'count;', 'rank;', 'hydrate;', 'render;', 'total;'):
+            self.assertIn(phase, timing)
+
+        self.client.force_authenticate(self.admin)
+        snapshot = self.client.get(reverse('metrics')).data
+        search = snapshot['endpoints']['product-search']
+        self.assertEqual(search['count'], 1)
+        self.assertEqual(search['buckets'][-1], {'le': '+Inf', 'count': 1})
+        self.assertGreater(search['sql_queries'], 0)
+        self.assertIn('rank', search['phases_ms'])
+
+    def test_phases_are_exclusive(self):
+        metrics = RequestMetrics()
+        with patch('products.metrics.time.perf_counter', side_effect=[0.0, 1.0, 3.0, 10.0]):
+            with metrics.timed('outer'):
+                with metrics.timed('inner'):
+                    pass
+        self.assertEqual(metrics.phases, {'inner': 2.0, 'outer': 8.0})
+
+    @override_settings(SLOW_SEARCH_THRESHOLD_MS=0, SLOW_SEARCH_EXPLAIN_SAMPLE_RATE=1.0)
+    def test_slow_search_log_with_plan(self):
+        with self.assertLogs('products.slow_search', level='WARNING') as logs:
+            self.client.get(reverse('product-search'), {'q': '  Fresh   MILK', 'category': self.category.id})
+        record = json.loads(logs.records[0].getMessage().split(': ', 1)[1])
+        self.assertEqual((record['query'], record['filters'], record['cache']),
+                         ('fresh milk', {'category': str(self.category.id)}, 'MISS'))
+        self.assertIn('actual time', record['plan'])
+
+        # Other endpoints never reach the slow search log
+        with self.assertNoLogs('products.slow_search'):
+            self.client.get(reverse('product-list'))
+
+
+class FastSerializationTestCase(TestCase):
+    def setUp(self):
+        brand = Brand.objects.create(name='Al "Safi"')
+        category = Category.objects.create(name='Dairy\\Fresh')
+        Product.objects.create(name='Milk \u2028 "Full" ✓', name_ar='حليب', sku='MILK1', price='10.50',
+                               brand=brand, category=category)
+        Product.objects.create(name='Laban', sku='LABAN1', price='0', brand=brand, category=category)
+        Product.objects.create(name='Old', sku='OLD1', price='1.00', brand=brand, category=category, is_active=False)
+        self.client = APIClient()
+
+    def test_rows_render_like_the_serializer(self):
+        queryset = Product.objects.order_by('name')
+        expected = ProductListSerializer(queryset.select_related('brand', 'category'), many=True).data
+        rows = EncodedRows(product_list_encoder, list(queryset.values_list(*product_list_encoder.columns)))
+        self.assertEqual(FastJSONRenderer().render(rows), JSONRenderer().render(expected))
+        self.assertEqual(rows, expected)
+
+        page = {'count': 3, 'next': 'http://testserver/?page=2', 'previous': None}
+        self.assertEqual(FastJSONRenderer().render({**page, 'results': rows}),
+                         JSONRenderer().render({**page, 'results': expected}))
+        # Indented output falls back to JSONRenderer
+        self.assertEqual(FastJSONRenderer().render(rows, 'application/json; indent=2'),
+                         JSONRenderer().render(expected, 'application/json; indent=2'))
+
+    def test_list_and_search_responses(self):
+        active = Product.objects.filter(is_active=True).select_related('brand', 'category').order_by('name')
+        expected = {'count': 2, 'next': None, 'previous': None,
+                    'results': ProductListSerializer(active, many=True).data}
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.content, JSONRenderer().render(expected))
+        self.assertEqual(response.data['results'][1]['price'], '10.50')
+
+        response = self.client.get(reverse('product-list'), {'pagination': 'cursor', 'ordering': '-price'})
+        self.assertEqual([item['sku'] for item in response.data['results']], ['MILK1', 'LABAN1'])
+
+        response = self.client.get(reverse('product-search'), {'q': 'milk'})
+        self.assertIn(b'"name":"Milk \\u2028 \\"Full\\" \xe2\x9c\x93"', response.content)
+        self.assertEqual(response.data['results'][0]['brand_name'], 'Al "Safi"')
+
+
+class AsyncSearchViewTestCase(TransactionTestCase):
+    # Pool threads have their own connections, so data must be committed
+
+    def setUp(self):
+        brand = Brand.objects.create(name='Almarai')
+        category = Category.objects.create(name='Dairy')
+        Product.objects.create(name='Fresh Milk', sku='MILK1', price='3.99', brand=brand, category=category)
+        self.pool = async_views._pool = async_views.SearchPool(2, 0.2, 1000)
+        self.addCleanup(setattr, async_views, '_pool', None)
+        self.addCleanup(self.pool.close)
+        self.addCleanup(setattr, suggest, '_index', None)
+        self.factory = AsyncRequestFactory()
+
+    async def test_responses_match_sync_views(self):
+        response = await async_views.search(self.factory.get('/api/products/search/', {'q': 'milk'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'][0]['sku'], 'MILK1')
+        expected = await sync_to_async(self.client.get)(reverse('product-search'), {'q': 'milk'})
+        self.assertEqual(response.content, expected.content)
+
+        response = await async_views.suggest(self.factory.get('/api/products/suggest/', {'q': 'fre'}))
+        self.assertEqual(json.loads(response.content)['suggestions'][0]['text'], 'Fresh Milk')
+
+    async def test_busy_pool_and_statement_timeout(self):
+        release = threading.Event()
+        busy = [asyncio.ensure_future(self.pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        response = await async_views.search(self.factory.get('/api/products/search/', {'q': 'milk'}))
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+        release.set()
+        await asyncio.gather(*busy)
+
+        def slow_view(request):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(2)')
+
+        response = await async_views._respond(slow_view, self.factory.get('/'))
+        self.assertEqual(response.status_code, 504)
+
+    def test_urls_route_to_async_views(self):
+        """Test that with SEARCH_ASYNC_VIEWS the URLconf serves the async views, not the router's"""
+        from product_search_api import urls as root_urls
+        from . import urls
+
+        def reload_urls():
+            importlib.reload(urls)
+            importlib.reload(root_urls)
+            clear_url_caches()
+
+        self.addCleanup(reload_urls)
+        with override_settings(SEARCH_ASYNC_VIEWS=True):
+            reload_urls()
+        self.assertIs(resolve('/api/products/search/').func, async_views.search)
+        self.assertIs(resolve('/api/products/search/batch/').func, async_views.search_batch)
+        self.assertIs(resolve('/api/products/suggest/').func, async_views.suggest)
+
+
+class ProductAdminTestCase(TestCase):
+    def setUp(self):
+        dairy = Category.objects.create(name='Dairy')
+        self.almarai = Brand.objects.create(name='Almarai')
+        nadec = Brand.objects.create(name='Nadec')
+        self.milk = Product.objects.create(sku='MILK001', name='Full Fat Milk', price='3.99', brand=self.almarai, category=dairy)
+        self.labneh = Product.objects.create(
+            sku='LAB001', name='Labneh', description='Strained yogurt', price='5.99', brand=nadec, category=dairy
+        )
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        self.url = reverse('admin:products_product_changelist')
+        caches['default'].clear()
+
+    def changelist(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(product.sku for product in response.context['cl'].result_list)
+
+    def test_search_uses_sku_full_text_and_trigrams(self):
+        """Test that admin search matches exact SKUs, words, prefixes and misspelled names"""
+        self.assertEqual(self.changelist(q='MILK001'), ['MILK001'])
+        self.assertEqual(self.changelist(q='yogurt'), ['LAB001'])
+        self.assertEqual(self.changelist(q='lab'), ['LAB001'])
+        self.assertEqual(self.changelist(q='Labneeh'), ['LAB001'])
+        self.assertEqual(self.changelist(q='  '), ['LAB001', 'MILK001'])
+
+    def test_brand_filter(self):
+        """Test that the autocomplete brand filter renders and filters by id"""
+        response = self.client.get(self.url, {'brand': self.almarai.id})
+        self.assertContains(response, 'data-filter-parameter="brand"')
+        self.assertEqual(sorted(p.sku for p in response.context['cl'].result_list), ['MILK001'])
+        # Invalid lookups redirect back with ?e=1
+        self.assertEqual(self.client.get(self.url, {'brand': 'x'}).status_code, 302)
+
+    def test_bulk_actions_update_the_search_index(self):
+        """Test that activate and deactivate update products and their search documents in one UPDATE"""
+        ids = [self.milk.id, self.labneh.id]
+        generation = get_generation()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'action': 'deactivate', '_selected_action': ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "products_product"') for query in queries), 1)
+        self.assertFalse(Product.objects.filter(is_active=True).exists())
+        self.assertFalse(SearchDocument.objects.filter(is_active=True).exists())
+        self.assertGreater(get_generation(), generation)
+
+        self.client.post(self.url, {'action': 'activate', '_selected_action': [self.milk.id]})
+        self.assertEqual(list(SearchDocument.objects.filter(is_active=True).values_list('sku', flat=True)), ['MILK001'])
+
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=0)
+    def test_estimated_count(self):
+        """Test that the changelist count is the planner estimate above the threshold"""
+        paginator = EstimatedCountPaginator(Product.objects.order_by('id'), 10)
+        self.assertIsInstance(paginator.count, int)
+        with self.settings(ESTIMATED_COUNT_THRESHOLD=10000):
+            self.assertEqual(EstimatedCountPaginator(Product.objects.order_by('id'), 10).count, 2)
+        self.assertEqual(self.changelist(), ['LAB001', 'MILK001'])
@@ -1,13 +1,28 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import CategoryViewSet, BrandViewSet, ProductViewSet
+from . import async_views
+from .views import CategoryViewSet, BrandViewSet, ProductViewSet, MetricsView
 
 router = DefaultRouter()
 router.register(r'categories', CategoryViewSet)
 router.register(r'brands', BrandViewSet)
 router.register(r'products', ProductViewSet)
 
+if settings.SEARCH_ASYNC_VIEWS:
+    # Under ASGI: requests wait on the event loop for a pooled connection
+    search_view, suggest_view = async_views.search, async_views.suggest
+    search_batch_view = async_views.search_batch
+else:
+    search_view = ProductViewSet.as_view({'get': 'search'})
+    suggest_view = ProductViewSet.as_view({'get': 'suggest'})
+    search_batch_view = ProductViewSet.as_view({'post': 'search_batch'})
+
+# Before the router, which also routes these actions to the sync viewset
 urlpatterns = [
+    path('products/search/', search_view, name='product-search'),
+    path('products/search/batch/', search_batch_view, name='product-search-batch'),
+    path('products/suggest/', suggest_view, name='product-suggest'),
     path('', include(router.urls)),
-    path('products/search/', ProductViewSet.as_view({'get': 'search'}), name='product-search'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -1,41 +1,88 @@
+from django.conf import settings
+from django.db import OperationalError
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, filters
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
 
-from .models import Category, Brand, Product
+from .models import Category, Brand, Product, SearchDocument
 from .serializers import (
     CategorySerializer, BrandSerializer,
-    ProductListSerializer, ProductDetailSerializer
+    ProductListSerializer, ProductDetailSerializer, SearchQuerySerializer,
+    EncodedRows, product_list_encoder
 )
+from .cache import SearchResultCache, get_or_set_catalog
+from .changes import ChangeFeed
+from .conditional import conditional
+from .degradation import TIER_FULL, get_load_governor, is_query_canceled
+from .export import CONTENT_TYPES, EXPORT_FORMATS, ProductExporter
+from .facets import parse_facets
+from .metrics import current_metrics, get_histograms, timed
+from .pagination import KeysetPagination
+from .related import related_rows
+from .routers import read_alias, replica_reads
 from .services import ProductSearchService
+from .suggest import get_suggestion_index
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Category.objects.all()
-    serializer_class = CategorySerializer
+class ReplicaReadMixin:
+    """Serve the viewset's reads from a read replica when one is usable (see products.routers)"""
+    
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class CachedCatalogViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Read-only viewset whose responses are validated with catalog ETags and
+    whose list data is kept in the shared search cache until the next
+    catalog write (see products.conditional).
+    """
     
-    @method_decorator(cache_page(60 * 60))  
+    @conditional
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        data = get_or_set_catalog(
+            f'{self.basename}:{request.get_host()}:{request.get_full_path()}',
+            lambda: super(CachedCatalogViewSet, self).list(request, *args, **kwargs).data,
+        )
+        return Response(data)
+    
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
-class BrandViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryViewSet(CachedCatalogViewSet):
+    queryset = Category.objects.all()
+    serializer_class = CategorySerializer
+
+class BrandViewSet(CachedCatalogViewSet):
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
-    
-    @method_decorator(cache_page(60 * 60))  
-    def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
 
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class ProductViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Product.objects.filter(is_active=True)
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['category', 'brand']
     ordering_fields = ['name', 'price', 'created_at']
     ordering = ['name']
+    # Query parameters that select a page of search results
+    search_page_params = ('page', 'cursor', 'pagination')
+    
+    @property
+    def paginator(self):
+        # ?pagination=cursor switches to keyset pages (no COUNT(*), no OFFSET)
+        if not hasattr(self, '_paginator') and KeysetPagination.is_requested(self.request):
+            self._paginator = KeysetPagination()
+        return super().paginator
+    
+    def check_throttles(self, request):
+        with timed('throttle'):
+            super().check_throttles(request)
     
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -43,8 +90,36 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         # Search or list 
         return ProductListSerializer
     
+    @conditional
+    def list(self, request, *args, **kwargs):
+        # Rows are read as tuples and encoded like ProductListSerializer (see RowEncoder)
+        queryset = self._values(self.filter_queryset(self.get_queryset()), product_list_encoder.columns)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(EncodedRows(product_list_encoder, page))
+        return Response(EncodedRows(product_list_encoder, list(queryset)))
+    
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+    
+    @action(detail=True, methods=['get']) # /{id}/related
+    @conditional
+    def related(self, request, pk=None):
+        """
+        Products similar to this one (same category, brand and name words),
+        best first, read from the table filled by compute_related_products
+        (see products.related) instead of searching for the product's name.
+        """
+        rows = related_rows(pk, product_list_encoder.columns) if pk.isdigit() else []
+        if not rows:
+            # Unknown and inactive products are a 404, products without neighbours an empty list
+            self.get_object()
+        return Response({'results': EncodedRows(product_list_encoder, rows)})
+    
     # Core of Task 
     @action(detail=False, methods=['get']) # /search
+    @conditional(degradable=True)
     def search(self, request):
         """
         Search products with advanced capabilities:
@@ -59,27 +134,254 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         - brand: Filter by brand ID
         - min_price: Filter by minimum price
         - max_price: Filter by maximum price
+        - pagination=cursor: Use keyset pagination (next/previous cursors, no count)
+        - facets: Comma separated facets to count (brand, category, price)
+        
+        The response includes `truncated`, which is true when the candidate
+        limit (SEARCH_CANDIDATE_LIMIT) cut off lower ranked matches, `tier`,
+        the degradation tier the search ran at (also in X-Search-Tier, see
+        products.degradation), and with `facets` the counts per facet value;
+        each facet ignores its own filter.
         """
         query = request.query_params.get('q', '')
-        category = request.query_params.get('category')
-        brand = request.query_params.get('brand')
-        min_price = request.query_params.get('min_price')
-        max_price = request.query_params.get('max_price')
+        filters = {
+            'category': request.query_params.get('category'),
+            'brand': request.query_params.get('brand'),
+            'min_price': request.query_params.get('min_price'),
+            'max_price': request.query_params.get('max_price'),
+        }
+        facets = parse_facets(request.query_params.get('facets'))
+        
+        # Ranked ids of this page, and the facet counts, are cached per query, filters and page
+        search_cache = SearchResultCache()
+        key = search_cache.make_key(query, filters, {
+            'host': request.get_host(),
+            'facets': ','.join(facets),
+            **{name: request.query_params.get(name) for name in self.search_page_params},
+        })
+        try:
+            entry, hit = search_cache.get_or_compute(
+                key,
+                lambda: self._search_page(query, filters, facets),
+                # Degraded pages are only kept until the load is likely to have passed
+                timeout=lambda entry: None if entry['tier'] == TIER_FULL else settings.SEARCH_DEGRADED_CACHE_TIMEOUT,
+            )
+        except OperationalError as exc:
+            if is_query_canceled(exc):
+                # Even the cheapest tier missed its deadline
+                return Response({'detail': 'Search timed out.'}, status=504)
+            raise
+        metrics = current_metrics()
+        if metrics is not None:
+            # Context for the slow search log
+            metrics.search = {
+                'query': search_cache.normalize_query(query),
+                'filters': {name: value for name, value in filters.items() if value not in (None, '')},
+                'cache': 'HIT' if hit else 'MISS',
+                'tier': entry['tier'],
+            }
+        
+        with timed('hydrate'):
+            data = EncodedRows(product_list_encoder, self._hydrate(entry['ids']))
+        meta = entry['meta']
+        if facets:
+            meta = {**(meta or {}), 'facets': entry['facets']}
+        if meta is None:
+            response = Response(data)
+        else:
+            response = Response({**meta, 'results': data})
+        response['X-Search-Cache'] = 'HIT' if hit else 'MISS'
+        response['X-Search-Tier'] = entry['tier']
+        return response
+    
+    @action(detail=False, methods=['post'], url_path='search/batch') # /search/batch
+    def search_batch(self, request):
+        """
+        Run several searches in one request: one database round trip for the
+        searches and one for their products, one throttle hit and one cache
+        entry for the whole batch.
+        
+        Body: a list of up to SEARCH_BATCH_MAX_QUERIES objects with the
+        search parameters `q`, `category`, `brand`, `min_price`, `max_price`
+        and `limit` (results per search, default PAGE_SIZE, at most
+        SEARCH_BATCH_MAX_LIMIT).
+        
+        The results are in input order, each with a `status`: `ok` with
+        `count` and `results`, or `error` with the `errors` of an invalid search.
+        """
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of searches.'}, status=400)
+        if len(request.data) > settings.SEARCH_BATCH_MAX_QUERIES:
+            return Response(
+                {'detail': f'At most {settings.SEARCH_BATCH_MAX_QUERIES} searches per batch.'}, status=400
+            )
         
-        # Use the search service
-        queryset = ProductSearchService.search(
-            query,
-            category=category,
-            brand=brand,
-            min_price=min_price,
-            max_price=max_price
+        queries, errors = [], {}
+        for index, item in enumerate(request.data):
+            serializer = SearchQuerySerializer(data=item)
+            if serializer.is_valid():
+                params = dict(serializer.validated_data)
+                queries.append((params.pop('q'), params, params.pop('limit')))
+            else:
+                errors[index] = serializer.errors
+        
+        search_cache = SearchResultCache()
+        key = search_cache.make_batch_key(queries)
+        batch_ids, hit = search_cache.get_or_compute(key, lambda: ProductSearchService.search_batch(queries))
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.search = {'batch': len(request.data), 'cache': 'HIT' if hit else 'MISS'}
+        
+        with timed('hydrate'):
+            rows = self._hydrate([pk for ids in batch_ids for pk in ids])
+        id_index = product_list_encoder.columns.index('id')
+        rows = {row[id_index]: row for row in rows}
+        
+        results, found = [], iter(batch_ids)
+        for index in range(len(request.data)):
+            if index in errors:
+                results.append({'status': 'error', 'errors': errors[index]})
+                continue
+            page = [rows[pk] for pk in next(found) if pk in rows]
+            results.append({'status': 'ok', 'count': len(page), 'results': EncodedRows(product_list_encoder, page)})
+        response = Response({'results': results})
+        response['X-Search-Cache'] = 'HIT' if hit else 'MISS'
+        return response
+    
+    @action(detail=False, methods=['get']) # /export
+    def export(self, request):
+        """
+        Stream all matching products as NDJSON or CSV in one response, with
+        brand, category and nutrition facts inline (see products.export).
+        
+        Query parameters:
+        - output: `ndjson` (default) or `csv`
+        - q, category, brand, min_price, max_price: as for search; products
+          are in rank order with a query
+        - ordering: without a query, `name` (default), `price` or
+          `created_at`, `-` for descending
+        """
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            return Response({'detail': f"Unknown output, use one of: {', '.join(EXPORT_FORMATS)}."}, status=400)
+        exporter = ProductExporter()
+        rows = exporter.rows(
+            request.query_params.get('q', ''),
+            ordering=request.query_params.get('ordering'),
+            # The rows are read while streaming, after the request left replica_reads()
+            using=read_alias(),
+            **{name: request.query_params.get(name) for name in ('category', 'brand', 'min_price', 'max_price')},
         )
+        response = StreamingHttpResponse(exporter.write(output, rows), content_type=CONTENT_TYPES[output])
+        response['Content-Disposition'] = f'attachment; filename="products.{output}"'
+        return response
+    
+    @action(detail=False, methods=['get']) # /changes
+    def changes(self, request):
+        """
+        Products created, updated, deactivated or deleted since a cursor, for
+        partner systems keeping a copy of the catalog (see products.changes).
+
+        Query parameters:
+        - since: `cursor` of the previous page; omit it to start from the beginning
+        - limit: Changes per page (default CHANGES_PAGE_SIZE, at most CHANGES_MAX_PAGE_SIZE)
+
+        The response has `changes` in order, each `upsert` with the `product`
+        (inactive ones included) or `delete` with the `sku` of a deleted
+        product, the `cursor` to pass as `since` next, and `has_more`.
+        """
+        try:
+            limit = int(request.query_params.get('limit', settings.CHANGES_PAGE_SIZE))
+        except ValueError:
+            limit = settings.CHANGES_PAGE_SIZE
+        limit = min(max(limit, 1), settings.CHANGES_MAX_PAGE_SIZE)
+        try:
+            # Not routed to a replica: in-flight writes are only visible on the primary
+            changes, cursor, has_more = ChangeFeed().read(request.query_params.get('since'), limit)
+        except ValueError:
+            return Response({'detail': 'Invalid cursor.'}, status=400)
+        return Response({'changes': changes, 'cursor': cursor, 'has_more': has_more})
+    
+    @action(detail=False, methods=['get']) # /suggest
+    def suggest(self, request):
+        """
+        Typeahead completions for product, brand and category names, served
+        from an in-process prefix index without querying the database.
         
-        # Apply pagination
-        page = self.paginate_queryset(queryset) # check if configured pagination exists in settings.py
-        if page is not None:
-            serializer = ProductListSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        Query parameters:
+        - q: Prefix typed so far (matches the start of any word)
+        - limit: Number of suggestions (default SUGGEST_LIMIT)
+        """
+        query = request.query_params.get('q', '')
+        try:
+            limit = int(request.query_params.get('limit', settings.SUGGEST_LIMIT))
+        except ValueError:
+            limit = settings.SUGGEST_LIMIT
+        limit = min(max(limit, 1), settings.SUGGEST_MAX_LIMIT)
+        
+        index = get_suggestion_index()
+        index.sync()
+        suggestions = [
+            {'text': text, 'type': kind, 'weight': weight}
+            for text, kind, weight in index.suggest(query, limit)
+        ]
+        return Response({'query': query, 'suggestions': suggestions})
+    
+    def _search_page(self, query, filters, facets=()):
+        """Run the search and return the ranked ids, pagination data, facet counts and tier of the requested page"""
+        entry, _ = ProductSearchService.search_tiered(query, self._read_page, facets, **filters)
+        return entry
+    
+    def _read_page(self, result, facet_counts):
+        """The page of a SearchResult, read under the deadline of its tier"""
+        # In-memory backends return ranked ids, the ORM backend a queryset
+        ranked = result.ranked_ids if result.ranked_ids is not None else self._values(result.queryset, ('id',))
+        metrics = current_metrics()
+        if metrics is not None and result.ranked_ids is None:
+            metrics.explain_queryset = result.queryset
+        
+        # Apply pagination; the ORM backend's relevance query runs here
+        with timed('rank'):
+            page = self.paginate_queryset(ranked) # check if configured pagination exists in settings.py
+            if page is None:
+                page = ranked if result.ranked_ids is not None else ranked.values_list('id', flat=True)
+                return {'ids': list(page), 'meta': None, 'facets': facet_counts, 'tier': result.tier}
         
-        serializer = ProductListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        meta = self.get_paginated_response(None).data
+        meta['truncated'] = result.truncated
+        meta['did_you_mean'] = result.did_you_mean
+        meta['tier'] = result.tier
+        ids = page if result.ranked_ids is not None else [row.id for row in page]
+        return {'ids': list(ids), 'meta': dict(meta), 'facets': facet_counts, 'tier': result.tier}
+    
+    @staticmethod
+    def _values(queryset, columns):
+        """Named rows of `columns` plus the ordering fields keyset pagination reads from each row"""
+        ordering = [
+            field.lstrip('-') for field in (queryset.query.order_by or queryset.model._meta.ordering)
+            if isinstance(field, str)
+        ]
+        extra = [field for field in dict.fromkeys(ordering + ['id']) if field not in columns]
+        return queryset.values_list(*columns, *extra, named=True)
+    
+    @staticmethod
+    def _hydrate(ids):
+        """Load list rows for cached ids from their search documents, keeping their ranked order"""
+        columns = [SearchDocument.PRODUCT_COLUMNS.get(column, column) for column in product_list_encoder.columns]
+        rows = SearchDocument.objects.filter(id__in=ids).values_list(*columns)
+        id_index = columns.index('id')
+        rows = {row[id_index]: row for row in rows}
+        return [rows[pk] for pk in ids if pk in rows]
+
+
+class MetricsView(APIView):
+    """
+    Request latency histograms per endpoint of the worker process that
+    answers, with SQL and phase totals (see products.metrics), and its
+    search load and degradation tier counters (see products.degradation).
+    Staff only: the endpoint names and traffic are operational details.
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response({**get_histograms().snapshot(), 'search_load': get_load_governor().snapshot()})